@@ -0,0 +1,318 @@
+import logging
+import math
+import os
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+import litserve as ls
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from litserve.server import RegularRequestHandler
+
+import api_metrics
+from api_batching import batching_loop
+from api_cache import cache_stats
+from api_embed import NomicVisionAPI
+from api_formats import (
+    FORMAT_FIELDS,
+    encode_embeddings,
+    matryoshka,
+    parse_format,
+    parse_matryoshka,
+)
+from api_priority import register_load_shedding
+from api_startup import register_readiness_route
+from api_stats import (
+    THUMBNAIL_SIZE,
+    analyze_colors,
+    create_stats_pool,
+    get_exif_data,
+    warm_stats_pool,
+)
+from api_utils import (
+    load_image,
+    open_image,
+    read_content,
+    register_upload_limit,
+    resolve_contents,
+)
+
+# Environment configurations
+PORT = int(os.environ.get("PORT", "8000"))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+NUM_API_SERVERS = int(os.environ.get("NUM_API_SERVERS", "1"))
+WORKERS_PER_DEVICE = int(os.environ.get("WORKERS_PER_DEVICE", "1"))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "32"))
+LATENCY_TARGET = float(os.environ.get("LATENCY_TARGET", "1.0"))
+# Queue bounds (0: unbounded) and bulk share of batches, see api_priority
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", str(16 * MAX_BATCH_SIZE)))
+BULK_QUEUE = int(os.environ.get("BULK_QUEUE", str(MAX_QUEUE // 2)))
+BULK_SHARE = float(os.environ.get("BULK_SHARE", "0.25"))
+BATCH_TIMEOUT = float(os.environ.get("BATCH_TIMEOUT", "0.2"))
+
+# Response fields a request can select with "fields"
+FIELDS = ("embeddings", "exif_data", "color_data")
+# Set by the analyze route on the payloads it submits, see register_analyze_route
+ANALYZE = "_analyze"
+
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL.upper()),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+def parse_fields(value) -> tuple[str, ...]:
+    """Read the "fields" request value (a list or comma-separated string)."""
+    if value is None:
+        return FIELDS
+    if isinstance(value, str):
+        value = value.split(",")
+    fields = tuple(f.strip() for f in value if f.strip())
+    unknown = [f for f in fields if f not in FIELDS]
+    if unknown or not fields:
+        raise ValueError(f"Unsupported fields {unknown}, expected some of {FIELDS}.")
+    return fields
+
+
+def decode_floor(size: tuple[int, int], embed_edge: int | None, stats: bool) -> int:
+    """
+    Smallest short edge to decode at so that the image still serves the
+    embedding (short edge >= ``embed_edge``) and, with ``stats``, the color
+    thumbnail (long edge >= THUMBNAIL_SIZE).
+    """
+    short, long = sorted(size)
+    floor = embed_edge or 1
+    if stats:
+        floor = max(floor, math.ceil(THUMBNAIL_SIZE * short / long))
+    return floor
+
+
+class ImageAnalyzeAPI(NomicVisionAPI):
+    """
+    The vision API, also serving /img/embed and /img/stats in one request
+    through register_analyze_route: every image is fetched and decoded once,
+    its colors are analyzed on the stats process pool while the batch runs
+    through the vision model, and "fields" selects which of "embeddings",
+    "exif_data" and "color_data" are computed at all.
+
+    Embed and analyze requests share the workers, batches and embedding
+    cache of this API, so the vision model is only loaded once per worker.
+    """
+
+    def setup(self, device):
+        self.pool = create_stats_pool()
+        super().setup(device)
+        logger.info("Image analysis setup complete.")
+
+    def warmup(self):
+        super().warmup()
+        warm_stats_pool(self.pool)
+
+    def decode_request(self, request, context):
+        if not request.get(ANALYZE):
+            return super().decode_request(request, context)
+        # Invalid requests fail on their own in encode_response, not the batch
+        context["analyze"] = True
+        context["format"] = {k: request[k] for k in FORMAT_FIELDS if k in request}
+        try:
+            fields = parse_fields(request.get("fields"))
+            if parse_format(context["format"])[1] == "raw":
+                raise ValueError("Use the 'json' or 'base64' encoding here.")
+            parse_matryoshka(context["format"])
+        except (TypeError, ValueError) as e:
+            context["error"] = str(e)
+            return None, ()
+        return read_content(request), fields
+
+    def batch(self, inputs):
+        # Analyze inputs are (content, fields), embed inputs only the content
+        with api_metrics.stage(self, "fetch"):
+            contents = resolve_contents(
+                [i[0] if isinstance(i, tuple) else i for i in inputs]
+            )
+        return [
+            (
+                self.prepare(file_bytes, input[1])
+                if isinstance(input, tuple)
+                else self.prepare_embed(file_bytes)
+            )
+            for file_bytes, input in zip(contents, inputs)
+        ]
+
+    def prepare(self, file_bytes: bytes | None, fields: tuple[str, ...]) -> dict:
+        """Decode one image once and start its color analysis."""
+        item = {}
+        if not fields:
+            return item
+        if file_bytes is None:
+            item["error"] = "No valid image data provided in request."
+            return item
+        colors = "color_data" in fields
+        embed_edge = self.decode_edge if "embeddings" in fields else None
+        image = open_image(
+            file_bytes, partial(decode_floor, embed_edge=embed_edge, stats=colors)
+        )
+        if image is None:
+            item["error"] = "No valid image data provided in request."
+            return item
+        if "embeddings" in fields:
+            item["key"] = self.cache_key(file_bytes, image.size)
+            item["cached"] = self.cache.get(item["key"])
+        if "exif_data" in fields:
+            # Read from the file header, before anything is decoded
+            item["exif_data"] = get_exif_data(image)
+        embed = "embeddings" in fields and item["cached"] is None
+        if not (embed or colors):
+            return item
+        with api_metrics.stage(self, "decode"):
+            try:
+                load_image(image)
+            except (OSError, ValueError) as e:
+                item["error"] = f"Failed to decode image: {e}"
+                return item
+        if embed:
+            item["image"] = image
+        if colors:
+            if self.pool is not None:
+                # Runs while the batch goes through the vision model
+                item["colors"] = self.pool.submit(analyze_colors, image)
+            else:
+                item["colors"] = image
+        return item
+
+    def cache_key(self, file_bytes: bytes, size: tuple[int, int]) -> str:
+        """
+        The /img/embed cache key of the image if it decodes it at ``size`` too,
+        else a key of its own: the embeddings of one image decoded at two
+        resolutions differ slightly.
+        """
+        embed_image = open_image(file_bytes, self.decode_edge)
+        if embed_image is not None and embed_image.size == size:
+            return self.cache.key(file_bytes)
+        width, height = size
+        return self.cache.key(f"analyze:{width}x{height}\0".encode() + file_bytes)
+
+    def predict(self, items):
+        if not isinstance(items, list):
+            # litserve skips batch() when batching is disabled
+            return self.predict(self.batch([items]))[0]
+
+        # Only run the model on cache misses, once per distinct image, for
+        # analyze items (dicts from prepare) and embed ones alike
+        pending = {}
+        for item in items:
+            if isinstance(item, dict) and "image" in item:
+                pending.setdefault(item["key"], item["image"])
+            elif isinstance(item, tuple) and item[2] is None:
+                pending.setdefault(item[0], item[1])
+        computed = self.embed_pending(pending, len(items))
+
+        outputs = []
+        broken = False
+        for item in items:
+            if not isinstance(item, dict):
+                outputs.append(self.embed_output(item, computed))
+                continue
+            output = {k: item[k] for k in ("error", "exif_data") if k in item}
+            if "key" in item and "error" not in item:
+                embedding = item["cached"]
+                if embedding is None:
+                    embedding = computed[item["key"]]
+                if isinstance(embedding, str):
+                    output["error"] = embedding
+                else:
+                    output["embeddings"] = embedding
+            colors = item.get("colors")
+            if isinstance(colors, Future):
+                with api_metrics.stage(self, "analyze_wait"):
+                    try:
+                        colors = colors.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        colors = {"error": "Image analysis process crashed."}
+            elif colors is not None:
+                with api_metrics.stage(self, "analyze"):
+                    colors = analyze_colors(colors)
+            if colors is not None and "error" in colors:
+                output.setdefault("error", colors["error"])
+            elif colors is not None:
+                output["color_data"] = colors["color_data"]
+            outputs.append(output)
+        if broken:
+            logger.error("Stats process pool crashed, starting a new one.")
+            self.pool = create_stats_pool()
+        return outputs
+
+    def encode_response(self, output, context):
+        if not context.get("analyze"):
+            return super().encode_response(output, context)
+        error = context.get("error") or output.get("error")
+        if error:
+            return JSONResponse(status_code=400, content={"detail": error})
+        with api_metrics.stage(self, "serialize"):
+            response = {}
+            if "embeddings" in output:
+                embeddings = output["embeddings"]
+                try:
+                    dimension, normalize = parse_matryoshka(
+                        context["format"], embeddings.shape[-1]
+                    )
+                except (TypeError, ValueError) as e:
+                    return JSONResponse(status_code=400, content={"detail": str(e)})
+                embeddings = matryoshka(embeddings, dimension, normalize)
+                dtype, encoding = parse_format(context["format"])
+                response = encode_embeddings(embeddings, dtype, encoding)
+            for field in ("exif_data", "color_data"):
+                if field in output:
+                    response[field] = output[field]
+            return response
+
+
+def register_analyze_route(server, lit_api: ImageAnalyzeAPI, path="/img/analyze"):
+    """
+    Add a POST ``path`` route for analyze requests, which it hands to the
+    workers of ``lit_api`` (serving /img/embed) like requests to its own route.
+    """
+    handler = RegularRequestHandler(lit_api, server)
+
+    async def analyze(request: Request):
+        content_type = request.headers.get("Content-Type", "")
+        if content_type.startswith(
+            ("multipart/form-data", "application/x-www-form-urlencoded")
+        ):
+            body = dict(await request.form())
+        else:
+            body = await request.json()
+        return await handler.handle_request({**body, ANALYZE: True}, dict)
+
+    server.app.add_api_route(path, analyze, methods=["POST"])
+
+
+if __name__ == "__main__":
+    api = ImageAnalyzeAPI(
+        max_batch_size=MAX_BATCH_SIZE,
+        batch_timeout=BATCH_TIMEOUT,
+        api_path="/embed",
+        loop=batching_loop(MAX_BATCH_SIZE, LATENCY_TARGET, BULK_SHARE),
+    )
+    server = ls.LitServer(
+        api,
+        accelerator="auto",
+        track_requests=True,
+        workers_per_device=WORKERS_PER_DEVICE,
+    )
+    register_load_shedding(server, api, MAX_QUEUE, BULK_QUEUE)
+    register_analyze_route(server, api, "/analyze")
+    server.app.add_api_route("/cache/stats", cache_stats, methods=["GET"])
+    api_metrics.register_metrics_route(server)
+    register_readiness_route(server)
+    register_upload_limit(server)
+    server.run(
+        port=PORT,
+        host="0.0.0.0",
+        log_level=LOG_LEVEL.lower(),
+        num_api_servers=NUM_API_SERVERS,
+        generate_client_file=False,
+    )
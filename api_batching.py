@@ -0,0 +1,260 @@
+"""
+Adaptive batching for the litserve batched loop.
+
+The static max_batch_size/batch_timeout of an API become upper bounds. For
+every batch the worker's BatchController picks how many requests to take
+and how long to wait for them after the first one arrives:
+
+- the batch size is the smallest one whose throughput, according to the
+  forward-pass cost observed per batch size, keeps up with the recent
+  arrival rate (with some headroom); requests already queued are always
+  taken up to the cap, since batching them costs no waiting
+- the wait is the expected time for that many requests to arrive, bounded
+  by batch_timeout and by what is left of the p99 latency target once the
+  expected forward pass is accounted for
+
+At low traffic this dispatches a lone request at once instead of paying
+the full timeout, and at peak it grows batches up to max_batch_size. A
+feedback factor shrinks the waits whenever the observed p99 exceeds the
+target. Queued requests are sorted into priority lanes (see api_priority)
+and every batch is filled from the interactive lane first.
+"""
+
+import logging
+import math
+import os
+import time
+from collections import deque
+from queue import Empty
+
+import numpy as np
+from litserve.loops.base import _SENTINEL_VALUE, _StopLoopError
+
+import api_metrics
+from api_metrics import InstrumentedBatchedLoop, api_label, metric
+from api_priority import LANE_LOOKAHEAD, Lanes
+
+ADAPTIVE_BATCHING = os.environ.get("ADAPTIVE_BATCHING", "1") == "1"
+# Capacity kept above the arrival rate when choosing the batch size
+ADAPTIVE_HEADROOM = float(os.environ.get("ADAPTIVE_HEADROOM", "1.25"))
+ADAPTIVE_LOG_INTERVAL = float(os.environ.get("ADAPTIVE_LOG_INTERVAL", "30"))
+# Arrivals older than this do not count towards the rate
+RATE_WINDOW = 10.0
+# Per-batch weight decay of the forward-pass cost model
+COST_DECAY = 0.98
+# Batches between p99 feedback updates
+FEEDBACK_INTERVAL = 32
+# How long an idle worker blocks on the queue per call
+IDLE_POLL = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+class BatchController:
+    """Chooses batch size and wait window for one worker."""
+
+    def __init__(self, max_batch_size: int, max_timeout: float, latency_target: float):
+        self.max_batch_size = max_batch_size
+        self.max_timeout = max_timeout
+        self.latency_target = latency_target
+        self.arrivals = deque(maxlen=4096)
+        self.latencies = deque(maxlen=2048)
+        # Exponentially weighted sums for least squares of seconds ~ size
+        self._w = self._b = self._t = self._bb = self._bt = 0.0
+        self.scale = 1.0
+        self.batches = 0
+
+    def observe_arrivals(self, timestamps: list[float]):
+        self.arrivals.extend(timestamps)
+
+    def observe_batch(self, size: int, seconds: float, latencies: list[float]):
+        """A batch of ``size`` took ``seconds``; its requests took ``latencies``."""
+        d = COST_DECAY
+        self._w = d * self._w + 1
+        self._b = d * self._b + size
+        self._t = d * self._t + seconds
+        self._bb = d * self._bb + size * size
+        self._bt = d * self._bt + size * seconds
+        self.latencies.extend(latencies)
+        self.batches += 1
+        if self.batches % FEEDBACK_INTERVAL == 0:
+            p99 = self.p99()
+            if p99 > self.latency_target:
+                self.scale = max(0.1, self.scale * 0.8)
+            elif p99 < 0.8 * self.latency_target:
+                self.scale = min(1.0, self.scale * 1.05)
+
+    def arrival_rate(self, now: float) -> float:
+        while self.arrivals and self.arrivals[0] < now - RATE_WINDOW:
+            self.arrivals.popleft()
+        if not self.arrivals:
+            return 0.0
+        # At least a second, so that a single burst does not read as a rate
+        span = max(now - self.arrivals[0], 1.0)
+        return len(self.arrivals) / span
+
+    def service_time(self, size: int) -> float:
+        """Expected seconds to process a batch of ``size`` (0 before any data)."""
+        if self._w == 0:
+            return 0.0
+        mean_b, mean_t = self._b / self._w, self._t / self._w
+        var_b = self._bb / self._w - mean_b * mean_b
+        if var_b < 1e-6:
+            # Only one size seen so far: assume cost proportional to size
+            return mean_t * size / mean_b
+        slope = max((self._bt / self._w - mean_b * mean_t) / var_b, 0.0)
+        intercept = max(mean_t - slope * mean_b, 0.0)
+        return intercept + slope * size
+
+    def p99(self) -> float:
+        return float(np.percentile(self.latencies, 99)) if self.latencies else 0.0
+
+    def plan(self, now: float, backlog: int, waited: float) -> tuple[int, float]:
+        """
+        Batch size and wait window for a batch whose first request has been
+        queued for ``waited`` seconds, with ``backlog`` more already queued.
+        """
+        rate = self.arrival_rate(now)
+        size = self.max_batch_size
+        for b in range(1, self.max_batch_size + 1):
+            cost = self.service_time(b)
+            if cost <= 0 or b / cost >= rate * ADAPTIVE_HEADROOM:
+                size = b
+                break
+        # Queued requests ride along for free
+        size = max(size, min(backlog + 1, self.max_batch_size))
+
+        missing = size - 1 - backlog
+        if missing <= 0 or rate <= 0:
+            return size, 0.0
+        budget = self.latency_target * self.scale - waited - self.service_time(size)
+        window = min(missing / rate, budget, self.max_timeout)
+        return size, max(window, 0.0)
+
+
+class AdaptiveBatchedLoop(InstrumentedBatchedLoop):
+    """
+    InstrumentedBatchedLoop that collects batches as planned by a
+    BatchController instead of litserve's fixed size and timeout.
+    """
+
+    def __init__(self, latency_target: float, bulk_share: float = 0.25):
+        super().__init__()
+        self.latency_target = latency_target
+        self.lanes = Lanes(bulk_share)
+        self.controller = None
+        self.dispatched = None  # (time, enqueue timestamps) of the last batch
+        self.last_gauges = self.last_log = -math.inf
+
+    def get_batch_requests(self, lit_api, request_queue):
+        if self.controller is None:
+            self.controller = BatchController(
+                lit_api.max_batch_size, lit_api.batch_timeout, self.latency_target
+            )
+        started = time.monotonic()
+        if self.dispatched is not None:
+            # The worker asks for a new batch once the previous one is done
+            dispatched_at, timestamps = self.dispatched
+            self.controller.observe_batch(
+                len(timestamps),
+                started - dispatched_at,
+                [started - t for t in timestamps],
+            )
+            self.dispatched = None
+
+        lanes = self.lanes
+        lookahead = LANE_LOOKAHEAD * lit_api.max_batch_size
+
+        def take(request_data):
+            if request_data == _SENTINEL_VALUE:
+                raise _StopLoopError()
+            lanes.put(request_data)
+
+        def look_ahead():
+            # Queued requests are sorted into lanes before choosing a batch
+            while len(lanes) < lookahead:
+                try:
+                    take(request_queue.get_nowait())
+                except Empty:
+                    break
+
+        if not lanes:
+            try:
+                take(request_queue.get(timeout=IDLE_POLL))
+            except Empty:
+                return [], []
+        look_ahead()
+
+        timed_out_uids = []
+        if lit_api.request_timeout not in (-1, False):
+            expired = lanes.expire(time.monotonic() - lit_api.request_timeout)
+            timed_out_uids = [(rq_id, uid) for _, (rq_id, uid, _, _) in expired]
+            if not lanes:
+                return [], timed_out_uids
+
+        now = time.monotonic()
+        try:
+            backlog = len(lanes) - 1 + request_queue.qsize()
+        except NotImplementedError:  # macOS
+            backlog = len(lanes) - 1
+        size, window = self.controller.plan(now, backlog, now - lanes.oldest())
+        deadline = now + window
+        while len(lanes) < size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    take(request_queue.get(timeout=remaining))
+                else:
+                    take(request_queue.get_nowait())
+            except Empty:
+                break
+        look_ahead()
+
+        batch = lanes.take(size)
+        payloads = [(rq_id, uid, x_enc) for _, (rq_id, uid, _, x_enc) in batch]
+        timestamps = [timestamp for _, (_, _, timestamp, _) in batch]
+        self.controller.observe_arrivals(timestamps)
+        self.record_batch(lit_api, started, timestamps, len(payloads))
+        self.record_plan(lit_api, size, window)
+        self.dispatched = (time.monotonic(), timestamps)
+        return payloads, timed_out_uids
+
+    def record_plan(self, lit_api, size: int, window: float):
+        api = api_label(lit_api)
+        api_metrics.observe(metric("batch_window_seconds", api=api), window)
+        now = time.monotonic()
+        if now - self.last_gauges < 1.0:
+            return
+        self.last_gauges = now
+        controller = self.controller
+        rate = controller.arrival_rate(now)
+        p99 = controller.p99()
+        labels = {"api": api, "worker": str(os.getpid())}
+        for name, value in (
+            ("batch_target_size", size),
+            ("batch_window_last_seconds", window),
+            ("arrival_rate", rate),
+            ("worker_latency_p99_seconds", p99),
+            ("batch_window_scale", controller.scale),
+        ):
+            api_metrics.set_gauge(metric(name, **labels), value)
+        if now - self.last_log >= ADAPTIVE_LOG_INTERVAL:
+            self.last_log = now
+            logger.info(
+                f"{api}: {rate:.1f} req/s, batch {size}/{controller.max_batch_size}, "
+                f"window {window * 1000:.1f}ms, "
+                f"forward {controller.service_time(size) * 1000:.1f}ms, "
+                f"p99 {p99 * 1000:.0f}ms (target "
+                f"{controller.latency_target * 1000:.0f}ms, scale {controller.scale:.2f})"
+            )
+
+
+def batching_loop(max_batch_size: int, latency_target: float, bulk_share: float = 0.25):
+    """
+    The loop= argument for a LitAPI: adaptive, with priority lanes (see
+    api_priority) giving bulk requests ``bulk_share`` of contended batches,
+    if enabled and batching.
+    """
+    if ADAPTIVE_BATCHING and max_batch_size > 1 and latency_target > 0:
+        return AdaptiveBatchedLoop(latency_target, bulk_share)
+    return "auto"
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import logging
+import os
+
+import litserve as ls
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from litserve.server import RegularRequestHandler
+
+from api_formats import parse_format, parse_integer, parse_matryoshka
+from api_priority import request_priority
+
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", "64"))
+# Chunks of one bulk request allowed in the batch queue at the same time
+BULK_MAX_INFLIGHT = int(os.environ.get("BULK_MAX_INFLIGHT", "2"))
+
+logger = logging.getLogger(__name__)
+
+
+async def stream_chunks(handler, texts, fields, chunk_size, max_inflight):
+    """
+    Submit ``texts`` in chunks as ordinary requests and yield one NDJSON line
+    per chunk as soon as it completes (so not necessarily in order). Only
+    ``max_inflight`` chunks are queued at once, which leaves room in every
+    batch for other clients and keeps at most that many results in memory.
+    """
+
+    async def run(offset):
+        payload = {**fields, "input": texts[offset : offset + chunk_size]}
+        while True:
+            try:
+                response = await handler.handle_request(payload, dict)
+                break
+            except HTTPException as e:
+                if e.status_code != 429:
+                    return {"offset": offset, "error": e.detail}
+                # The queue is full (see api_priority): back off and resubmit
+                await asyncio.sleep(float(e.headers.get("Retry-After", 1)))
+        if isinstance(response, Response):
+            # A 400 for this chunk from encode_response
+            return {"offset": offset, "error": json.loads(response.body)["detail"]}
+        return {"offset": offset, **response}
+
+    offsets = iter(range(0, len(texts), chunk_size))
+    pending = set()
+    for offset in offsets:
+        pending.add(asyncio.create_task(run(offset)))
+        if len(pending) >= max_inflight:
+            break
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.add(asyncio.create_task(run(offset)))
+                yield json.dumps(task.result()) + "\n"
+    finally:
+        # The client went away; stop submitting its remaining chunks
+        for task in pending:
+            task.cancel()
+
+
+def register_bulk_route(server: ls.LitServer, lit_api: ls.LitAPI, path: str):
+    """
+    Add a POST ``path`` route that accepts {"input": [...], ...} with any
+    number of texts and streams the embeddings of ``lit_api`` back as NDJSON
+    lines of {"offset": i, "embeddings": [...]}. Other request fields (such
+    as "prefix") are passed through to every chunk. Chunks are queued with
+    the "bulk" priority unless the request sets another one.
+    """
+    handler = RegularRequestHandler(lit_api, server)
+
+    async def embed_bulk(request: Request) -> StreamingResponse:
+        body = await request.json()
+        texts = body.get("input")
+        if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+            raise HTTPException(400, "'input' must be a list of strings.")
+        try:
+            _, encoding = parse_format(body)
+            parse_matryoshka(body)
+            request_priority(body)
+            chunk_size = parse_integer(
+                "chunk_size", body.get("chunk_size", BULK_CHUNK_SIZE)
+            )
+            if chunk_size < 1:
+                raise ValueError("'chunk_size' must be a positive integer.")
+        except (TypeError, ValueError) as e:
+            raise HTTPException(400, str(e)) from None
+        if encoding == "raw":
+            raise HTTPException(400, "Bulk responses are NDJSON, use 'base64'.")
+        fields = {k: v for k, v in body.items() if k not in ("input", "chunk_size")}
+        fields.setdefault("priority", "bulk")
+        logger.info(f"Streaming {len(texts)} embeddings in chunks of {chunk_size}.")
+        return StreamingResponse(
+            stream_chunks(handler, texts, fields, chunk_size, BULK_MAX_INFLIGHT),
+            media_type="application/x-ndjson",
+        )
+
+    server.app.add_api_route(path, embed_bulk, methods=["POST"])
@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import api_metrics
+
+CACHE_SIZE = int(os.environ.get("CACHE_SIZE", "10000"))
+CACHE_DIR = os.environ.get("CACHE_DIR", "")
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache with two tiers:
+
+    - a bounded in-memory LRU (``max_size`` entries, 0 disables it)
+    - an optional on-disk tier of memory-mapped ``.npy`` files under
+      ``cache_dir/<name>/`` that survives restarts and is shared by workers
+
+    Entries are full-size, unnormalized embeddings, which every request
+    truncates and normalizes as it asked for. Keys include the model so that
+    changing it never returns stale vectors.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        max_size: int = CACHE_SIZE,
+        cache_dir: str = CACHE_DIR,
+    ):
+        self.name = name
+        self.max_size = max_size
+        self.namespace = f"{model}|full".encode()
+        self.disk_dir = os.path.join(cache_dir, name) if cache_dir else None
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            logger.info(f"Using on-disk {name} embedding cache at {self.disk_dir}.")
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 or self.disk_dir is not None
+
+    def key(self, payload: bytes) -> str:
+        return hashlib.sha256(self.namespace + b"\0" + payload).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.npy")
+
+    def get(self, key: str) -> np.ndarray | None:
+        if not self.enabled:
+            return None
+        embedding = self._memory.get(key)
+        if embedding is not None:
+            self._memory.move_to_end(key)
+            self._count("hits")
+            return embedding
+        if self.disk_dir:
+            try:
+                embedding = np.array(np.load(self._disk_path(key), mmap_mode="r"))
+            except (OSError, ValueError):
+                embedding = None
+            if embedding is not None:
+                self._remember(key, embedding)
+                self._count("hits")
+                return embedding
+        self._count("misses")
+        return None
+
+    def put(self, key: str, embedding: np.ndarray):
+        if not self.enabled:
+            return
+        self._remember(key, embedding)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                return
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write-then-rename so readers in other workers never see a
+                # partial file.
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, embedding)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Failed to write {self.name} cache entry: {e}")
+
+    def _remember(self, key: str, embedding: np.ndarray):
+        if self.max_size <= 0:
+            return
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+            self._count("evictions")
+
+    def _count(self, event: str):
+        setattr(self, event, getattr(self, event) + 1)
+        api_metrics.inc(f"{self.name}_cache_{event}")
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._memory),
+        }
+
+
+def cache_stats() -> dict:
+    """Hit/miss/eviction counters summed over all workers, per cache name."""
+    stats: dict[str, dict] = {}
+    for metric, value in api_metrics.collect().items():
+        name, sep, event = metric.partition("_cache_")
+        if sep:
+            stats.setdefault(name, {})[event] = int(value)
+    return stats
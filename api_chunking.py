@@ -0,0 +1,120 @@
+"""
+Document mode for the text endpoint: token windows and pooled embeddings.
+
+The model truncates inputs at its max sequence length, and attention cost
+grows with the square of the length. Requests may set:
+
+- ``chunking``: "pooled" splits every input into overlapping token windows,
+  embeds each window as its own input (batched and cached with every other
+  text) and returns one token-weighted mean per input in "embeddings";
+  "chunks" also returns the windows, as "chunks": {"spans": [[start, end],
+  ...] (character offsets into the input), "embeddings": ...} per input
+- ``chunk_tokens``: window length in tokens, prefix and special tokens
+  included (TEXT_CHUNK_TOKENS by default)
+- ``chunk_overlap``: tokens shared by consecutive windows
+  (TEXT_CHUNK_OVERLAP by default)
+"""
+
+import math
+import os
+
+import numpy as np
+
+from api_formats import parse_integer
+
+# Window length; 0 derives it from the model and overlap (see chunk_tokens_for)
+TEXT_CHUNK_TOKENS = int(os.environ.get("TEXT_CHUNK_TOKENS", "0"))
+TEXT_CHUNK_OVERLAP = int(os.environ.get("TEXT_CHUNK_OVERLAP", "64"))
+
+CHUNK_FIELDS = ("chunking", "chunk_tokens", "chunk_overlap")
+CHUNKING_MODES = ("pooled", "chunks")
+# Special tokens the tokenizer adds around every input ([CLS] ... [SEP])
+SPECIAL_TOKENS = 2
+
+
+def chunk_tokens_for(overhead: int, hidden_size: int, max_tokens: int) -> int:
+    """
+    The window length with the least compute per input token.
+
+    Per token, a transformer layer spends ~12 d^2 multiply-adds in its
+    projections and ~2 L d in attention over a window of L tokens, and
+    ``overhead`` tokens of every window (the overlap, prefix and special
+    tokens) are repeated work. Minimizing L (12 d^2 + 2 L d) / (L - overhead)
+    gives L = overhead + sqrt(overhead^2 + 6 d overhead): longer windows waste
+    less on overhead, shorter ones less on attention. Rounded to a multiple
+    of 64.
+    """
+    best = overhead + math.sqrt(overhead**2 + 6 * hidden_size * overhead)
+    return int(min(max(64, round(best / 64) * 64), max_tokens))
+
+
+def parse_chunking(request, hidden_size: int, max_tokens: int, prefix_tokens: int):
+    """
+    (mode, window, overlap) of a request, None if it does not ask for
+    chunking. ``window`` excludes the prefix and special tokens. Raises
+    ValueError for invalid values.
+    """
+    mode = request.get("chunking")
+    if mode in (None, "", "none"):
+        return None
+    if mode not in CHUNKING_MODES:
+        raise ValueError(
+            f"Unsupported chunking {mode!r}, expected one of {CHUNKING_MODES}."
+        )
+    try:
+        overlap = parse_integer(
+            "chunk_overlap", request.get("chunk_overlap", TEXT_CHUNK_OVERLAP)
+        )
+        tokens = request.get("chunk_tokens")
+        if tokens is not None:
+            tokens = parse_integer("chunk_tokens", tokens)
+    except TypeError as e:
+        raise ValueError(str(e))
+    if tokens is None:
+        tokens = TEXT_CHUNK_TOKENS or chunk_tokens_for(
+            overlap + prefix_tokens + SPECIAL_TOKENS, hidden_size, max_tokens
+        )
+    if not 0 < tokens <= max_tokens:
+        raise ValueError(f"'chunk_tokens' must be between 1 and {max_tokens}.")
+    window = tokens - prefix_tokens - SPECIAL_TOKENS
+    if not 0 <= overlap < window:
+        raise ValueError(
+            f"'chunk_overlap' must be at least 0 and less than {window} "
+            f"(chunk_tokens minus the prefix and special tokens)."
+        )
+    return mode, window, overlap
+
+
+def chunk_spans(
+    text: str, offsets: list[tuple[int, int]], window: int, overlap: int
+) -> list[tuple[int, int, int]]:
+    """
+    (start, end, tokens) of the windows of ``text``, whose tokens span the
+    character ``offsets``. A text that fits in one window stays whole.
+    """
+    if len(offsets) <= window:
+        return [(0, len(text), max(len(offsets), 1))]
+    spans = []
+    step = window - overlap
+    for first in range(0, len(offsets), step):
+        last = min(first + window, len(offsets))
+        spans.append((offsets[first][0], offsets[last - 1][1], last - first))
+        if last == len(offsets):
+            break
+    return spans
+
+
+def pool_chunks(embeddings: np.ndarray, documents: list[list[tuple[int, int, int]]]):
+    """
+    Split the consecutive window ``embeddings`` of ``documents`` (their
+    chunk_spans) into (spans, embeddings) per document, and average each
+    document's windows weighted by their token counts.
+    """
+    pooled, chunks, row = [], [], 0
+    for spans in documents:
+        rows = embeddings[row : row + len(spans)]
+        row += len(spans)
+        weights = [tokens for _, _, tokens in spans]
+        pooled.append(np.average(rows, axis=0, weights=weights))
+        chunks.append(([[start, end] for start, end, _ in spans], rows))
+    return np.stack(pooled).astype(np.float32), chunks
@@ -2,22 +2,56 @@ import logging
 import os
 
 import litserve as ls
+import numpy as np
 import torch
-import torch.nn.functional as F
+from fastapi.responses import JSONResponse
 from PIL import Image
-from transformers import AutoImageProcessor, AutoModel
 
-from api_utils import decode_request
+import api_metrics
+from api_batching import batching_loop
+from api_cache import EmbeddingCache, cache_stats
+from api_formats import FORMAT_FIELDS
+from api_index import INDEX_FIELDS, index_embeddings, register_search_route
+from api_preprocess import BatchImagePreprocessor, PreprocessPipeline
+from api_priority import register_load_shedding
+from api_shared import SHARED_WEIGHTS, share_weights
+from api_startup import (
+    StartupTimer,
+    model_revision,
+    register_readiness_route,
+    resolve_model,
+    warmup_sizes,
+)
+from api_stub import STUB_MODELS, StubVisionModel, stub_image_processor, stub_name
+from api_utils import (
+    embedding_response,
+    load_image,
+    open_image,
+    read_content,
+    register_upload_limit,
+    resolve_contents,
+)
 
 # Environment configurations
 PORT = int(os.environ.get("PORT", "8000"))
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 NUM_API_SERVERS = int(os.environ.get("NUM_API_SERVERS", "1"))
-WORKERS_PER_DEVICE = int(os.environ.get("WORKERS_PER_DEVICE ", "1"))
+WORKERS_PER_DEVICE = int(os.environ.get("WORKERS_PER_DEVICE", "1"))
 MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "32"))
+LATENCY_TARGET = float(os.environ.get("LATENCY_TARGET", "1.0"))
+# Queue bounds (0: unbounded) and bulk share of batches, see api_priority
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", str(16 * MAX_BATCH_SIZE)))
+BULK_QUEUE = int(os.environ.get("BULK_QUEUE", str(MAX_QUEUE // 2)))
+BULK_SHARE = float(os.environ.get("BULK_SHARE", "0.25"))
 
-NORMALIZE = bool(os.environ.get("NORMALIZE", "0"))
-DIMENSION = int(os.environ.get("DIMENSION", "768"))
+FAST_PREPROCESS = os.environ.get("FAST_PREPROCESS", "1") == "1"
+# Images per micro-batch of the preprocessing pipeline (0 disables it)
+PIPELINE_MICRO_BATCH = int(os.environ.get("PIPELINE_MICRO_BATCH", "8"))
+PREPROCESS_THREADS = int(
+    os.environ.get("PREPROCESS_THREADS", str(min(4, os.cpu_count() or 1)))
+)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch").lower()
+VISION_MODEL = "nomic-ai/nomic-embed-vision-v1.5"
 
 # Set up logging
 logging.basicConfig(
@@ -30,50 +64,257 @@ logger = logging.getLogger(__name__)
 class NomicVisionAPI(ls.LitAPI):
     def setup(self, device):
         logger.info("Setting up Nomic vision model.")
-        self.processor = AutoImageProcessor.from_pretrained(
-            "nomic-ai/nomic-embed-vision-v1.5",
-            use_fast=False,
-        )
-        self.model = AutoModel.from_pretrained(
-            "nomic-ai/nomic-embed-vision-v1.5", trust_remote_code=True
-        )
+        startup = StartupTimer(self)
+        self.onnx = None
         self.device = device
-        self.model.to(device)
-        self.model.eval()
-        self.normalize = NORMALIZE
-        self.dimension = DIMENSION
+        if STUB_MODELS:
+            logger.warning("Using a stub vision model (STUB_MODELS=1).")
+            with startup.phase("load"):
+                self.processor = stub_image_processor()
+                self.model = StubVisionModel()
+        else:
+            with startup.phase("import"):
+                # Deferred so that API server processes never pay for it
+                from transformers import AutoImageProcessor
+            with startup.phase("resolve"):
+                self.model_path = resolve_model(VISION_MODEL)
+            with startup.phase("load"):
+                self.processor = AutoImageProcessor.from_pretrained(
+                    self.model_path,
+                    use_fast=False,
+                )
+                if INFERENCE_BACKEND == "onnx":
+                    # Only needed for this backend, and onnxruntime is an optional extra
+                    from api_onnx import load_or_export
+
+                    if device != "cpu":
+                        logger.warning(
+                            f"The ONNX backend runs on CPU, ignoring {device=}."
+                        )
+                    self.device = "cpu"
+                    self.model = None
+                    self.onnx = load_or_export(
+                        VISION_MODEL,
+                        model_revision(self.model_path),
+                        self.build_onnx_export,
+                    )
+                else:
+                    self.model = self.load_model()
+        if self.model is not None:
+            with startup.phase("to_device"):
+                self.model.to(self.device)
+                self.model.eval()
+            if SHARED_WEIGHTS and self.device == "cpu":
+                with startup.phase("share"):
+                    if STUB_MODELS:
+                        share_weights(self.model, stub_name(VISION_MODEL), "stub")
+                    else:
+                        share_weights(
+                            self.model,
+                            self.model_path,
+                            model_revision(self.model_path),
+                        )
+        model_name = stub_name(VISION_MODEL) if STUB_MODELS else VISION_MODEL
+        self.cache = EmbeddingCache("img", model_name)
+        # The processor resizes the short edge to this, so never decode smaller
+        size = self.processor.size
+        self.decode_edge = (
+            size.get("shortest_edge") or min(size["height"], size["width"])
+            if isinstance(size, dict)
+            else int(size)
+        )
+        self.fast_preprocessor = None
+        if FAST_PREPROCESS:
+            try:
+                self.fast_preprocessor = BatchImagePreprocessor.from_processor(
+                    self.processor
+                )
+            except ValueError as e:
+                logger.warning(f"Falling back to the slow image processor: {e}")
+        self.pipeline = None
+        if self.fast_preprocessor is not None and PIPELINE_MICRO_BATCH > 0:
+            self.pipeline = PreprocessPipeline(
+                self.fast_preprocessor,
+                PIPELINE_MICRO_BATCH,
+                PREPROCESS_THREADS,
+                self.device,
+                opener=self.load_content,
+            )
+        with startup.phase("warmup"):
+            self.warmup()
+        startup.done()
         logger.info("Vision model setup complete.")
 
-    def decode_request(self, request) -> Image.Image:
-        image = decode_request(request)
-        if image is None:
+    def load_model(self):
+        from transformers import AutoModel
+
+        # safetensors weights are memory-mapped instead of read into buffers
+        return AutoModel.from_pretrained(
+            self.model_path, trust_remote_code=True, use_safetensors=True
+        )
+
+    def build_onnx_export(self):
+        """The module and sample input api_onnx exports on its first run."""
+        from api_onnx import VisionEmbedding
+
+        crop = self.processor.crop_size
+        sample = {"pixel_values": torch.zeros(1, 3, crop["height"], crop["width"])}
+        return VisionEmbedding(self.load_model()), sample
+
+    def warmup(self):
+        """Run the model once per warmup batch size, bypassing the cache."""
+        edge = self.decode_edge
+        for size in warmup_sizes(self):
+            images = [Image.new("RGB", (edge * 4 // 3, edge), "gray")] * size
+            self.embed(images)
+            logger.info(f"Warmed up the vision model with a batch of {size}.")
+
+    def decode_request(self, request, context) -> bytes | str:
+        context["format"] = {k: request[k] for k in FORMAT_FIELDS if k in request}
+        context["index"] = {k: request[k] for k in INDEX_FIELDS if k in request}
+        content = read_content(request)
+        if content is None:
             raise ValueError("No valid image data provided in request.")
-        return image
+        return content
 
-    def predict(self, images):
-        if isinstance(images, list):
-            logger.info(f"Generating {len(images)} embeddings.")
-        else:
-            logger.info("Generating 1 embedding.")
+    def batch(self, inputs: list[bytes | str]):
+        # Fetch every URL in the batch concurrently instead of one per request
+        with api_metrics.stage(self, "fetch"):
+            contents = resolve_contents(inputs)
+        return [self.prepare_embed(file_bytes) for file_bytes in contents]
+
+    def prepare_embed(self, file_bytes: bytes | None) -> tuple | str:
+        """
+        The (cache key, image, cached embedding) of one image, or an error
+        message that encode_response turns into a 400 for its request alone:
+        raising would fail every other request in the batch.
+        """
+        if file_bytes is None:
+            return "No valid image data provided in request."
+        # Key on the encoded bytes so that cache hits skip image decoding too
+        key = self.cache.key(file_bytes)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return key, None, cached
+        with api_metrics.stage(self, "decode"):
+            image = open_image(file_bytes, self.decode_edge)
+            if image is not None and self.pipeline is None:
+                try:
+                    image = load_image(image)
+                except (OSError, ValueError) as e:
+                    return f"Failed to decode image: {e}"
+        if image is None:
+            return "No valid image data provided in request."
+        if self.pipeline is not None:
+            # Only the header is read so far; the pipeline decodes the bytes
+            # again one micro-batch at a time and frees the pixels when done
+            image = file_bytes
+        return key, image, None
 
-        inputs = self.processor(images, return_tensors="pt")
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+    def load_content(self, file_bytes: bytes) -> Image.Image | None:
+        """Decode an image for the pipeline, waiting for decode budget."""
+        image = open_image(file_bytes, self.decode_edge)
+        return None if image is None else load_image(image, wait=True)
 
-        with torch.no_grad():
-            img_emb = self.model(**inputs).last_hidden_state
-            img_embeddings = img_emb[:, 0]
+    def predict(self, items):
+        if not isinstance(items, list):
+            # litserve skips batch() when batching is disabled
+            return self.predict(self.batch([items]))[0]
+
+        # Only run the model on cache misses, once per distinct image
+        pending: dict[str, Image.Image | bytes] = {}
+        for item in items:
+            if isinstance(item, tuple) and item[2] is None:
+                pending.setdefault(item[0], item[1])
+        computed = self.embed_pending(pending, len(items))
+        return [self.embed_output(item, computed) for item in items]
+
+    def embed_pending(self, pending: dict, requests: int) -> dict:
+        """
+        Embed the ``pending`` images of a batch of ``requests`` and cache them,
+        by cache key. Images the pipeline could not decode get an error message.
+        """
+        logger.info(
+            f"Generating {len(pending)} embeddings "
+            f"({requests - len(pending)} served from cache or failed)."
+        )
+        computed = {}
+        if pending:
+            embeddings = self.embed(list(pending.values()))
+            for key, embedding in zip(pending, embeddings):
+                if np.isnan(embedding).any():
+                    computed[key] = "Failed to decode image."
+                    continue
+                self.cache.put(key, embedding)
+                computed[key] = embedding
+        return computed
+
+    @staticmethod
+    def embed_output(item: tuple | str, computed: dict) -> np.ndarray | str:
+        """The embedding of an item from prepare_embed, or its error message."""
+        if isinstance(item, str):
+            return item
+        key, _, cached = item
+        return cached if cached is not None else computed[key]
+
+    def embed(self, images: list[Image.Image | bytes]) -> np.ndarray:
+        if self.pipeline is not None:
+            return self.embed_pipelined(images)
+        with api_metrics.stage(self, "preprocess"):
+            if self.fast_preprocessor is not None:
+                inputs = self.fast_preprocessor(images, device=self.device)
+            else:
+                inputs = self.processor(images, return_tensors="pt")
+                inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        return self.embed_inputs(inputs)
+
+    def embed_pipelined(self, images: list[Image.Image | bytes]) -> np.ndarray:
+        """Embed in micro-batches, preprocessing the next during each forward."""
+        embeddings, timings = self.pipeline.run(images, self.embed_inputs)
+        api = api_metrics.api_label(self)
+        api_metrics.observe(
+            api_metrics.metric("stage_seconds", api=api, stage="preprocess"),
+            timings["preprocess"],
+        )
+        api_metrics.observe(
+            api_metrics.metric("pipeline_overlap", api=api),
+            timings["overlap"],
+            api_metrics.RATIO_BUCKETS,
+        )
+        logger.debug(
+            f"Pipelined {len(images)} images: {timings['preprocess']:.3f}s "
+            f"preprocessing, {timings['forward']:.3f}s forward in "
+            f"{timings['wall']:.3f}s ({timings['overlap']:.0%} overlap)"
+        )
+        return embeddings
 
-        # Truncate to Matryoshka embedding dimension
-        embedding = img_embeddings[:, : self.dimension]
-        # Apply normalization if requested
-        logger.debug(f"Embedding shape: {embedding.shape}")
+    def embed_inputs(self, inputs: dict[str, torch.Tensor]) -> np.ndarray:
+        """Embed already preprocessed ``pixel_values`` (see backfill.py)."""
+        with api_metrics.stage(self, "forward"), torch.no_grad():
+            if self.onnx is not None:
+                img_embeddings = torch.from_numpy(self.onnx(**inputs))
+            else:
+                img_emb = self.model(**inputs).last_hidden_state
+                img_embeddings = img_emb[:, 0]
+            if img_embeddings.is_cuda:
+                # Kernels run asynchronously; charge them to this stage
+                torch.cuda.synchronize(img_embeddings.device)
 
-        if self.normalize:
-            embedding = F.normalize(embedding, p=2, dim=-1)
-        return embedding.cpu().numpy()
+        # Full size and unnormalized: every request of the batch picks its own
+        # dimension and normalization in encode_response
+        with api_metrics.stage(self, "transfer"):
+            return img_embeddings.cpu().numpy()
 
-    def encode_response(self, output):
-        return {"embeddings": output.tolist()}
+    def encode_response(self, output, context):
+        if isinstance(output, str):
+            # This image failed in batch() or predict(), not its batch
+            return JSONResponse(status_code=400, content={"detail": output})
+        try:
+            index_embeddings(context["index"], output)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"detail": str(e)})
+        with api_metrics.stage(self, "serialize"):
+            return embedding_response(output, context["format"])
 
 
 if __name__ == "__main__":
@@ -81,6 +322,7 @@ if __name__ == "__main__":
         max_batch_size=MAX_BATCH_SIZE,
         batch_timeout=1,
         api_path="/embed",
+        loop=batching_loop(MAX_BATCH_SIZE, LATENCY_TARGET, BULK_SHARE),
     )
     server = ls.LitServer(
         api,
@@ -88,6 +330,12 @@ if __name__ == "__main__":
         track_requests=True,
         workers_per_device=WORKERS_PER_DEVICE,
     )
+    register_load_shedding(server, api, MAX_QUEUE, BULK_QUEUE)
+    server.app.add_api_route("/cache/stats", cache_stats, methods=["GET"])
+    api_metrics.register_metrics_route(server)
+    register_search_route(server, image_api=api)
+    register_readiness_route(server)
+    register_upload_limit(server)
     server.run(
         port=PORT,
         host="0.0.0.0",
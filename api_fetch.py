@@ -0,0 +1,137 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+FETCH_CONNECT_TIMEOUT = float(os.environ.get("FETCH_CONNECT_TIMEOUT", "3.05"))
+FETCH_READ_TIMEOUT = float(os.environ.get("FETCH_READ_TIMEOUT", "10"))
+FETCH_MAX_BYTES = int(os.environ.get("FETCH_MAX_BYTES", str(32 * 1024 * 1024)))
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", "16"))
+FETCH_POOL_HOSTS = int(os.environ.get("FETCH_POOL_HOSTS", "8"))
+# Comma-separated "from=to" netloc pairs, e.g. for reaching a sibling
+# container that clients address as localhost.
+FETCH_HOST_REWRITES = os.environ.get(
+    "FETCH_HOST_REWRITES", "localhost:3210=backend:3210"
+)
+
+logger = logging.getLogger(__name__)
+
+
+class FetchError(Exception):
+    pass
+
+
+def parse_host_rewrites(spec: str) -> dict[str, str]:
+    """Parse "a=b,c=d" into {"a": "b", "c": "d"}, ignoring blank entries."""
+    rewrites = {}
+    for pair in spec.split(","):
+        if not pair.strip():
+            continue
+        source, sep, target = pair.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid host rewrite {pair!r}, expected 'from=to'.")
+        rewrites[source.strip()] = target.strip()
+    return rewrites
+
+
+class Fetcher:
+    """
+    Fetches image URLs over a shared keep-alive session.
+
+    Connections are pooled per host, every request has connect/read timeouts,
+    and bodies are streamed so that oversized responses are aborted as soon
+    as they cross ``max_bytes`` instead of being buffered in full.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = FETCH_CONNECT_TIMEOUT,
+        read_timeout: float = FETCH_READ_TIMEOUT,
+        max_bytes: int = FETCH_MAX_BYTES,
+        concurrency: int = FETCH_CONCURRENCY,
+        pool_hosts: int = FETCH_POOL_HOSTS,
+        host_rewrites: dict[str, str] | None = None,
+        session: requests.Session | None = None,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_bytes = max_bytes
+        self.concurrency = max(1, concurrency)
+        self.host_rewrites = (
+            parse_host_rewrites(FETCH_HOST_REWRITES)
+            if host_rewrites is None
+            else host_rewrites
+        )
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=pool_hosts, pool_maxsize=self.concurrency
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self._executor: ThreadPoolExecutor | None = None
+
+    def rewrite(self, url: str) -> str:
+        parts = urlsplit(url)
+        target = self.host_rewrites.get(parts.netloc)
+        if target is None:
+            return url
+        return urlunsplit(parts._replace(netloc=target))
+
+    def fetch(self, url: str) -> bytes:
+        """Download ``url``, raising FetchError on any failure or oversize body."""
+        url = self.rewrite(url)
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                declared = response.headers.get("Content-Length")
+                if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                    raise FetchError(
+                        f"{url} declares {declared} bytes, over the "
+                        f"{self.max_bytes} byte limit."
+                    )
+                chunks = []
+                received = 0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    received += len(chunk)
+                    if received > self.max_bytes:
+                        raise FetchError(
+                            f"{url} exceeded the {self.max_bytes} byte limit."
+                        )
+                    chunks.append(chunk)
+                return b"".join(chunks)
+        except requests.exceptions.RequestException as e:
+            raise FetchError(f"Failed to fetch image from URL {url}: {e}") from e
+
+    def fetch_all(self, urls: list[str]) -> list[bytes | None]:
+        """Fetch ``urls`` concurrently, returning None for each failed fetch."""
+        if not urls:
+            return []
+        if len(urls) == 1:
+            return [self._fetch_or_none(urls[0])]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="fetch"
+            )
+        return list(self._executor.map(self._fetch_or_none, urls))
+
+    def _fetch_or_none(self, url: str) -> bytes | None:
+        try:
+            return self.fetch(url)
+        except FetchError as e:
+            logger.error(str(e))
+            return None
+
+
+_fetcher: Fetcher | None = None
+
+
+def get_fetcher() -> Fetcher:
+    """Process-wide Fetcher, created lazily so that each worker owns its pool."""
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = Fetcher()
+    return _fetcher
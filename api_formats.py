@@ -0,0 +1,187 @@
+"""
+Compact response formats for the embedding endpoints.
+
+Requests may set four optional fields:
+
+- ``dimension``: keep only the first ``dimension`` values of every vector
+  (Matryoshka truncation), DIMENSION by default
+- ``normalize``: scale the (truncated) vectors to unit length, NORMALIZE by
+  default
+- ``dtype``: "float32" (default), "float16", "int8" (symmetric, with one
+  float scale per vector) or "binary" (sign bits packed with np.packbits,
+  most significant bit first)
+- ``encoding``: "json" (default, a list of numbers), "base64" (the raw
+  little-endian bytes as a base64 string inside JSON) or "raw" (the bytes
+  as an application/octet-stream body, described by X-Embedding-* headers)
+
+``decode_embeddings`` turns any of these responses back into a float32 (or,
+for "binary", a 0/1 uint8) NumPy array and only needs NumPy, so clients can
+copy it as is.
+"""
+
+import base64
+import os
+
+import numpy as np
+
+# Defaults for requests that do not set "dimension" and "normalize"
+DIMENSION = int(os.environ.get("DIMENSION", "768"))
+NORMALIZE = os.environ.get("NORMALIZE", "0") == "1"
+
+# Request fields read by parse_matryoshka and parse_format
+FORMAT_FIELDS = ("dimension", "normalize", "dtype", "encoding")
+DTYPES = ("float32", "float16", "int8", "binary")
+ENCODINGS = ("json", "base64", "raw")
+
+
+def parse_format(request) -> tuple[str, str]:
+    """Read and validate the dtype/encoding fields, raising ValueError if invalid."""
+    dtype = request.get("dtype", "float32")
+    encoding = request.get("encoding", "json")
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported dtype {dtype!r}, expected one of {DTYPES}.")
+    if encoding not in ENCODINGS:
+        raise ValueError(
+            f"Unsupported encoding {encoding!r}, expected one of {ENCODINGS}."
+        )
+    return dtype, encoding
+
+
+def parse_integer(name: str, value) -> int:
+    """
+    The integer ``value`` of request field ``name``, raising TypeError for
+    other types, bools and floats included. Form uploads send strings, so
+    "64" is accepted.
+    """
+    if isinstance(value, str):
+        try:
+            value = int(value)
+        except ValueError:
+            pass
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise TypeError(f"'{name}' must be an integer, got {value!r}.")
+    return value
+
+
+def parse_matryoshka(request, size: int | None = None) -> tuple[int, bool]:
+    """
+    Read and validate the dimension/normalize fields for embeddings of
+    ``size`` values (unchecked if None), raising TypeError for values of the
+    wrong type and ValueError for out of range ones. Form uploads send both
+    as strings, so "256" and "true" are accepted.
+    """
+    dimension = request.get("dimension")
+    if dimension is None:
+        dimension = DIMENSION if size is None else min(DIMENSION, size)
+    if isinstance(dimension, str) and dimension.strip().isdigit():
+        dimension = int(dimension)
+    if isinstance(dimension, bool) or not isinstance(dimension, int):
+        raise TypeError(f"Unsupported dimension {dimension!r}, expected an integer.")
+    if dimension < 1 or (size is not None and dimension > size):
+        raise ValueError(f"Unsupported dimension {dimension}, expected 1 to {size}.")
+    normalize = request.get("normalize", NORMALIZE)
+    if isinstance(normalize, str):
+        normalize = {"true": True, "1": True, "false": False, "0": False}.get(
+            normalize.lower(), normalize
+        )
+    if not isinstance(normalize, bool):
+        raise TypeError(f"Unsupported normalize {normalize!r}, expected a boolean.")
+    return dimension, normalize
+
+
+def matryoshka(embeddings: np.ndarray, dimension: int, normalize: bool):
+    """Truncate full-size embeddings to ``dimension``, then maybe normalize."""
+    embeddings = embeddings[..., :dimension]
+    if normalize:
+        norm = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        embeddings = embeddings / np.where(norm == 0, 1.0, norm)
+    return embeddings
+
+
+def quantize(embeddings: np.ndarray, dtype: str):
+    """Convert float embeddings to ``dtype``, returning (values, scale or None)."""
+    if dtype == "float32":
+        return embeddings.astype("<f4", copy=False), None
+    if dtype == "float16":
+        return embeddings.astype("<f2"), None
+    if dtype == "int8":
+        scale = np.abs(embeddings).max(axis=-1) / 127.0
+        scale = np.where(scale == 0, 1.0, scale).astype(np.float32)
+        values = np.round(embeddings / scale[..., None]).clip(-127, 127)
+        return values.astype(np.int8), scale
+    return np.packbits(embeddings > 0, axis=-1), None
+
+
+def encode_embeddings(embeddings: np.ndarray, dtype="float32", encoding="json"):
+    """
+    Encode one request's embeddings (a vector or a matrix).
+
+    Returns a JSON-serializable dict for "json"/"base64", or a (body, headers)
+    tuple for "raw".
+    """
+    if dtype == "float32" and encoding == "json":
+        # The original response format, kept byte-for-byte compatible
+        return {"embeddings": embeddings.tolist()}
+
+    values, scale = quantize(embeddings, dtype)
+    meta = {"dtype": dtype, "dimension": int(embeddings.shape[-1])}
+    if encoding == "raw":
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "X-Embedding-Dtype": dtype,
+            "X-Embedding-Dimension": str(meta["dimension"]),
+            "X-Embedding-Shape": ",".join(str(n) for n in values.shape),
+        }
+        if scale is not None:
+            headers["X-Embedding-Scale"] = ",".join(
+                repr(float(s)) for s in np.atleast_1d(scale)
+            )
+        return values.tobytes(), headers
+
+    if scale is not None:
+        meta["scale"] = scale.tolist()
+    if encoding == "base64":
+        meta["shape"] = list(values.shape)
+        return {"embeddings": base64.b64encode(values.tobytes()).decode(), **meta}
+    return {"embeddings": values.tolist(), **meta}
+
+
+def decode_embeddings(payload, headers=None) -> np.ndarray:
+    """
+    Client-side inverse of encode_embeddings.
+
+    Args:
+        payload: The parsed JSON response, or the response body bytes for
+                 "raw" responses.
+        headers: The response headers, required for "raw" responses.
+    """
+    if isinstance(payload, (bytes, bytearray)):
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        dtype = headers["x-embedding-dtype"]
+        dimension = int(headers["x-embedding-dimension"])
+        shape = tuple(int(n) for n in headers["x-embedding-shape"].split(","))
+        scale = headers.get("x-embedding-scale")
+        if scale is not None:
+            scale = np.array([float(s) for s in scale.split(",")], np.float32)
+        values = np.frombuffer(payload, dtype=_numpy_dtype(dtype)).reshape(shape)
+    else:
+        dtype = payload.get("dtype", "float32")
+        dimension = payload.get("dimension")
+        scale = payload.get("scale")
+        if isinstance(payload["embeddings"], str):
+            raw = base64.b64decode(payload["embeddings"])
+            values = np.frombuffer(raw, dtype=_numpy_dtype(dtype))
+            values = values.reshape(payload["shape"])
+        else:
+            values = np.asarray(payload["embeddings"], dtype=_numpy_dtype(dtype))
+
+    if dtype == "binary":
+        return np.unpackbits(values, axis=-1, count=dimension)
+    if dtype == "int8":
+        scale = np.asarray(scale, np.float32).reshape(values.shape[:-1] + (1,))
+        return values.astype(np.float32) * scale
+    return values.astype(np.float32)
+
+
+def _numpy_dtype(dtype: str) -> str:
+    return {"float32": "<f4", "float16": "<f2", "int8": "i1", "binary": "u1"}[dtype]
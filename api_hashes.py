@@ -0,0 +1,160 @@
+"""
+Perceptual hashes and near-duplicate lookup for /img/stats.
+
+Every analyzed image gets two 64-bit hashes of its color analysis thumbnail,
+returned as 16 hex digits:
+
+- ``dhash``: whether each of 8x8 grayscale pixels is brighter than its right
+  neighbour, in a 9x8 downscale
+- ``phash``: whether each of the 8x8 lowest frequency DCT coefficients of a
+  32x32 downscale is above their median
+
+Re-encodes, resizes and small edits of an image change few bits of either.
+Each worker remembers the hashes of the last HASH_INDEX_SIZE images it saw,
+packed in uint64 arrays, and reports those within HASH_MAX_DISTANCE bits of
+a new image (in both hashes) as its "near_duplicates", so that callers can
+reuse embeddings they already computed instead of calling /img/embed again.
+The index is not shared: with WORKERS_PER_DEVICE > 1, an image is only
+compared with those analyzed by the same worker process.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+from PIL import Image
+
+HASH_INDEX_SIZE = int(os.environ.get("HASH_INDEX_SIZE", "100000"))
+HASH_MAX_DISTANCE = int(os.environ.get("HASH_MAX_DISTANCE", "8"))
+HASH_MAX_MATCHES = int(os.environ.get("HASH_MAX_MATCHES", "10"))
+
+HASH_BITS = 64
+DCT_SIZE = 32
+DCT_LOW = 8
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Orthonormal DCT-II matrix: D @ x transforms the columns of x."""
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+    matrix[0] *= 1 / np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+_DCT = _dct_matrix(DCT_SIZE)[:DCT_LOW]
+
+
+def pack_bits(bits: np.ndarray) -> int:
+    """The 64 booleans of ``bits`` as an integer, first one most significant."""
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def dhash(image: Image.Image) -> int:
+    pixels = np.asarray(
+        image.convert("L").resize((9, 8), Image.Resampling.BOX), dtype=np.int16
+    )
+    return pack_bits(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image: Image.Image) -> int:
+    pixels = np.asarray(
+        image.convert("L").resize((DCT_SIZE, DCT_SIZE), Image.Resampling.BOX),
+        dtype=np.float64,
+    )
+    # Only the low frequencies of the 2D DCT are ever needed
+    low = _DCT @ pixels @ _DCT.T
+    return pack_bits(low > np.median(low))
+
+
+def perceptual_hashes(image: Image.Image) -> dict[str, str]:
+    """dhash and phash of ``image`` (a thumbnail is enough) as hex strings."""
+    return {"dhash": f"{dhash(image):016x}", "phash": f"{phash(image):016x}"}
+
+
+def parse_hash_options(request) -> dict:
+    """The near-duplicate options of a request, raising ValueError if invalid."""
+    id_ = request.get("id")
+    options = {
+        "id": None if id_ in (None, "") else str(id_),
+        "max_distance": HASH_MAX_DISTANCE,
+    }
+    if request.get("max_distance") not in (None, ""):
+        try:
+            options["max_distance"] = int(request["max_distance"])
+        except (TypeError, ValueError):
+            raise ValueError("'max_distance' must be an integer.")
+        if not 0 <= options["max_distance"] <= HASH_BITS:
+            raise ValueError(f"'max_distance' must be between 0 and {HASH_BITS}.")
+    return options
+
+
+def content_id(file_bytes: bytes) -> str:
+    """Default id of an image: the SHA-256 of its encoded bytes."""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+class HammingIndex:
+    """
+    The hashes of the last ``capacity`` images, by id, searched by brute force:
+    one XOR and popcount per stored phash, then the dhash of the few within
+    reach. Not thread-safe; every worker owns one.
+    """
+
+    def __init__(self, capacity: int = HASH_INDEX_SIZE):
+        self.capacity = capacity
+        # Ring buffers once full, one row per image
+        self.phashes = np.zeros(capacity, dtype=np.uint64)
+        self.dhashes = np.zeros(capacity, dtype=np.uint64)
+        self.ids: list[str | None] = [None] * capacity
+        self.slots: dict[str, int] = {}
+        self.next = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, id_: str, hashes: dict[str, str]):
+        """Store the hashes of ``id_``, replacing older ones of the same id."""
+        slot = self.slots.get(id_)
+        if slot is None:
+            slot = self.next
+            evicted = self.ids[slot]
+            if evicted is not None:
+                del self.slots[evicted]
+            self.next = (self.next + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+        self.phashes[slot] = int(hashes["phash"], 16)
+        self.dhashes[slot] = int(hashes["dhash"], 16)
+        self.ids[slot] = id_
+        self.slots[id_] = slot
+
+    def search(
+        self,
+        hashes: dict[str, str],
+        max_distance: int,
+        limit: int = HASH_MAX_MATCHES,
+        exclude: str | None = None,
+    ) -> list[dict]:
+        """
+        Up to ``limit`` {"id", "distance"} of the images within ``max_distance``
+        bits of ``hashes`` in both hashes, closest first, other than ``exclude``.
+        The distance is that of the hash that differs more.
+        """
+        if not self.count:
+            return []
+        phash = np.uint64(int(hashes["phash"], 16))
+        dhash = np.uint64(int(hashes["dhash"], 16))
+        candidates = np.flatnonzero(
+            np.bitwise_count(self.phashes[: self.count] ^ phash) <= max_distance
+        )
+        distances = np.maximum(
+            np.bitwise_count(self.phashes[candidates] ^ phash),
+            np.bitwise_count(self.dhashes[candidates] ^ dhash),
+        )
+        within = (distances <= max_distance) & (candidates != self.slots.get(exclude))
+        matches, distances = candidates[within], distances[within]
+        order = np.argsort(distances, kind="stable")[:limit]
+        return [
+            {"id": self.ids[slot], "distance": int(distance)}
+            for slot, distance in zip(matches[order], distances[order])
+        ]
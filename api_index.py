@@ -0,0 +1,404 @@
+"""
+In-process vector index behind /search.
+
+With INDEX_DIR set, /img/embed and /txt/embed store the embeddings of any
+request carrying "index_id" (a string, or one per text for a list input)
+in a collection (the "collection" field, "default" if absent). Each
+collection is a directory holding:
+
+- ``vectors.f32``: unit-length float32 rows, memory-mapped for search
+- ``ids.jsonl``: the id of every row, one JSON string per line
+- ``meta.json``: the vector dimension
+
+Rows are only ever appended, under a file lock, so any worker or API
+server process can add to a collection and every other process picks up
+new rows on its next search. Adding an id again replaces its vector.
+
+Collections of fewer than INDEX_IVF_THRESHOLD rows are searched exactly, by
+blocked matrix multiplication. Larger ones get an IVF index (spherical
+k-means lists, built in memory by each searching process on a background
+thread and rebuilt as the collection grows) that scans only the
+INDEX_IVF_NPROBE closest lists; rows added since the last build are always
+scanned exactly.
+"""
+
+import asyncio
+import fcntl
+import json
+import logging
+import math
+import os
+import re
+import threading
+
+import numpy as np
+from fastapi import HTTPException, Request, Response
+from litserve.server import RegularRequestHandler
+
+INDEX_DIR = os.environ.get("INDEX_DIR", "")
+INDEX_IVF_THRESHOLD = int(os.environ.get("INDEX_IVF_THRESHOLD", "50000"))
+INDEX_IVF_NPROBE = int(os.environ.get("INDEX_IVF_NPROBE", "16"))
+# Rebuild the IVF lists once this share of rows was added after the build
+INDEX_IVF_REBUILD = float(os.environ.get("INDEX_IVF_REBUILD", "0.2"))
+INDEX_MAX_K = 1000
+# Rows scored per matrix multiplication in exact search
+BLOCK_ROWS = 65536
+IVF_ITERATIONS = 10
+# k-means trains on this many sampled rows per list
+IVF_SAMPLES_PER_LIST = 32
+# Request fields read by index_embeddings
+INDEX_FIELDS = ("index_id", "collection")
+COLLECTION_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$")
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, np.float32)
+    norm = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norm == 0, 1.0, norm)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Column indices of the ``k`` highest scores of every row, best first."""
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+
+class IVFLists:
+    """Inverted lists over unit vectors, from spherical k-means."""
+
+    def __init__(self, vectors: np.ndarray, n_lists: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        count = len(vectors)
+        sample_size = min(count, n_lists * IVF_SAMPLES_PER_LIST)
+        sample = np.asarray(vectors[np.sort(rng.choice(count, sample_size, False))])
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)]
+        for _ in range(IVF_ITERATIONS):
+            labels = (sample @ centroids.T).argmax(axis=1)
+            order = np.argsort(labels, kind="stable")
+            used, starts = np.unique(labels[order], return_index=True)
+            # Empty lists keep their previous centroid
+            centroids[used] = normalize_rows(np.add.reduceat(sample[order], starts))
+        self.centroids = centroids
+        labels = np.concatenate(
+            [
+                (vectors[i : i + BLOCK_ROWS] @ centroids.T).argmax(axis=1)
+                for i in range(0, count, BLOCK_ROWS)
+            ]
+        )
+        self.rows = np.argsort(labels, kind="stable")
+        self.offsets = np.searchsorted(labels[self.rows], np.arange(n_lists + 1))
+        self.size = count
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """Rows in the ``nprobe`` lists closest to ``query``."""
+        scores = (self.centroids @ query)[None]
+        lists = top_k(scores, min(nprobe, len(self.centroids)))[0]
+        return np.concatenate(
+            [self.rows[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+        )
+
+
+class VectorIndex:
+    """One collection: append-only vectors and ids, searched by cosine similarity."""
+
+    def __init__(self, path: str, ivf_threshold: int = INDEX_IVF_THRESHOLD):
+        self.path = path
+        self.ivf_threshold = ivf_threshold
+        self.vectors_path = os.path.join(path, "vectors.f32")
+        self.ids_path = os.path.join(path, "ids.jsonl")
+        self.meta_path = os.path.join(path, "meta.json")
+        self.lock_path = os.path.join(path, "lock")
+        self.dim = None
+        self.ids: list[str] = []
+        self.rows: dict[str, int] = {}
+        self.alive = np.zeros(0, bool)
+        self.vectors = np.zeros((0, 0), np.float32)
+        self.ivf = None
+        self._building = False
+        self._ids_offset = 0
+        self._mutex = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _read_ids(self):
+        """Take in the ids appended since the last call."""
+        try:
+            with open(self.ids_path, "rb") as f:
+                f.seek(self._ids_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # A line without its newline is still being written
+        data = data[: data.rfind(b"\n") + 1]
+        if not data:
+            return
+        self._ids_offset += len(data)
+        start = len(self.ids)
+        new = [json.loads(line) for line in data.splitlines()]
+        self.ids.extend(new)
+        self.alive = np.concatenate([self.alive, np.ones(len(new), bool)])
+        for row, id_ in enumerate(new, start):
+            previous = self.rows.get(id_)
+            if previous is not None:
+                self.alive[previous] = False
+            self.rows[id_] = row
+        if self.dim is None:
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)["dim"]
+
+    def refresh(self):
+        """Map the rows other processes added since the last call."""
+        with self._mutex:
+            count = len(self.ids)
+            self._read_ids()
+            if len(self.ids) != count:
+                self.vectors = np.memmap(
+                    self.vectors_path,
+                    np.float32,
+                    "r",
+                    shape=(len(self.ids), self.dim),
+                )
+            indexed = self.ivf.size if self.ivf is not None else 0
+            if (
+                not self._building
+                and len(self.ids) >= self.ivf_threshold
+                and len(self.ids) - indexed > INDEX_IVF_REBUILD * indexed
+            ):
+                self._building = True
+                threading.Thread(
+                    target=self._build_in_background, name="ivf-build", daemon=True
+                ).start()
+
+    def build_ivf(self):
+        """
+        (Re)build the IVF lists over the rows mapped so far. Searches keep
+        using the previous lists meanwhile, scanning newer rows exactly.
+        """
+        vectors = self.vectors
+        n_lists = max(1, int(2 * math.sqrt(len(vectors))))
+        logger.info(f"Building {n_lists} IVF lists over {len(vectors)} rows.")
+        ivf = IVFLists(vectors, n_lists)
+        with self._mutex:
+            self.ivf = ivf
+
+    def _build_in_background(self):
+        try:
+            self.build_ivf()
+        except Exception:
+            logger.exception(f"Failed to build the IVF lists of {self.path}.")
+        finally:
+            self._building = False
+
+    def add(self, ids: list[str], vectors: np.ndarray):
+        """Append (or replace) the vectors of ``ids``."""
+        vectors = normalize_rows(np.atleast_2d(vectors))
+        if len(ids) != len(vectors):
+            raise ValueError(f"Got {len(ids)} ids for {len(vectors)} vectors.")
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with self._mutex:
+                self._read_ids()
+                if self.dim is None:
+                    # The first rows of the collection set its dimension
+                    with open(self.meta_path, "w") as f:
+                        json.dump({"dim": vectors.shape[1]}, f)
+                    self.dim = vectors.shape[1]
+                if vectors.shape[1] != self.dim:
+                    raise ValueError(
+                        f"Collection {os.path.basename(self.path)!r} holds "
+                        f"{self.dim}-dimensional vectors, got {vectors.shape[1]}."
+                    )
+                # Drop vectors of a writer that died before recording their ids
+                with open(self.vectors_path, "ab") as f:
+                    f.truncate(len(self.ids) * self.dim * 4)
+                    f.write(vectors.tobytes())
+                # The ids commit the rows, so they go last
+                with open(self.ids_path, "ab") as f:
+                    f.write(b"".join(json.dumps(i).encode() + b"\n" for i in ids))
+
+    def get(self, id_: str) -> np.ndarray | None:
+        self.refresh()
+        row = self.rows.get(id_)
+        return None if row is None else np.array(self.vectors[row])
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        exact: bool = False,
+        nprobe: int = INDEX_IVF_NPROBE,
+    ) -> list[list[tuple[str, float]]]:
+        """The ``k`` nearest ids (with cosine similarity) of every query."""
+        self.refresh()
+        queries = normalize_rows(np.atleast_2d(queries))
+        vectors, alive, ivf = self.vectors, self.alive, self.ivf
+        if not len(self.ids):
+            return [[] for _ in queries]
+        if queries.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dimensional queries.")
+        if ivf is None or exact:
+            rows = self._search_exact(vectors, alive, queries, k)
+        else:
+            rows = [
+                self._search_ivf(vectors, alive, ivf, query, k, nprobe)
+                for query in queries
+            ]
+        return [
+            [(self.ids[row], float(score)) for row, score in result] for result in rows
+        ]
+
+    @staticmethod
+    def _search_exact(vectors, alive, queries, k):
+        candidates, scores = [], []
+        for start in range(0, len(alive), BLOCK_ROWS):
+            block = vectors[start : start + BLOCK_ROWS] @ queries.T
+            block[~alive[start : start + BLOCK_ROWS]] = -np.inf
+            best = top_k(block.T, k)
+            candidates.append(best + start)
+            scores.append(np.take_along_axis(block.T, best, axis=1))
+        candidates = np.concatenate(candidates, axis=1)
+        scores = np.concatenate(scores, axis=1)
+        best = top_k(scores, k)
+        return [
+            [(row, score) for row, score in zip(r, s) if score > -np.inf]
+            for r, s in zip(
+                np.take_along_axis(candidates, best, axis=1),
+                np.take_along_axis(scores, best, axis=1),
+            )
+        ]
+
+    @staticmethod
+    def _search_ivf(vectors, alive, ivf, query, k, nprobe):
+        rows = np.concatenate(
+            [ivf.candidates(query, nprobe), np.arange(ivf.size, len(alive))]
+        )
+        rows = np.sort(rows[alive[rows]])
+        scores = (vectors[rows] @ query)[None]
+        best = top_k(scores, k)[0]
+        return list(zip(rows[best], scores[0, best]))
+
+
+_indexes: dict[str, VectorIndex] = {}
+
+
+def get_index(collection: str | None) -> VectorIndex:
+    """The VectorIndex of ``collection``, raising ValueError if unavailable."""
+    if not INDEX_DIR:
+        raise ValueError("The vector index is disabled, set INDEX_DIR to enable it.")
+    collection = collection or "default"
+    if not COLLECTION_NAME.match(collection):
+        raise ValueError(f"Invalid collection name {collection!r}.")
+    if collection not in _indexes:
+        _indexes[collection] = VectorIndex(os.path.join(INDEX_DIR, collection))
+    return _indexes[collection]
+
+
+def parse_index_ids(request, count: int | None) -> list[str] | None:
+    """
+    Read the "index_id" field: one id, or for list inputs (``count`` texts)
+    a list of as many ids. None if the request does not index anything.
+    """
+    ids = request.get("index_id")
+    if ids is None:
+        return None
+    if isinstance(ids, str):
+        ids = [ids]
+    if (
+        not isinstance(ids, list)
+        or not all(isinstance(i, str) and i for i in ids)
+        or len(ids) != (count or 1)
+    ):
+        raise ValueError(
+            f"'index_id' must be {'one non-empty id' if not count else count} "
+            "string(s), one per input."
+        )
+    return ids
+
+
+def index_embeddings(request, embeddings: np.ndarray):
+    """
+    Store the full-size ``embeddings`` of one request (a vector, or a matrix
+    for a list input) if it asks for it. Raises ValueError on invalid fields.
+    """
+    count = None if embeddings.ndim == 1 else len(embeddings)
+    ids = parse_index_ids(request, count)
+    if ids is not None:
+        get_index(request.get("collection")).add(ids, embeddings)
+
+
+def register_search_route(server, text_api=None, image_api=None, path="/search"):
+    """
+    Add a POST ``path`` route that returns the "k" nearest ids of a query:
+    texts ("input", a string or a list), an image ("content") or an id
+    already in the collection ("id"). Queries are embedded by ``text_api``
+    and ``image_api``, like requests to their own routes.
+    """
+    handlers = {
+        name: RegularRequestHandler(lit_api, server)
+        for name, lit_api in (("input", text_api), ("content", image_api))
+        if lit_api is not None
+    }
+
+    async def query_embeddings(body, index) -> np.ndarray:
+        if "id" in body:
+            vector = await asyncio.to_thread(index.get, body["id"])
+            if vector is None:
+                raise HTTPException(404, f"Unknown id {body['id']!r}.")
+            return vector
+        field = next((f for f in handlers if f in body), None)
+        if field is None:
+            raise HTTPException(400, f"Expected one of {['id', *handlers]}.")
+        payload = {
+            **{k: v for k, v in body.items() if k in (field, "prefix")},
+            "dimension": index.dim,
+            "normalize": True,
+        }
+        response = await handlers[field].handle_request(payload, dict)
+        if isinstance(response, Response):
+            # A 400 for this query from encode_response
+            raise HTTPException(
+                response.status_code, json.loads(response.body)["detail"]
+            )
+        return np.asarray(response["embeddings"], np.float32)
+
+    async def search(request: Request):
+        content_type = request.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            body = dict(await request.form())
+        else:
+            body = await request.json()
+        try:
+            index = get_index(body.get("collection"))
+            k = int(body.get("k", 10))
+            if not 1 <= k <= INDEX_MAX_K:
+                raise ValueError(f"'k' must be between 1 and {INDEX_MAX_K}.")
+            nprobe = int(body.get("nprobe", INDEX_IVF_NPROBE))
+            if nprobe < 1:
+                raise ValueError("'nprobe' must be at least 1.")
+            exact = str(body.get("exact", False)).lower() in ("true", "1")
+        except (TypeError, ValueError) as e:
+            raise HTTPException(400, str(e)) from None
+        await asyncio.to_thread(index.refresh)
+        if not len(index):
+            return {"results": []}
+        queries = await query_embeddings(body, index)
+        exclude = body.get("id")
+        results = await asyncio.to_thread(
+            index.search, queries, k + (exclude is not None), exact, nprobe
+        )
+        results = [
+            [{"id": i, "score": s} for i, s in result if i != exclude][:k]
+            for result in results
+        ]
+        single = queries.ndim == 1
+        return {"results": results[0] if single else results}
+
+    server.app.add_api_route(path, search, methods=["POST"])
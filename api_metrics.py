@@ -0,0 +1,326 @@
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from fastapi import Response
+from litserve.loops import BatchedLoop
+
+# One directory per server by default, named after the process that first
+# imports this module; its workers and API servers inherit it from the env
+METRICS_DIR = os.environ.get("METRICS_DIR") or os.path.join(
+    tempfile.gettempdir(), f"nomic-mono-api-metrics-{os.getpid()}"
+)
+os.environ["METRICS_DIR"] = METRICS_DIR
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "1.0"))
+METRICS_PREFIX = "nomic_"
+
+# Histogram upper bounds; +Inf is implicit
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)  # fmt: skip
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+RATIO_BUCKETS = (0.125, 0.25, 0.5, 0.75, 1.0)
+
+logger = logging.getLogger(__name__)
+
+# Counters live in the worker process that increments them. Each process
+# dumps a snapshot to METRICS_DIR from a background thread, at most every
+# METRICS_FLUSH_INTERVAL, so the API server process (which never runs
+# predict) can aggregate them across workers.
+_counters: dict[str, float] = defaultdict(float)
+# name -> {"buckets": bounds, "counts": per-bucket (not cumulative), "sum", "count"}
+_histograms: dict[str, dict] = {}
+# Last value wins; label gauges per worker if several processes set them
+_gauges: dict[str, float] = {}
+_dirty = False
+# Process the flush thread runs in; forked children have to start their own
+_flusher_pid = None
+
+
+def metric(name: str, **labels) -> str:
+    """Metric name with Prometheus labels, e.g. stage_seconds{stage="decode"}."""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def inc(name: str, value: float = 1.0):
+    """Increment a process-local counter."""
+    _counters[name] += value
+    _changed()
+
+
+def observe(name: str, value: float, buckets=LATENCY_BUCKETS):
+    """Record ``value`` in a process-local histogram."""
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms[name] = {
+            "buckets": list(buckets),
+            "counts": [0] * (len(buckets) + 1),
+            "sum": 0.0,
+            "count": 0,
+        }
+    histogram["counts"][bisect.bisect_left(histogram["buckets"], value)] += 1
+    histogram["sum"] += value
+    histogram["count"] += 1
+    _changed()
+
+
+def set_gauge(name: str, value: float):
+    """Set a process-local gauge."""
+    _gauges[name] = value
+    _changed()
+
+
+@contextmanager
+def timer(name: str):
+    """Observe the wall time of the block in seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def _changed():
+    """Mark the snapshot stale, starting this process's flush thread if needed."""
+    global _dirty, _flusher_pid
+    _dirty = True
+    if _flusher_pid != os.getpid():
+        _flusher_pid = os.getpid()
+        threading.Thread(
+            target=_flush_periodically, name="metrics-flush", daemon=True
+        ).start()
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        if _dirty:
+            flush()
+
+
+def flush():
+    """Write this process's counters to METRICS_DIR/<pid>.json atomically."""
+    global _dirty
+    _dirty = False
+    # Shallow copies, as other threads may add metrics meanwhile
+    snapshot = {
+        "counters": dict(_counters),
+        "histograms": dict(_histograms),
+        "gauges": dict(_gauges),
+    }
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Failed to flush metrics to {METRICS_DIR}: {e}")
+
+
+def _snapshots():
+    if not os.path.isdir(METRICS_DIR):
+        return
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename)) as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            # Partially written or removed between listdir and open
+            continue
+
+
+def collect() -> dict[str, float]:
+    """Sum the counters flushed by every process."""
+    totals: dict[str, float] = defaultdict(float)
+    for snapshot in _snapshots():
+        for name, value in snapshot.get("counters", {}).items():
+            totals[name] += value
+    return totals
+
+
+def collect_gauges() -> dict[str, float]:
+    """The gauges set by every process."""
+    gauges = {}
+    for snapshot in _snapshots():
+        gauges.update(snapshot.get("gauges", {}))
+    return gauges
+
+
+def collect_histograms() -> dict[str, dict]:
+    """Merge the histograms flushed by every process."""
+    merged: dict[str, dict] = {}
+    for snapshot in _snapshots():
+        for name, histogram in snapshot.get("histograms", {}).items():
+            total = merged.get(name)
+            if total is None or total["buckets"] != histogram["buckets"]:
+                merged.setdefault(name, histogram)
+                continue
+            total["counts"] = [
+                a + b for a, b in zip(total["counts"], histogram["counts"])
+            ]
+            total["sum"] += histogram["sum"]
+            total["count"] += histogram["count"]
+    return merged
+
+
+def reset():
+    """Remove snapshots left over from a previous run. Call before starting."""
+    if not os.path.isdir(METRICS_DIR):
+        return
+    for filename in os.listdir(METRICS_DIR):
+        try:
+            os.remove(os.path.join(METRICS_DIR, filename))
+        except OSError:
+            pass
+
+
+def _split(key: str) -> tuple[str, str]:
+    """'name{a="b"}' -> ('name', 'a="b"')"""
+    name, _, labels = key.partition("{")
+    return name, labels.rstrip("}")
+
+
+def _with_labels(name: str, labels: str, extra: str = "") -> str:
+    labels = ",".join(part for part in (labels, extra) if part)
+    return f"{name}{{{labels}}}" if labels else name
+
+
+def render_prometheus(gauges: dict[str, float] | None = None) -> str:
+    """Counters, histograms and ``gauges`` in the Prometheus text format."""
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for key, value in sorted(collect().items()):
+        name, labels = _split(key)
+        name = f"{METRICS_PREFIX}{name}_total"
+        declare(name, "counter")
+        lines.append(f"{_with_labels(name, labels)} {value:g}")
+    for key, histogram in sorted(collect_histograms().items()):
+        name, labels = _split(key)
+        name = METRICS_PREFIX + name
+        declare(name, "histogram")
+        cumulative = 0
+        bounds = [*histogram["buckets"], "+Inf"]
+        for bound, count in zip(bounds, histogram["counts"]):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f"{_with_labels(name + '_bucket', labels, le)} {cumulative}")
+        lines.append(f"{_with_labels(name + '_sum', labels)} {histogram['sum']:g}")
+        lines.append(f"{_with_labels(name + '_count', labels)} {histogram['count']}")
+    for key, value in sorted({**collect_gauges(), **(gauges or {})}.items()):
+        name, labels = _split(key)
+        name = METRICS_PREFIX + name
+        declare(name, "gauge")
+        lines.append(f"{_with_labels(name, labels)} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+def api_label(lit_api) -> str:
+    return lit_api.api_path.strip("/")
+
+
+def stage(lit_api, name: str):
+    """Timer for one hot-path stage of ``lit_api`` (fetch, decode, forward...)."""
+    return timer(metric("stage_seconds", api=api_label(lit_api), stage=name))
+
+
+class _TimestampedQueue:
+    """Request queue wrapper remembering the enqueue time of what it returns."""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.timestamps = []
+
+    def _record(self, item):
+        if isinstance(item, tuple):
+            # (response_queue_id, uid, enqueue time.monotonic(), payload)
+            self.timestamps.append(item[2])
+        return item
+
+    def get(self, *args, **kwargs):
+        return self._record(self.queue.get(*args, **kwargs))
+
+    def get_nowait(self):
+        return self._record(self.queue.get_nowait())
+
+
+class InstrumentedBatchedLoop(BatchedLoop):
+    """
+    litserve's batched loop, also recording how long each request waited in
+    the queue, how long the worker waited for a batch to fill and how full
+    the batches it runs are.
+    """
+
+    def get_batch_requests(self, lit_api, request_queue):
+        started = time.monotonic()
+        queue = _TimestampedQueue(request_queue)
+        batches, timed_out_uids = super().get_batch_requests(lit_api, queue)
+        if batches:
+            self.record_batch(lit_api, started, queue.timestamps, len(batches))
+        return batches, timed_out_uids
+
+    @staticmethod
+    def record_batch(lit_api, started: float, timestamps: list[float], size: int):
+        """
+        Args:
+            started: When the worker started collecting the batch.
+            timestamps: Enqueue times of the requests taken from the queue.
+            size: Requests in the batch (timed out ones are not).
+        """
+        now = time.monotonic()
+        api = api_label(lit_api)
+        for timestamp in timestamps:
+            observe(metric("queue_wait_seconds", api=api), now - timestamp)
+        # From the first request being available to the batch closing
+        first = max(started, min(timestamps, default=started))
+        observe(metric("batch_fill_seconds", api=api), now - first)
+        observe(metric("batch_size", api=api), size, SIZE_BUCKETS)
+        observe(
+            metric("batch_occupancy", api=api),
+            size / lit_api.max_batch_size,
+            RATIO_BUCKETS,
+        )
+
+
+def register_metrics_route(server, path: str = "/metrics"):
+    """
+    Add a Prometheus ``path`` route to ``server`` and switch its batched APIs
+    to InstrumentedBatchedLoop. Call before ``server.run``.
+    """
+    for lit_api in server.litapi_connector:
+        if type(lit_api.loop) is BatchedLoop:
+            lit_api.loop = InstrumentedBatchedLoop()
+
+    def metrics() -> Response:
+        gauges = {}
+        for lit_api in server.litapi_connector:
+            queue = server.litapi_request_queues.get(lit_api.api_path)
+            try:
+                depth = queue.qsize()
+            except (AttributeError, NotImplementedError):
+                continue
+            gauges[metric("queue_depth", api=api_label(lit_api))] = depth
+        if server.active_requests is not None:
+            gauges["active_requests"] = server.active_requests
+        return Response(
+            render_prometheus(gauges), media_type="text/plain; version=0.0.4"
+        )
+
+    server.app.add_api_route(path, metrics, methods=["GET"])
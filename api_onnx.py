@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+
+import numpy as np
+import onnxruntime as ort
+import torch
+from onnxruntime.quantization import QuantType, quantize_dynamic
+
+ONNX_CACHE_DIR = os.environ.get(
+    "ONNX_CACHE_DIR", os.path.expanduser("~/.cache/nomic-mono-api/onnx")
+)
+ONNX_QUANTIZE = os.environ.get("ONNX_QUANTIZE", "0") == "1"
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", "0"))
+ONNX_OPSET = 17
+
+logger = logging.getLogger(__name__)
+
+
+class VisionEmbedding(torch.nn.Module):
+    """The vision model up to the CLS embedding, as exported to ONNX."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).last_hidden_state[:, 0]
+
+
+class SentenceEmbedding(torch.nn.Module):
+    """A SentenceTransformer (transformer + pooling) as exported to ONNX."""
+
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        features = dict(zip(self.input_names, inputs))
+        return self.model(features)["sentence_embedding"]
+
+
+def artifact_path(
+    model_name: str, revision: str, quantize: bool = ONNX_QUANTIZE
+) -> str:
+    filename = "model_int8.onnx" if quantize else "model.onnx"
+    return os.path.join(
+        ONNX_CACHE_DIR, model_name.replace("/", "__"), revision, filename
+    )
+
+
+def export(module: torch.nn.Module, sample: dict[str, torch.Tensor], path: str):
+    """
+    Export ``module`` called with ``sample`` (name -> tensor, batch first)
+    to ``path``, keeping the batch and sequence dimensions dynamic.
+    """
+    dynamic_axes = {
+        name: {0: "batch"} if tensor.dim() != 2 else {0: "batch", 1: "sequence"}
+        for name, tensor in sample.items()
+    }
+    dynamic_axes["embedding"] = {0: "batch"}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    module.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            tuple(sample.values()),
+            tmp_path,
+            input_names=list(sample),
+            output_names=["embedding"],
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET,
+            dynamo=False,
+        )
+    os.replace(tmp_path, path)
+
+
+def quantize(fp32_path: str, int8_path: str):
+    """Dynamic INT8 quantization: int8 weights, activations quantized on the fly."""
+    tmp_path = f"{int8_path}.{os.getpid()}.tmp"
+    quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+    os.replace(tmp_path, int8_path)
+
+
+def load_or_export(
+    model_name: str, revision: str, build, quantize_model: bool = ONNX_QUANTIZE
+):
+    """
+    Return an OnnxEncoder for ``model_name``, exporting (and quantizing) it
+    into ONNX_CACHE_DIR first if it is not cached yet.
+
+    Args:
+        model_name: Hub id of the model, used for the cache directory.
+        revision: Revision of its weights (see api_startup.model_revision),
+                  so that a model update never loads a stale export.
+        build: Callable returning (module, sample inputs) to export; only
+               called on a cache miss, so PyTorch weights load only once.
+        quantize_model: Use the dynamically quantized INT8 model.
+    """
+    fp32_path = artifact_path(model_name, revision, quantize=False)
+    path = artifact_path(model_name, revision, quantize=quantize_model)
+    if not os.path.exists(fp32_path):
+        logger.info(f"Exporting {model_name} to {fp32_path}.")
+        module, sample = build()
+        export(module, sample, fp32_path)
+    if quantize_model and not os.path.exists(path):
+        logger.info(f"Quantizing {model_name} to {path}.")
+        quantize(fp32_path, path)
+    return OnnxEncoder(path)
+
+
+class SentenceTokenizer:
+    """
+    The tokenization of a sentence-transformers model without its weights,
+    for running the model with OnnxEncoder. Reads the same settings as
+    SentenceTransformer and tokenizes lists of strings the same way.
+    """
+
+    device = torch.device("cpu")
+
+    def __init__(self, model_path: str):
+        from transformers import AutoConfig, AutoTokenizer
+        from transformers.utils import cached_file
+
+        # model_path is a local directory or a hub id, like for SentenceTransformer
+        settings_path = cached_file(
+            model_path,
+            "sentence_bert_config.json",
+            _raise_exceptions_for_missing_entries=False,
+        )
+        settings = {}
+        if settings_path is not None:
+            with open(settings_path) as f:
+                settings = json.load(f)
+        self.do_lower_case = settings.get("do_lower_case", False)
+        self.max_seq_length = settings.get("max_seq_length")
+        tokenizer_args = {}
+        if self.max_seq_length is not None:
+            tokenizer_args["model_max_length"] = self.max_seq_length
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            model_path, trust_remote_code=True, **tokenizer_args
+        )
+        if self.max_seq_length is None:
+            config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+            self.max_seq_length = min(
+                config.max_position_embeddings, self.tokenizer.model_max_length
+            )
+
+    def tokenize(self, texts: list[str]) -> dict[str, torch.Tensor]:
+        texts = [str(text).strip() for text in texts]
+        if self.do_lower_case:
+            texts = [text.lower() for text in texts]
+        return self.tokenizer(
+            texts,
+            padding=True,
+            truncation="longest_first",
+            return_tensors="pt",
+            max_length=self.max_seq_length,
+        )
+
+
+class OnnxEncoder:
+    """Runs an exported embedding model with ONNX Runtime on CPU."""
+
+    def __init__(self, path: str, threads: int = ONNX_THREADS):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        logger.info(f"Loaded ONNX model {path}.")
+
+    def __call__(self, **inputs) -> np.ndarray:
+        feed = {}
+        for name in self.input_names:
+            value = inputs[name]
+            if isinstance(value, torch.Tensor):
+                value = value.cpu().numpy()
+            feed[name] = value
+        return self.session.run(None, feed)[0]
@@ -0,0 +1,222 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+import torch
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+class BatchImagePreprocessor:
+    """
+    Batched replacement for a CLIP-style slow image processor.
+
+    The slow processor converts every image to float arrays and rescales,
+    normalizes and transposes them one at a time. Here each image is only
+    resized and cropped with PIL (same resampling and crop offsets) into a
+    single uint8 batch, and rescale + normalize run once for the whole batch
+    as one fused tensor operation on the target device.
+    """
+
+    def __init__(
+        self,
+        shortest_edge: int,
+        crop_size: tuple[int, int],
+        mean,
+        std,
+        rescale_factor: float = 1 / 255,
+        resample=Image.Resampling.BICUBIC,
+    ):
+        self.shortest_edge = shortest_edge
+        self.crop_height, self.crop_width = crop_size
+        self.resample = resample
+        # (x * rescale - mean) / std == x * scale + shift
+        std = np.asarray(std, dtype=np.float32)
+        self.scale = torch.from_numpy(rescale_factor / std).view(1, 3, 1, 1)
+        self.shift = torch.from_numpy(-np.asarray(mean, dtype=np.float32) / std).view(
+            1, 3, 1, 1
+        )
+
+    @classmethod
+    def from_processor(cls, processor) -> "BatchImagePreprocessor":
+        """
+        Build from a transformers CLIP-style image processor, raising ValueError
+        if it uses a configuration this engine does not reproduce.
+        """
+        size = processor.size
+        if not isinstance(size, dict) or "shortest_edge" not in size:
+            raise ValueError(f"Unsupported resize configuration {size!r}.")
+        if not (
+            processor.do_resize
+            and processor.do_center_crop
+            and processor.do_rescale
+            and processor.do_normalize
+        ):
+            raise ValueError("Processor must resize, crop, rescale and normalize.")
+        crop = processor.crop_size
+        return cls(
+            shortest_edge=size["shortest_edge"],
+            crop_size=(crop["height"], crop["width"]),
+            mean=processor.image_mean,
+            std=processor.image_std,
+            rescale_factor=processor.rescale_factor,
+            resample=Image.Resampling(processor.resample),
+        )
+
+    def resize_and_crop(self, image: Image.Image) -> np.ndarray:
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        width, height = image.size
+        # Same rounding as transformers' get_resize_output_image_size
+        short, long = (width, height) if width <= height else (height, width)
+        new_short, new_long = self.shortest_edge, int(self.shortest_edge * long / short)
+        new_size = (new_short, new_long) if width <= height else (new_long, new_short)
+        image = image.resize(new_size, resample=self.resample)
+
+        left = (new_size[0] - self.crop_width) // 2
+        top = (new_size[1] - self.crop_height) // 2
+        if left < 0 or top < 0:
+            raise ValueError(f"Resized image {new_size} is smaller than the crop.")
+        image = image.crop((left, top, left + self.crop_width, top + self.crop_height))
+        return np.asarray(image)
+
+    def __call__(self, images, device="cpu") -> dict[str, torch.Tensor]:
+        if isinstance(images, Image.Image):
+            images = [images]
+        batch = np.empty((len(images), self.crop_height, self.crop_width, 3), np.uint8)
+        for i, image in enumerate(images):
+            batch[i] = self.resize_and_crop(image)
+        return self.normalize(batch, device)
+
+    def normalize(
+        self, batch: np.ndarray, device="cpu", out: torch.Tensor | None = None
+    ) -> dict[str, torch.Tensor]:
+        """
+        Model inputs for a uint8 NHWC batch of resized and cropped images,
+        written to ``out`` (a float32 NCHW tensor on ``device``) if given.
+        """
+        pixels = torch.from_numpy(batch).to(device, non_blocking=True)
+        if out is None:
+            out = torch.empty(
+                (len(batch), 3, self.crop_height, self.crop_width), device=device
+            )
+        out.copy_(pixels.permute(0, 3, 1, 2))
+        out.mul_(self.scale.to(device)).add_(self.shift.to(device))
+        return {"pixel_values": out}
+
+
+class PreprocessPipeline:
+    """
+    Runs batches through a model in micro-batches, resizing and cropping the
+    images of micro-batch k + 1 on a thread pool while micro-batch k is in
+    the model. PIL releases the GIL while it decodes and resamples and torch
+    while it computes, so both stages make progress at the same time.
+
+    Pixels go to two preallocated uint8 buffers (pinned for CUDA), one being
+    filled while the other is normalized, and from there to one reusable
+    float32 input tensor: a batch allocates no new input memory.
+
+    Images may also be given as encoded bytes, which ``opener`` decodes. The
+    thread that crops such an image decodes it, and it is freed right after.
+    An image that cannot be decoded only fails itself: its output row is NaN.
+    """
+
+    def __init__(
+        self,
+        preprocessor: BatchImagePreprocessor,
+        micro_batch: int,
+        threads: int,
+        device="cpu",
+        opener=None,
+    ):
+        self.preprocessor = preprocessor
+        self.micro_batch = micro_batch
+        self.device = device
+        self.opener = opener
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="preprocess")
+        height, width = preprocessor.crop_height, preprocessor.crop_width
+        pin = str(device).startswith("cuda")
+        self.buffers = [
+            torch.empty(
+                (micro_batch, height, width, 3), dtype=torch.uint8, pin_memory=pin
+            ).numpy()
+            for _ in range(2)
+        ]
+        self.inputs = torch.empty((micro_batch, 3, height, width), device=device)
+
+    def _fill(self, buffer: np.ndarray, images) -> list:
+        """
+        Start resizing and cropping ``images`` into ``buffer``, one task each.
+        A task returns its start and end time and whether its image decoded.
+        """
+
+        def task(i, image):
+            start = time.perf_counter()
+            try:
+                if isinstance(image, bytes):
+                    image = self.opener(image)
+                    if image is None:
+                        raise ValueError("Not an image.")
+                buffer[i] = self.preprocessor.resize_and_crop(image)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to preprocess image: {e}")
+                buffer[i] = 0
+                return start, time.perf_counter(), False
+            return start, time.perf_counter(), True
+
+        return [self.pool.submit(task, i, image) for i, image in enumerate(images)]
+
+    def run(self, images, forward) -> tuple[np.ndarray, dict[str, float]]:
+        """
+        The concatenated outputs of ``forward(inputs)`` over ``images``, and
+        the seconds spent preprocessing and in ``forward``, the wall time and
+        the overlap: the share of the shorter stage hidden behind the other.
+        Rows of images that failed to decode or preprocess are NaN.
+        """
+        chunks = [
+            images[i : i + self.micro_batch]
+            for i in range(0, len(images), self.micro_batch)
+        ]
+        started = time.perf_counter()
+        preprocess = forward_seconds = 0.0
+        outputs, failed = [], []
+        pending = self._fill(self.buffers[0], chunks[0])
+        try:
+            for k, chunk in enumerate(chunks):
+                spans = [future.result() for future in pending]
+                preprocess += max(end for _, end, _ in spans) - min(
+                    start for start, _, _ in spans
+                )
+                failed += [
+                    k * self.micro_batch + i
+                    for i, (_, _, ok) in enumerate(spans)
+                    if not ok
+                ]
+                pending = []
+                if k + 1 < len(chunks):
+                    pending = self._fill(self.buffers[(k + 1) % 2], chunks[k + 1])
+                inputs = self.preprocessor.normalize(
+                    self.buffers[k % 2][: len(chunk)],
+                    self.device,
+                    out=self.inputs[: len(chunk)],
+                )
+                start = time.perf_counter()
+                outputs.append(forward(inputs))
+                forward_seconds += time.perf_counter() - start
+        finally:
+            # Never leave tasks writing to a buffer the next batch will use
+            wait(pending)
+        wall = time.perf_counter() - started
+        shorter = min(preprocess, forward_seconds)
+        hidden = preprocess + forward_seconds - wall
+        timings = {
+            "preprocess": preprocess,
+            "forward": forward_seconds,
+            "wall": wall,
+            "overlap": min(max(hidden / shorter, 0.0), 1.0) if shorter > 0 else 0.0,
+        }
+        outputs = np.concatenate(outputs)
+        outputs[failed] = np.nan
+        return outputs, timings
@@ -0,0 +1,224 @@
+"""
+Priority lanes and load shedding for the batched embedding endpoints.
+
+Requests may set ``priority``: "interactive" (the default) or "bulk" (the
+default of the /bulk routes). Each endpoint gets:
+
+- a bounded queue: at most ``max_queue`` requests may wait for a batch, of
+  which at most ``bulk_queue`` bulk ones. Beyond that, requests are refused
+  at once with a 429 and a Retry-After header instead of queueing for ever
+  longer. The count is shared by all API server processes and decremented
+  when a worker takes the request from the queue.
+- priority lanes: the adaptive batching loop (see api_batching) looks ahead
+  in the queue and fills every batch with interactive requests first. While
+  both lanes have requests waiting, bulk ones still get ``bulk_share`` of
+  the batch slots, so a steady stream of queries slows a backfill down but
+  never stops it. With any other loop (ADAPTIVE_BATCHING=0), requests are
+  batched first come, first served whatever their priority.
+
+Looking ahead, every worker holds up to LANE_LOOKAHEAD * max_batch_size
+requests it took from the queue, which no longer count against
+``max_queue``: up to that many more per worker may wait for a batch.
+"""
+
+import inspect
+import logging
+import multiprocessing as mp
+import os
+from collections import deque
+
+from fastapi import HTTPException
+
+import api_metrics
+from api_metrics import api_label, metric
+
+# Seconds clients are asked to wait after a 429
+QUEUE_RETRY_AFTER = int(os.environ.get("QUEUE_RETRY_AFTER", "1"))
+
+PRIORITIES = ("interactive", "bulk")
+# Batches a worker may take from the shared queue ahead to sort into lanes
+LANE_LOOKAHEAD = 4
+
+logger = logging.getLogger(__name__)
+
+
+def request_priority(payload) -> str:
+    """The lane of a request payload, raising ValueError for unknown ones."""
+    priority = payload.get("priority") or "interactive"
+    if priority not in PRIORITIES:
+        raise ValueError(
+            f"Unsupported priority {priority!r}, expected one of {PRIORITIES}."
+        )
+    return priority
+
+
+class QueueBound:
+    """Per-lane counts of the requests of one endpoint waiting for a batch."""
+
+    def __init__(self, api: str, max_queue: int, bulk_queue: int):
+        self.api = api
+        self.max_queue = max_queue
+        self.bulk_queue = bulk_queue
+        # Created before the API servers fork and the workers spawn; a spawn
+        # context lock can be handed to both
+        self.counts = mp.get_context("spawn").Array("i", len(PRIORITIES))
+
+    def admit(self, priority: str):
+        """Count a request in, or raise a 429 if its lane is full."""
+        lane = PRIORITIES.index(priority)
+        with self.counts.get_lock():
+            queued = sum(self.counts)
+            full = queued >= self.max_queue or (
+                priority == "bulk" and self.counts[lane] >= self.bulk_queue
+            )
+            if not full:
+                self.counts[lane] += 1
+        if full:
+            api_metrics.inc(metric("requests_shed", api=self.api, priority=priority))
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many {priority} requests queued, retry later.",
+                headers={"Retry-After": str(QUEUE_RETRY_AFTER)},
+            )
+
+    def release(self, priority: str):
+        """Count a request out once a worker has taken it from the queue."""
+        lane = PRIORITIES.index(priority)
+        with self.counts.get_lock():
+            self.counts[lane] = max(self.counts[lane] - 1, 0)
+
+
+class _AdmittingQueue:
+    """Request queue wrapper that admits every request through a QueueBound."""
+
+    def __init__(self, queue, bound: QueueBound):
+        self.queue = queue
+        self.bound = bound
+
+    def put(self, item, *args, **kwargs):
+        # (response_queue_id, uid, enqueue time.monotonic(), payload)
+        try:
+            priority = request_priority(item[3])
+        except ValueError as e:
+            raise HTTPException(400, str(e)) from None
+        self.bound.admit(priority)
+        try:
+            return self.queue.put(item, *args, **kwargs)
+        except BaseException:
+            self.bound.release(priority)
+            raise
+
+    # The workers are handed the same queue and only read from it
+    def get(self, *args, **kwargs):
+        return self._taken(self.queue.get(*args, **kwargs))
+
+    def get_nowait(self):
+        return self._taken(self.queue.get_nowait())
+
+    def _taken(self, item):
+        if isinstance(item, tuple):  # not the stop sentinel
+            self.bound.release(request_priority(item[3]))
+        return item
+
+    def qsize(self):
+        return self.queue.qsize()
+
+
+class Lanes:
+    """The requests one worker has taken from the shared queue, by priority."""
+
+    def __init__(self, bulk_share: float):
+        self.queues = {priority: deque() for priority in PRIORITIES}
+        self.bulk_share = bulk_share
+        # Bulk slots owed, accumulated over batches smaller than 1 / bulk_share
+        self.credit = 0.0
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def put(self, request_data):
+        try:
+            priority = request_priority(request_data[3])
+        except ValueError:
+            priority = "interactive"
+        self.queues[priority].append(request_data)
+
+    def oldest(self) -> float:
+        """Enqueue time of the request that has waited longest."""
+        return min(queue[0][2] for queue in self.queues.values() if queue)
+
+    def expire(self, deadline: float) -> list[tuple[str, tuple]]:
+        """Remove and return (priority, request) of those queued before ``deadline``."""
+        expired = []
+        for priority, queue in self.queues.items():
+            kept = deque()
+            for request_data in queue:
+                if request_data[2] < deadline:
+                    expired.append((priority, request_data))
+                else:
+                    kept.append(request_data)
+            self.queues[priority] = kept
+        return expired
+
+    def take(self, size: int) -> list[tuple[str, tuple]]:
+        """Remove and return (priority, request) of up to ``size`` requests."""
+        interactive, bulk = self.queues["interactive"], self.queues["bulk"]
+        if interactive and bulk:
+            self.credit += size * self.bulk_share
+        else:
+            self.credit = 0.0
+        n_bulk = min(len(bulk), int(self.credit))
+        n_interactive = min(len(interactive), size - n_bulk)
+        n_bulk = min(len(bulk), size - n_interactive)
+        self.credit = max(self.credit - n_bulk, 0.0)
+        return [
+            ("interactive", interactive.popleft()) for _ in range(n_interactive)
+        ] + [("bulk", bulk.popleft()) for _ in range(n_bulk)]
+
+
+def register_load_shedding(
+    server, lit_api, max_queue: int, bulk_queue: int | None = None
+):
+    """
+    Bound the queue of ``lit_api`` to ``max_queue`` requests (0 disables),
+    ``bulk_queue`` of them bulk (half by default). Call before server.run().
+    """
+    api = api_label(lit_api)
+    # Only the adaptive loop sorts requests into lanes
+    lanes = getattr(lit_api.loop, "lanes", None) is not None
+    if not lanes:
+        logger.warning(
+            f"{api}: priority lanes need adaptive batching (ADAPTIVE_BATCHING=1), "
+            "bulk requests are batched like interactive ones."
+        )
+    if max_queue <= 0:
+        return
+    if bulk_queue is None:
+        bulk_queue = max_queue // 2
+    bound = QueueBound(api, max_queue, bulk_queue)
+    # litserve has no public hook on its request queues: the route handlers
+    # and the workers both get them from this method, so wrap it if it is
+    # still there
+    get_request_queue = getattr(server, "_get_request_queue", None)
+    if get_request_queue is None or list(
+        inspect.signature(get_request_queue).parameters
+    ) != ["api_path"]:
+        raise RuntimeError(
+            f"{api}: load shedding does not support this litserve version, "
+            "disable it with a max queue of 0 (MAX_QUEUE, IMAGE_MAX_QUEUE or "
+            "TEXT_MAX_QUEUE)."
+        )
+
+    def request_queue(api_path: str):
+        queue = get_request_queue(api_path)
+        return _AdmittingQueue(queue, bound) if api_path == lit_api.api_path else queue
+
+    # Used for the route handlers and for the workers alike
+    server._get_request_queue = request_queue
+    ahead = (
+        f", plus up to {LANE_LOOKAHEAD * lit_api.max_batch_size} taken ahead "
+        "by each worker"
+        if lanes
+        else ""
+    )
+    logger.info(f"{api}: at most {max_queue} queued, {bulk_queue} bulk{ahead}.")
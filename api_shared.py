@@ -0,0 +1,80 @@
+"""
+Model weights shared read-only between the worker processes of a host.
+
+litserve spawns every worker as a fresh interpreter, so each one holds its
+own copy of the weights it loaded. With SHARED_WEIGHTS=1, CPU workers save
+their state dict once to SHARED_WEIGHTS_DIR and swap their parameters for a
+memory map of that file: all workers then use the same page-cache pages and
+only their activations stay private. Point SHARED_WEIGHTS_DIR at /dev/shm
+to keep the file in memory, if it is large enough (Docker defaults to 64MB).
+"""
+
+import ctypes
+import ctypes.util
+import fcntl
+import gc
+import hashlib
+import logging
+import os
+import tempfile
+
+import torch
+
+SHARED_WEIGHTS = os.environ.get("SHARED_WEIGHTS", "0") == "1"
+SHARED_WEIGHTS_DIR = os.environ.get(
+    "SHARED_WEIGHTS_DIR", os.path.join(tempfile.gettempdir(), "nomic-weights")
+)
+
+logger = logging.getLogger(__name__)
+
+
+def release_memory():
+    """
+    Hand freed heap memory back to the OS. The replaced weights were small
+    enough allocations for glibc to keep them in its arenas otherwise, where
+    they still count against the worker.
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass  # not glibc
+
+
+def weights_path(state: dict[str, torch.Tensor], source: str, revision: str) -> str:
+    """
+    File for ``state``, keyed on where it came from, the revision of the
+    model there (see api_startup.model_revision) and its layout: an updated
+    model of the same shapes must not reuse the weights of the old one.
+    """
+    digest = hashlib.sha1(f"{source}@{revision}".encode())
+    for name, tensor in state.items():
+        digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype};".encode())
+    return os.path.join(SHARED_WEIGHTS_DIR, f"{digest.hexdigest()[:16]}.pt")
+
+
+def share_weights(
+    model: torch.nn.Module, source: str, revision: str
+) -> torch.nn.Module:
+    """
+    Back the parameters and buffers of ``model`` (loaded from ``source``, a
+    model id or path, at ``revision``) with the shared memory-mapped file,
+    writing it first if no other worker has. The model must not be modified afterwards:
+    in-place writes would silently turn shared pages into private copies.
+    """
+    state = model.state_dict()
+    path = weights_path(state, source, revision)
+    os.makedirs(SHARED_WEIGHTS_DIR, exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        # Workers start together; only the first one writes the file
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            tmp = f"{path}.{os.getpid()}.tmp"
+            torch.save(state, tmp)
+            os.replace(tmp, path)
+            logger.info(f"Saved the weights of {source} to {path}.")
+    del state
+    model.load_state_dict(torch.load(path, mmap=True, weights_only=True), assign=True)
+    release_memory()
+    logger.info(f"Sharing the weights of {source} from {path}.")
+    return model
@@ -0,0 +1,161 @@
+"""
+Worker startup: local model snapshots, per-phase timing, warmup and /ready.
+
+    python api_startup.py            # download both models into the HF cache
+"""
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from fastapi.responses import JSONResponse
+from litserve.utils import WorkerSetupStatus
+
+import api_metrics
+from api_metrics import api_label, metric
+
+# Directory of pre-downloaded models, laid out as MODEL_DIR/<org>/<name>
+MODEL_DIR = os.environ.get("MODEL_DIR", "")
+# Batch sizes every worker runs once before reporting ready; empty disables.
+# WARMUP_BATCH_SIZES_<API> overrides it per endpoint, e.g. ..._TXT_EMBED
+WARMUP_BATCH_SIZES = os.environ.get("WARMUP_BATCH_SIZES", "1,8")
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_model(model_id: str) -> str:
+    """
+    A local directory holding ``model_id``, so that loading it needs no hub
+    requests: MODEL_DIR/<model_id> if it exists, else the snapshot in the
+    Hugging Face cache. Falls back to ``model_id`` itself (a download).
+    """
+    if MODEL_DIR:
+        path = os.path.join(MODEL_DIR, model_id)
+        if os.path.isdir(path):
+            return path
+        logger.warning(f"{path} does not exist, trying the Hugging Face cache.")
+    from huggingface_hub import snapshot_download
+    from huggingface_hub.errors import LocalEntryNotFoundError
+
+    try:
+        return snapshot_download(model_id, local_files_only=True)
+    except LocalEntryNotFoundError:
+        logger.info(f"{model_id} is not cached yet, downloading it.")
+        return model_id
+
+
+def model_revision(model_path: str) -> str:
+    """
+    Revision of the model that ``model_path`` (from resolve_model) loads, to
+    key files derived from its weights: the commit of a Hugging Face cache
+    snapshot, else the last modification time of a MODEL_DIR directory.
+    """
+    if not os.path.isdir(model_path):
+        from huggingface_hub import snapshot_download
+
+        # Only resolvable once loading the model has downloaded it
+        model_path = snapshot_download(model_path, local_files_only=True)
+    if os.path.basename(os.path.dirname(model_path)) == "snapshots":
+        return os.path.basename(model_path)
+    mtime = max(
+        (
+            os.path.getmtime(os.path.join(root, name))
+            for root, _, names in os.walk(model_path)
+            for name in names
+        ),
+        default=0,
+    )
+    return f"mtime-{int(mtime)}"
+
+
+def warmup_sizes(lit_api) -> list[int]:
+    """The warmup batch sizes of ``lit_api``, capped at its max_batch_size."""
+    name = "WARMUP_BATCH_SIZES_" + api_label(lit_api).upper().replace("/", "_")
+    sizes = os.environ.get(name, WARMUP_BATCH_SIZES).split(",")
+    return sorted(
+        {min(int(size), lit_api.max_batch_size) for size in sizes if size.strip()} - {0}
+    )
+
+
+class StartupTimer:
+    """Times the setup phases of one worker and reports them when done."""
+
+    def __init__(self, lit_api):
+        self.api = api_label(lit_api)
+        self.started = time.perf_counter()
+        self.phases: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def done(self):
+        total = time.perf_counter() - self.started
+        labels = {"api": self.api, "worker": str(os.getpid())}
+        for name, seconds in {**self.phases, "total": total}.items():
+            api_metrics.set_gauge(
+                metric("startup_phase_seconds", **labels, phase=name), seconds
+            )
+        # Read by /ready: litserve's own setup status only knows the last
+        # path segment, which /img/embed and /txt/embed share
+        api_metrics.inc(metric("workers_ready", api=self.api))
+        api_metrics.flush()
+        phases = ", ".join(f"{k} {v:.2f}s" for k, v in self.phases.items())
+        logger.info(f"{self.api} worker ready in {total:.2f}s ({phases}).")
+
+
+def register_readiness_route(server, path: str = "/ready"):
+    """
+    Add a ``path`` route that returns 200 once every worker of every API has
+    finished setup, warmup included, and 503 before; both with the startup
+    phases and the number of ready workers per API.
+    """
+
+    def ready() -> JSONResponse:
+        workers = dict(server.workers_setup_status)
+        counters = api_metrics.collect()
+        expected = len(server.inference_workers_config)
+        apis = {
+            api_label(lit_api): int(
+                counters.get(metric("workers_ready", api=api_label(lit_api)), 0)
+            )
+            for lit_api in server.litapi_connector
+        }
+        is_ready = (
+            bool(workers)
+            and all(status == WorkerSetupStatus.READY for status in workers.values())
+            and all(count >= expected for count in apis.values())
+        )
+        startup = {
+            key: round(value, 3)
+            for key, value in api_metrics.collect_gauges().items()
+            if key.startswith("startup_phase_seconds")
+        }
+        return JSONResponse(
+            status_code=200 if is_ready else 503,
+            content={
+                "ready": is_ready,
+                "workers": {name: str(status) for name, status in workers.items()},
+                "apis": {api: f"{count}/{expected}" for api, count in apis.items()},
+                "startup": startup,
+            },
+        )
+
+    server.app.add_api_route(path, ready, methods=["GET"])
+
+
+if __name__ == "__main__":
+    from huggingface_hub import snapshot_download
+
+    from api_embed import VISION_MODEL
+    from api_text import TEXT_MODEL
+
+    for model_id in (VISION_MODEL, TEXT_MODEL):
+        print(snapshot_download(model_id))
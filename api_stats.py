@@ -1,22 +1,53 @@
 import json
 import logging
+import multiprocessing
 import os
-from collections import Counter
-from colorsys import rgb_to_hsv
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import litserve as ls
 import numpy as np
+from fastapi.responses import JSONResponse
 from PIL import ExifTags, Image
 
-from api_utils import decode_request
+import api_metrics
+from api_hashes import (
+    HASH_INDEX_SIZE,
+    HammingIndex,
+    content_id,
+    parse_hash_options,
+    perceptual_hashes,
+)
+from api_startup import StartupTimer, register_readiness_route
+from api_utils import (
+    load_image,
+    open_image,
+    read_content,
+    register_upload_limit,
+    resolve_contents,
+)
 
 # Environment configurations
 PORT = int(os.environ.get("PORT", "8000"))
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 NUM_API_SERVERS = int(os.environ.get("NUM_API_SERVERS", "1"))
 WORKERS_PER_DEVICE = int(os.environ.get("WORKERS_PER_DEVICE", "1"))
+STATS_MAX_BATCH_SIZE = int(os.environ.get("STATS_MAX_BATCH_SIZE", "16"))
+STATS_BATCH_TIMEOUT = float(os.environ.get("STATS_BATCH_TIMEOUT", "0.05"))
+# Split the available cores between the litserve workers by default; only
+# Linux has sched_getaffinity, which also counts CPU affinity limits
+CPU_COUNT = (
+    len(os.sched_getaffinity(0))
+    if hasattr(os, "sched_getaffinity")
+    else os.cpu_count() or 1
+)
+STATS_PROCESSES = int(
+    os.environ.get("STATS_PROCESSES", str(max(1, CPU_COUNT // WORKERS_PER_DEVICE)))
+)
 AVERAGING_METHOD = os.environ.get("AVERAGING_METHOD", "geometric").lower()
 THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", "512"))
+PALETTE_SIZE = int(os.environ.get("PALETTE_SIZE", "5"))
+PALETTE_ITERATIONS = int(os.environ.get("PALETTE_ITERATIONS", "10"))
 
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL.upper()),
@@ -159,47 +190,120 @@ def rgb_to_hex(rgb_array):
     return f"#{r_int:02x}{g_int:02x}{b_int:02x}"
 
 
-def find_dominant_color(valid_pixels):
-    """Find the dominant color using HSV clustering"""
-    # Convert to HSV for better color grouping
-    rgb_pixels = valid_pixels[:, :3] / 255.0
-    hsv_pixels = np.array([rgb_to_hsv(r, g, b) for r, g, b in rgb_pixels])
-
-    # Quantize colors to reduce unique count
-    quantized = (
+def rgb_to_hsv_array(rgb):
+    """
+    Vectorized colorsys.rgb_to_hsv for an (N, 3) float array in [0, 1].
+    Performs the same floating point operations in the same order, so the
+    result is bit-for-bit identical to calling colorsys per pixel.
+    """
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    maxc = rgb.max(axis=1)
+    minc = rgb.min(axis=1)
+    rangec = maxc - minc
+    grey = rangec == 0
+    # Grey pixels would divide by zero below; their hue and saturation are 0
+    safe_range = np.where(grey, 1.0, rangec)
+    safe_max = np.where(maxc == 0, 1.0, maxc)
+
+    s = np.where(grey, 0.0, rangec / safe_max)
+    rc = (maxc - r) / safe_range
+    gc = (maxc - g) / safe_range
+    bc = (maxc - b) / safe_range
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.where(grey, 0.0, (h / 6.0) % 1.0)
+    return np.stack([h, s, maxc], axis=1)
+
+
+def quantize_colors(valid_pixels):
+    """Quantize pixels to packed HSV keys, one decimal digit per channel"""
+    hsv_pixels = rgb_to_hsv_array(valid_pixels[:, :3] / 255.0)
+    return (
         (hsv_pixels[:, 0] * 10).astype(int) * 1000
         + (hsv_pixels[:, 1] * 10).astype(int) * 10
         + (hsv_pixels[:, 2] * 10).astype(int)
     )
 
-    # Count occurrences
-    color_counts = Counter(quantized)
 
-    # Get most common color
-    most_common_key = color_counts.most_common(1)[0][0]
+def find_dominant_color(valid_pixels, quantized=None):
+    """Find the dominant color using HSV clustering"""
+    if quantized is None:
+        quantized = quantize_colors(valid_pixels)
+
+    # Count occurrences of every key
+    counts = np.bincount(quantized)
 
-    # Find an actual pixel with this quantization
-    idx = np.where(quantized == most_common_key)[0][0]
+    # Ties go to the key seen first, which is the pixel we report
+    is_most_common = counts[quantized] == counts.max()
+    idx = np.argmax(is_most_common)
     dominant_rgb = valid_pixels[idx, :3] / 255.0
 
     return dominant_rgb
 
 
+def find_palette(valid_pixels, size, quantized=None, iterations=PALETTE_ITERATIONS):
+    """
+    Find the ``size`` main colors with a weighted k-means over the HSV histogram.
+    Each occupied histogram bin is one point at the mean color of its pixels,
+    weighted by its pixel count, so the cost does not depend on image size.
+
+    Returns:
+        centers: (k, 3) array of RGB values in range [0,1], heaviest first
+        shares: (k,) array with the fraction of pixels assigned to each center
+    """
+    if quantized is None:
+        quantized = quantize_colors(valid_pixels)
+    rgb = valid_pixels[:, :3].astype(float) / 255.0
+
+    counts = np.bincount(quantized)
+    occupied = np.nonzero(counts)[0]
+    weights = counts[occupied].astype(float)
+    colors = (
+        np.stack(
+            [
+                np.bincount(quantized, weights=rgb[:, c], minlength=len(counts))[
+                    occupied
+                ]
+                for c in range(3)
+            ],
+            axis=1,
+        )
+        / weights[:, None]
+    )
+
+    # Seed with the heaviest bins so the result is deterministic
+    k = min(size, len(colors))
+    centers = colors[np.argsort(-weights, kind="stable")[:k]]
+    for _ in range(iterations):
+        distances = ((colors[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        labels = distances.argmin(axis=1)
+        totals = np.bincount(labels, weights=weights, minlength=k)
+        updated = centers.copy()
+        for c in range(3):
+            channel = np.bincount(labels, weights=weights * colors[:, c], minlength=k)
+            nonempty = totals > 0
+            updated[nonempty, c] = channel[nonempty] / totals[nonempty]
+        if np.allclose(updated, centers):
+            break
+        centers = updated
+
+    distances = ((colors[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+    labels = distances.argmin(axis=1)
+    totals = np.bincount(labels, weights=weights, minlength=k)
+    order = np.argsort(-totals, kind="stable")
+    return centers[order], totals[order] / totals.sum()
+
+
 def prepare_image_for_color_analysis(image):
     """
-    Prepare image for color analysis by creating a thumbnail and converting to RGBA.
-    Also extracts valid (non-transparent) pixels.
+    Prepare a thumbnail (see resize_for_processing) for color analysis by
+    converting it to RGBA. Also extracts valid (non-transparent) pixels.
 
     Returns:
         valid_pixels: Array of non-transparent pixel values
         or None if no valid pixels found
     """
-    # Create a thumbnail for processing if image is large
-    process_image = resize_for_processing(image)
-
     # Convert image to RGBA if it isn't already
-    if process_image.mode != "RGBA":
-        process_image = process_image.convert("RGBA")
+    process_image = image if image.mode == "RGBA" else image.convert("RGBA")
 
     # Get image data
     pixels = np.array(process_image)
@@ -237,17 +341,18 @@ def get_average_color(valid_pixels, averaging_method="arithmetic"):
     }
 
 
-def get_dominant_color(valid_pixels):
+def get_dominant_color(valid_pixels, quantized=None):
     """
     Find the dominant color in an image using HSV clustering.
 
     Args:
         valid_pixels: Array of non-transparent pixel values
+        quantized: Optional precomputed quantize_colors(valid_pixels)
 
     Returns:
         Dictionary containing RGB values and hex code for the dominant color
     """
-    dominant_rgb = find_dominant_color(valid_pixels)
+    dominant_rgb = find_dominant_color(valid_pixels, quantized)
     dominant_hex = rgb_to_hex(dominant_rgb)
 
     return {
@@ -256,18 +361,37 @@ def get_dominant_color(valid_pixels):
     }
 
 
+def get_palette(valid_pixels, size, quantized=None):
+    """
+    Find the main colors in an image, heaviest first.
+
+    Args:
+        valid_pixels: Array of non-transparent pixel values
+        size: Maximum number of palette colors
+        quantized: Optional precomputed quantize_colors(valid_pixels)
+
+    Returns:
+        List of dictionaries with RGB values, hex code and pixel share per color
+    """
+    centers, shares = find_palette(valid_pixels, size, quantized)
+    return [
+        {"rgb": center.tolist(), "hex": rgb_to_hex(center), "share": float(share)}
+        for center, share in zip(centers, shares)
+    ]
+
+
 def get_image_colors(image, averaging_method="arithmetic"):
     """
     Extract color information from image, including average and dominant colors.
     This function can later be converted to use async operations for parallel processing.
 
     Args:
-        image: PIL Image object
+        image: PIL Image object, already resized by resize_for_processing
         averaging_method: Method to use for calculating average color
 
     Returns:
-        Dictionary containing average and dominant color information,
-        or None if no valid pixels were found
+        Dictionary containing average and dominant color information and,
+        if PALETTE_SIZE > 0, the palette; or None if no valid pixels were found
     """
     valid_pixels = prepare_image_for_color_analysis(image)
 
@@ -276,12 +400,73 @@ def get_image_colors(image, averaging_method="arithmetic"):
 
     # Calculate average and dominant colors
     avg_color_data = get_average_color(valid_pixels, averaging_method)
-    dominant_color_data = get_dominant_color(valid_pixels)
+    quantized = quantize_colors(valid_pixels)
+    dominant_color_data = get_dominant_color(valid_pixels, quantized)
 
-    return {
+    color_data = {
         "avg_color": avg_color_data,
         "dominant_color": dominant_color_data,
     }
+    if PALETTE_SIZE > 0:
+        color_data["palette"] = get_palette(valid_pixels, PALETTE_SIZE, quantized)
+    return color_data
+
+
+def analyze_image(file_bytes):
+    """
+    Compute EXIF and color data for one encoded image. Runs in a pool process,
+    so any failure is returned as {"error": ...} rather than raised.
+    """
+    try:
+        # Only the thumbnail is analyzed, but EXIF comes from the full file
+        image = open_image(file_bytes, THUMBNAIL_SIZE, edge="long")
+        if image is None:
+            return {"error": "No valid image data provided in request."}
+        load_image(image)
+        exif_data = get_exif_data(image)
+        thumbnail = resize_for_processing(image)
+        color_data = get_image_colors(thumbnail, AVERAGING_METHOD)
+        hashes = perceptual_hashes(thumbnail)
+    except Exception as e:
+        logger.exception("Failed to analyze image.")
+        return {"error": f"Failed to analyze image: {e}"}
+    return {"exif_data": exif_data, "color_data": color_data, "hashes": hashes}
+
+
+def analyze_colors(image):
+    """
+    Color data for an already decoded image, as computed by analyze_image.
+    Runs in a pool process; failures are returned as {"error": ...}.
+    """
+    try:
+        thumbnail = resize_for_processing(image)
+        return {"color_data": get_image_colors(thumbnail, AVERAGING_METHOD)}
+    except Exception as e:
+        logger.exception("Failed to analyze image colors.")
+        return {"error": f"Failed to analyze image: {e}"}
+
+
+def create_stats_pool() -> ProcessPoolExecutor | None:
+    """Process pool for color analysis, or None for STATS_PROCESSES <= 1."""
+    if STATS_PROCESSES <= 1:
+        return None
+    return ProcessPoolExecutor(
+        max_workers=STATS_PROCESSES,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+def warm_stats_pool(pool: ProcessPoolExecutor | None):
+    """
+    Start every pool process and run one analysis in it, so that the first
+    requests do not wait for spawned interpreters to import their modules.
+    """
+    image = Image.new("RGB", (64, 48), "gray")
+    if pool is None:
+        analyze_colors(image)
+        return
+    for future in [pool.submit(analyze_colors, image) for _ in range(STATS_PROCESSES)]:
+        future.result()
 
 
 class ImageStatsAPI(ls.LitAPI):
@@ -290,30 +475,105 @@ class ImageStatsAPI(ls.LitAPI):
             logger.warning(
                 "ImageStatsAPI does not benefit from hardware acceleration. Use 'cpu'."
             )
+        startup = StartupTimer(self)
+        with startup.phase("pool"):
+            self.pool = create_stats_pool()
+        with startup.phase("warmup"):
+            warm_stats_pool(self.pool)
+        self.hash_index = HammingIndex() if HASH_INDEX_SIZE > 0 else None
+        startup.done()
         logger.info(
-            f"Set up ImageStatsAPI for color analysis with {AVERAGING_METHOD=}."
+            f"Set up ImageStatsAPI for color analysis with {AVERAGING_METHOD=} "
+            f"and {STATS_PROCESSES=}."
         )
 
-    def decode_request(self, request) -> Image.Image:
-        image = decode_request(request)
-        if image is None:
-            raise ValueError("No valid image data provided in request.")
-        return image
-
-    def predict(self, image):
-        exif_data = get_exif_data(image)
-        color_data = get_image_colors(image, AVERAGING_METHOD)
-
-        return {"exif_data": exif_data, "color_data": color_data}
+    def decode_request(self, request):
+        # Errors are reported per image in encode_response: raising here
+        # would fail every other request in the batch.
+        try:
+            options = parse_hash_options(request)
+        except ValueError as e:
+            return None, {"error": str(e)}
+        return read_content(request), options
+
+    def batch(self, inputs):
+        with api_metrics.stage(self, "fetch"):
+            contents = resolve_contents([content for content, _ in inputs])
+        return [(content, options) for content, (_, options) in zip(contents, inputs)]
+
+    def predict(self, items):
+        if not isinstance(items, list):
+            # litserve skips batch() when batching is disabled
+            return self.predict(self.batch([items]))[0]
+        with api_metrics.stage(self, "analyze"):
+            results = self.analyze(
+                [None if "error" in options else content for content, options in items]
+            )
+        with api_metrics.stage(self, "near_duplicates"):
+            for (content, options), result in zip(items, results):
+                if "error" in options:
+                    result["error"] = options["error"]
+                elif "hashes" in result and self.hash_index is not None:
+                    self.find_near_duplicates(content, options, result)
+        return results
+
+    def find_near_duplicates(self, file_bytes: bytes, options: dict, result: dict):
+        """
+        Add the near-duplicates of an analyzed image seen earlier by this
+        worker (earlier images of the same batch included) to ``result``,
+        then remember the image. Every worker process has its own index, so
+        with several workers an image only finds those its worker analyzed;
+        an image is never its own near-duplicate, even when sent again.
+        """
+        result["id"] = options["id"] or content_id(file_bytes)
+        result["near_duplicates"] = self.hash_index.search(
+            result["hashes"], options["max_distance"], exclude=result["id"]
+        )
+        self.hash_index.add(result["id"], result["hashes"])
+
+    def analyze(self, contents):
+        results = [None] * len(contents)
+        for i, file_bytes in enumerate(contents):
+            if file_bytes is None:
+                results[i] = {"error": "No valid image data provided in request."}
+        todo = [i for i, result in enumerate(results) if result is None]
+
+        if self.pool is None or len(todo) == 1:
+            for i in todo:
+                results[i] = analyze_image(contents[i])
+            return results
+
+        futures = {i: self.pool.submit(analyze_image, contents[i]) for i in todo}
+        for i, future in futures.items():
+            try:
+                results[i] = future.result()
+            except BrokenProcessPool:
+                results[i] = {"error": "Image analysis process crashed."}
+        if any(isinstance(f.exception(), BrokenProcessPool) for f in futures.values()):
+            logger.error("Stats process pool crashed, starting a new one.")
+            self.pool = create_stats_pool()
+        return results
+
+    def encode_response(self, output):
+        if "error" in output:
+            return JSONResponse(status_code=400, content={"detail": output["error"]})
+        return output
 
 
 if __name__ == "__main__":
     server = ls.LitServer(
-        ImageStatsAPI(max_batch_size=1, api_path="/stats"),
+        ImageStatsAPI(
+            max_batch_size=STATS_MAX_BATCH_SIZE,
+            batch_timeout=STATS_BATCH_TIMEOUT,
+            api_path="/stats",
+        ),
         accelerator="cpu",
         track_requests=True,
         workers_per_device=WORKERS_PER_DEVICE,
     )
+    api_metrics.register_metrics_route(server)
+    register_readiness_route(server)
+    register_upload_limit(server)
     server.run(
         port=PORT,
         host="0.0.0.0",
@@ -0,0 +1,134 @@
+"""
+Stand-in models for STUB_MODELS=1.
+
+They have the interfaces the APIs use (a CLIP-style image processor, a
+vision model returning ``last_hidden_state`` and a SentenceTransformer-like
+text model) but no pretrained weights, so a server can run offline to
+measure queueing, batching and serialization overhead. The embeddings are
+deterministic functions of the input, which keeps caching meaningful.
+
+STUB_BATCH_MS and STUB_ITEM_MS add a simulated forward pass of
+``batch_ms + n * item_ms`` per batch of ``n`` inputs.
+"""
+
+import os
+import re
+import time
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+STUB_MODELS = os.environ.get("STUB_MODELS", "0") == "1"
+STUB_BATCH_MS = float(os.environ.get("STUB_BATCH_MS", "0"))
+STUB_ITEM_MS = float(os.environ.get("STUB_ITEM_MS", "0"))
+STUB_HIDDEN_SIZE = 768
+STUB_VOCAB_SIZE = 30522
+STUB_MAX_LENGTH = 512
+
+
+def stub_name(model_name: str) -> str:
+    """Model id for stub embeddings, so they never share cache entries."""
+    return f"stub:{model_name}"
+
+
+def simulate_forward(batch_size: int):
+    delay = STUB_BATCH_MS + batch_size * STUB_ITEM_MS
+    if delay > 0:
+        time.sleep(delay / 1000)
+
+
+def stub_image_processor():
+    """The nomic-embed-vision preprocessing, without a hub download."""
+    from transformers import CLIPImageProcessor
+    from transformers.image_utils import OPENAI_CLIP_MEAN, OPENAI_CLIP_STD
+
+    return CLIPImageProcessor(
+        size={"shortest_edge": 224},
+        crop_size={"height": 224, "width": 224},
+        image_mean=OPENAI_CLIP_MEAN,
+        image_std=OPENAI_CLIP_STD,
+        resample=3,
+    )
+
+
+class StubVisionModel(torch.nn.Module):
+    """Pools pixels to an 8x8 grid and projects them to the hidden size."""
+
+    def __init__(self, hidden_size: int = STUB_HIDDEN_SIZE, seed: int = 0):
+        super().__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.proj = torch.nn.Parameter(
+            torch.randn(3 * 8 * 8, hidden_size, generator=generator),
+            requires_grad=False,
+        )
+
+    def forward(self, pixel_values):
+        simulate_forward(len(pixel_values))
+        pooled = torch.nn.functional.adaptive_avg_pool2d(pixel_values, 8)
+        cls = pooled.flatten(1) @ self.proj
+        return SimpleNamespace(last_hidden_state=cls[:, None])
+
+
+class StubTokenizer:
+    """Whitespace tokenizer with character offsets, like a fast tokenizer's."""
+
+    padding_side = "right"
+    is_fast = True
+
+    def __call__(self, text: str, return_offsets_mapping=False, **kwargs):
+        words = list(re.finditer(r"\S+", text))
+        encoding = {
+            "input_ids": [
+                zlib.crc32(word.group().encode()) % STUB_VOCAB_SIZE for word in words
+            ]
+        }
+        if return_offsets_mapping:
+            encoding["offset_mapping"] = [word.span() for word in words]
+        return encoding
+
+
+class StubSentenceModel(torch.nn.Module):
+    """Hashes words to token ids and mean-pools a random embedding table."""
+
+    def __init__(self, hidden_size: int = STUB_HIDDEN_SIZE, seed: int = 0):
+        super().__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.embeddings = torch.nn.Parameter(
+            torch.randn(STUB_VOCAB_SIZE, hidden_size, generator=generator),
+            requires_grad=False,
+        )
+        self.tokenizer = StubTokenizer()
+        self.max_seq_length = STUB_MAX_LENGTH
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.embeddings.shape[1]
+
+    @property
+    def device(self) -> torch.device:
+        return self.embeddings.device
+
+    def tokenize(self, texts: list[str]) -> dict[str, torch.Tensor]:
+        ids = [
+            [zlib.crc32(word.encode()) % STUB_VOCAB_SIZE for word in text.split()]
+            for text in texts
+        ]
+        ids = [row[:STUB_MAX_LENGTH] or [0] for row in ids]
+        width = max(len(row) for row in ids)
+        input_ids = torch.zeros(len(ids), width, dtype=torch.long)
+        attention_mask = torch.zeros(len(ids), width, dtype=torch.long)
+        for i, row in enumerate(ids):
+            input_ids[i, : len(row)] = torch.tensor(row)
+            attention_mask[i, : len(row)] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def forward(self, features):
+        simulate_forward(len(features["input_ids"]))
+        mask = features["attention_mask"].unsqueeze(-1).float()
+        tokens = self.embeddings[features["input_ids"]] * mask
+        return {"sentence_embedding": tokens.sum(dim=1) / mask.sum(dim=1)}
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        with torch.no_grad():
+            return self(self.tokenize(texts))["sentence_embedding"].numpy()
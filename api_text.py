@@ -3,7 +3,27 @@ import os
 
 import litserve as ls
 import numpy as np
-from sentence_transformers import SentenceTransformer
+import torch
+from fastapi.responses import JSONResponse
+
+import api_metrics
+from api_batching import batching_loop
+from api_bulk import register_bulk_route
+from api_cache import EmbeddingCache, cache_stats
+from api_chunking import CHUNK_FIELDS, chunk_spans, parse_chunking, pool_chunks
+from api_formats import FORMAT_FIELDS, parse_format
+from api_index import INDEX_FIELDS, index_embeddings, register_search_route
+from api_priority import register_load_shedding
+from api_shared import SHARED_WEIGHTS, share_weights
+from api_startup import (
+    StartupTimer,
+    model_revision,
+    register_readiness_route,
+    resolve_model,
+    warmup_sizes,
+)
+from api_stub import STUB_MODELS, StubSentenceModel, stub_name
+from api_utils import embedding_response
 
 # Environment configurations
 PORT = int(os.environ.get("PORT", "8000"))
@@ -11,10 +31,16 @@ LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 NUM_API_SERVERS = int(os.environ.get("NUM_API_SERVERS", "1"))
 WORKERS_PER_DEVICE = int(os.environ.get("WORKERS_PER_DEVICE", "1"))
 MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "32"))
+LATENCY_TARGET = float(os.environ.get("LATENCY_TARGET", "1.0"))
+# Queue bounds (0: unbounded) and bulk share of batches, see api_priority
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", str(16 * MAX_BATCH_SIZE)))
+BULK_QUEUE = int(os.environ.get("BULK_QUEUE", str(MAX_QUEUE // 2)))
+BULK_SHARE = float(os.environ.get("BULK_SHARE", "0.25"))
 BATCH_TIMEOUT = float(os.environ.get("BATCH_TIMEOUT", "0.1"))
-NORMALIZE = bool(os.environ.get("NORMALIZE", "0"))
-DIMENSION = int(os.environ.get("DIMENSION", "768"))
-assert MAX_BATCH_SIZE > 1, "This implementation presumes MAX_BATCH_SIZE > 1"
+# Padded tokens per forward pass; 0 falls back to SentenceTransformer.encode
+TEXT_MAX_BATCH_TOKENS = int(os.environ.get("TEXT_MAX_BATCH_TOKENS", "16384"))
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch").lower()
+TEXT_MODEL = "nomic-ai/nomic-embed-text-v1.5"
 
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL.upper()),
@@ -23,32 +49,295 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def plan_buckets(lengths: np.ndarray, max_tokens: int) -> list[np.ndarray]:
+    """
+    Group input indices into forward passes of similar token length.
+
+    Inputs are taken longest first and a pass is closed as soon as adding the
+    next input would push (inputs x longest input) over ``max_tokens``. An
+    input longer than the budget still gets a pass of its own.
+    """
+    order = np.argsort(-lengths, kind="stable")
+    buckets = []
+    current = []
+    for idx in order:
+        # Sorted descending, so the first input sets the padded length
+        if current and (len(current) + 1) * lengths[current[0]] > max_tokens:
+            buckets.append(np.array(current))
+            current = []
+        current.append(idx)
+    if current:
+        buckets.append(np.array(current))
+    return buckets
+
+
 class NomicTextAPI(ls.LitAPI):
     def setup(self, device: str):
         logger.info("Setting up Nomic text model.")
-        self.model = SentenceTransformer(
-            "nomic-ai/nomic-embed-text-v1.5", trust_remote_code=True, device=device
-        )
+        startup = StartupTimer(self)
+        self.onnx = None
+        if STUB_MODELS:
+            logger.warning("Using a stub text model (STUB_MODELS=1).")
+            with startup.phase("load"):
+                self.model = StubSentenceModel().to(device)
+        else:
+            with startup.phase("import"):
+                # Deferred so that API server processes never pay for it
+                if INFERENCE_BACKEND == "onnx":
+                    # Only needed for this backend, and onnxruntime is an optional extra
+                    from api_onnx import SentenceTokenizer, load_or_export
+                else:
+                    import sentence_transformers  # noqa: F401
+            with startup.phase("resolve"):
+                model_path = resolve_model(TEXT_MODEL)
+            if INFERENCE_BACKEND == "onnx" and device != "cpu":
+                logger.warning(f"The ONNX backend runs on CPU, ignoring {device=}.")
+                device = "cpu"
+            with startup.phase("load"):
+                if INFERENCE_BACKEND == "onnx":
+                    # Just the tokenizer: the weights only load to export the model
+                    self.model = SentenceTokenizer(model_path)
+                    self.onnx = load_or_export(
+                        TEXT_MODEL,
+                        model_revision(model_path),
+                        lambda: self.build_onnx_export(model_path),
+                    )
+                else:
+                    self.model = self.load_model(model_path, device)
+        if SHARED_WEIGHTS and device == "cpu" and self.onnx is None:
+            with startup.phase("share"):
+                if STUB_MODELS:
+                    share_weights(self.model, stub_name(TEXT_MODEL), "stub")
+                else:
+                    share_weights(self.model, model_path, model_revision(model_path))
         self.prefix = "search_query: "
+        model_name = stub_name(TEXT_MODEL) if STUB_MODELS else TEXT_MODEL
+        self.cache = EmbeddingCache("txt", model_name)
+        with startup.phase("warmup"):
+            self.warmup()
+        startup.done()
         logger.info("Text model setup complete.")
 
-    def decode_request(self, request):
+    def load_model(self, model_path: str, device: str):
+        from sentence_transformers import SentenceTransformer
+
+        # safetensors weights are memory-mapped instead of read into buffers
+        return SentenceTransformer(
+            model_path,
+            trust_remote_code=True,
+            device=device,
+            model_kwargs={"use_safetensors": True},
+        )
+
+    def build_onnx_export(self, model_path: str):
+        """The module and sample input api_onnx exports on its first run."""
+        from api_onnx import SentenceEmbedding
+
+        features = self.model.tokenize(["search_query: hello world"])
+        sample = {k: v for k, v in features.items() if isinstance(v, torch.Tensor)}
+        model = self.load_model(model_path, "cpu")
+        return SentenceEmbedding(model, list(sample)), sample
+
+    def warmup(self):
+        """Run the model once per warmup batch size, bypassing the cache."""
+        text = f"{self.prefix}warmup " + "lorem ipsum dolor sit amet " * 16
+        for size in warmup_sizes(self):
+            self.embed([text] * size)
+            logger.info(f"Warmed up the text model with a batch of {size}.")
+
+    def decode_request(self, request, context):
+        context["format"] = {k: request[k] for k in FORMAT_FIELDS if k in request}
+        context["index"] = {k: request[k] for k in INDEX_FIELDS if k in request}
         prefix = request.get("prefix", self.prefix).strip()
         if not prefix.endswith(":"):
             prefix += ":"
             logger.info("appended missing separator (':')")
-        logger.info(f"Processing with prefix='{prefix}'")
-        return prefix + " " + np.asarray(request["input"])
+        inputs = request.get("input")
+        single = isinstance(inputs, str)
+        if single:
+            inputs = [inputs]
+        context["single"] = single
+        try:
+            if (
+                not isinstance(inputs, list)
+                or not inputs
+                or not all(isinstance(text, str) for text in inputs)
+            ):
+                raise ValueError(
+                    "'input' must be a string or a non-empty list of strings."
+                )
+            chunking = self.parse_chunking(
+                {k: request[k] for k in CHUNK_FIELDS if k in request}, prefix
+            )
+            if chunking and parse_format(context["format"])[1] == "raw":
+                raise ValueError("Use the 'json' or 'base64' encoding with chunking.")
+        except ValueError as e:
+            context["error"] = str(e)
+            return single, None, None
+        logger.info(f"Processing {len(inputs)} input(s) with prefix='{prefix}'")
+        documents = None
+        if chunking:
+            # Every window becomes an input of its own, so the windows of all
+            # requests are batched, bucketed and cached together
+            mode, window, overlap = chunking
+            documents = [
+                chunk_spans(text, self.token_offsets(text), window, overlap)
+                for text in inputs
+            ]
+            inputs = [
+                text[start:end]
+                for text, spans in zip(inputs, documents)
+                for start, end, _ in spans
+            ]
+            documents = mode, documents
+        items = []
+        for text in inputs:
+            text = f"{prefix} {text}"
+            key = self.cache.key(text.encode())
+            items.append((key, text, self.cache.get(key)))
+        return single, items, documents
 
-    def predict(self, inputs):
-        embeddings = self.model.encode(inputs)
-        # normalize the embeddings
-        if NORMALIZE:
-            embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
-        return embeddings[:, :DIMENSION]
+    def parse_chunking(self, request, prefix: str):
+        """The (mode, window, overlap) of a request, see api_chunking."""
+        if not request.get("chunking"):
+            return None
+        if not getattr(self.model.tokenizer, "is_fast", False):
+            raise ValueError("Chunking needs a tokenizer with character offsets.")
+        prefix_tokens = len(
+            self.model.tokenizer(f"{prefix} ", add_special_tokens=False)["input_ids"]
+        )
+        return parse_chunking(
+            request,
+            self.model.get_sentence_embedding_dimension(),
+            self.model.max_seq_length,
+            prefix_tokens,
+        )
+
+    def token_offsets(self, text: str) -> list[tuple[int, int]]:
+        """Character offsets of the tokens of ``text``, special tokens excluded."""
+        encoding = self.model.tokenizer(
+            text,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            verbose=False,
+        )
+        return encoding["offset_mapping"]
+
+    def predict(self, requests):
+        if not isinstance(requests, list):
+            return self.predict([requests])[0]
+
+        # Only run the model on cache misses, once per distinct text
+        pending = {}
+        for _, items, _ in requests:
+            for key, text, cached in items or ():
+                if cached is None and key not in pending:
+                    pending[key] = text
+        computed = {}
+        if pending:
+            embeddings = self.embed(list(pending.values()))
+            for key, embedding in zip(pending, embeddings):
+                self.cache.put(key, embedding)
+                computed[key] = embedding
+
+        # A single string gets a single vector, a list gets one row per text
+        outputs = []
+        for single, items, documents in requests:
+            if items is None:
+                outputs.append(None)  # rejected in decode_request
+                continue
+            embeddings = np.stack(
+                [
+                    cached if cached is not None else computed[key]
+                    for key, _, cached in items
+                ]
+            )
+            chunks = None
+            if documents is not None:
+                mode, documents = documents
+                embeddings, chunks = pool_chunks(embeddings, documents)
+                if mode != "chunks":
+                    chunks = None
+            outputs.append(
+                {
+                    "embeddings": embeddings[0] if single else embeddings,
+                    "chunks": chunks,
+                }
+            )
+        return outputs
+
+    def embed(self, inputs):
+        if TEXT_MAX_BATCH_TOKENS > 0 or self.onnx is not None:
+            embeddings = self.encode_bucketed(inputs)
+        else:
+            embeddings = self.model.encode(inputs)
+        # Truncated and normalized per request, in embedding_response
+        return embeddings
+
+    def encode_bucketed(self, texts: list[str]) -> np.ndarray:
+        """
+        Equivalent of SentenceTransformer.encode that tokenizes once and runs
+        length buckets under a token budget, each padded only to its own
+        longest input. Embeddings are returned in the order of ``texts``.
+        """
+        with api_metrics.stage(self, "tokenize"):
+            features = self.model.tokenize(texts)
+        lengths = features["attention_mask"].sum(dim=1).numpy()
+        # Dropping padding columns depends on which side the padding is on
+        left_padded = self.model.tokenizer.padding_side == "left"
+
+        embeddings = None
+        padded_tokens = 0
+        buckets = plan_buckets(lengths, TEXT_MAX_BATCH_TOKENS or np.inf)
+        for bucket in buckets:
+            width = int(lengths[bucket].max())
+            columns = slice(-width, None) if left_padded else slice(0, width)
+            rows = torch.from_numpy(bucket)
+            batch = {
+                name: value[rows][:, columns].to(self.model.device)
+                for name, value in features.items()
+                if isinstance(value, torch.Tensor)
+            }
+            with api_metrics.stage(self, "forward"):
+                if self.onnx is not None:
+                    output = self.onnx(**batch)
+                else:
+                    with torch.no_grad():
+                        output = self.model(batch)["sentence_embedding"]
+                    # Includes waiting for the device, which .cpu() syncs on
+                    output = output.float().cpu().numpy()
+            if embeddings is None:
+                embeddings = np.empty((len(texts), output.shape[1]), np.float32)
+            embeddings[bucket] = output
+            padded_tokens += len(bucket) * width
+
+        real_tokens = int(lengths.sum())
+        logger.debug(
+            f"Padding efficiency {real_tokens / padded_tokens:.2f} over "
+            f"{len(buckets)} passes (single pass: "
+            f"{real_tokens / (len(texts) * lengths.max()):.2f})."
+        )
+        api_metrics.inc("txt_tokens", real_tokens)
+        api_metrics.inc("txt_padded_tokens", padded_tokens)
+        return embeddings
 
-    def encode_response(self, output):
-        return {"embeddings": output.tolist()}
+    def encode_response(self, output, context):
+        if "error" in context:
+            return JSONResponse(status_code=400, content={"detail": context["error"]})
+        try:
+            index_embeddings(context["index"], output["embeddings"])
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"detail": str(e)})
+        with api_metrics.stage(self, "serialize"):
+            response = embedding_response(output["embeddings"], context["format"])
+            if output["chunks"] is None or not isinstance(response, dict):
+                return response
+            chunks = [
+                {"spans": spans, **embedding_response(embeddings, context["format"])}
+                for spans, embeddings in output["chunks"]
+            ]
+            response["chunks"] = chunks[0] if context["single"] else chunks
+            return response
 
 
 if __name__ == "__main__":
@@ -56,6 +345,7 @@ if __name__ == "__main__":
         max_batch_size=MAX_BATCH_SIZE,
         batch_timeout=BATCH_TIMEOUT,
         api_path="/embed",
+        loop=batching_loop(MAX_BATCH_SIZE, LATENCY_TARGET, BULK_SHARE),
     )
     server = ls.LitServer(
         api,
@@ -63,6 +353,12 @@ if __name__ == "__main__":
         track_requests=True,
         workers_per_device=WORKERS_PER_DEVICE,
     )
+    register_load_shedding(server, api, MAX_QUEUE, BULK_QUEUE)
+    server.app.add_api_route("/cache/stats", cache_stats, methods=["GET"])
+    api_metrics.register_metrics_route(server)
+    register_readiness_route(server)
+    register_bulk_route(server, api, "/embed/bulk")
+    register_search_route(server, text_api=api)
     server.run(
         port=PORT,
         host="0.0.0.0",
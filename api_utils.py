@@ -1,11 +1,32 @@
 import logging
+import math
 import os
+import threading
+import weakref
+from collections.abc import Callable
 from io import BytesIO
 
-import requests
+import numpy as np
+from fastapi import HTTPException, Response
+from fastapi.responses import JSONResponse
 from PIL import Image
 
+from api_fetch import FETCH_MAX_BYTES, get_fetcher
+from api_formats import encode_embeddings, matryoshka, parse_format, parse_matryoshka
+from api_priority import QUEUE_RETRY_AFTER
+
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+REDUCED_DECODE = os.environ.get("REDUCED_DECODE", "1") == "1"
+# Largest upload (multipart request body) accepted, in bytes
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(FETCH_MAX_BYTES)))
+# Upload bytes one API server process may hold at once, see UploadLimitMiddleware
+UPLOAD_MEMORY_BUDGET = int(
+    os.environ.get("UPLOAD_MEMORY_BUDGET", str(8 * UPLOAD_MAX_BYTES))
+)
+# Largest image decoded, in pixels after any reduced decoding
+IMAGE_MAX_PIXELS = int(os.environ.get("IMAGE_MAX_PIXELS", str(50_000_000)))
+# Pixels a worker process may hold decoded at once, see load_image
+DECODE_PIXEL_BUDGET = int(os.environ.get("DECODE_PIXEL_BUDGET", str(200_000_000)))
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -13,16 +34,95 @@ logging.basicConfig(
 )
 
 
-def decode_request(request) -> Image.Image | None:
+class UploadLimitMiddleware:
     """
-    Decodes an incoming request to extract an image.
+    Refuses multipart (upload) request bodies over ``max_bytes`` with a 413 as
+    soon as their declared length or the bytes received so far cross it, so
+    an oversized upload is never buffered in full. Other bodies pass as is.
+
+    Uploads are held in memory until their request completes: litserve turns
+    off Starlette's spooling to disk so that forms can be pickled onto the
+    worker queues, and the workers need the encoded bytes to decode and hash
+    them anyway. So that concurrent uploads cannot exhaust memory, uploads
+    that would take this process over ``budget`` bytes in flight (counting
+    the declared or received length) are refused with a 429 and Retry-After.
+    """
+
+    def __init__(self, app, max_bytes: int, budget: int = UPLOAD_MEMORY_BUDGET):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.budget = budget
+        # Requests of a process share one event loop, so no lock is needed
+        self.in_flight = 0
+
+    def over_budget(self, extra: int) -> bool:
+        # A lone upload is always admitted, whatever the budget
+        return self.in_flight > 0 and self.in_flight + extra > self.budget
+
+    async def __call__(self, scope, receive, send):
+        headers = dict(scope.get("headers") or ())
+        content_type = headers.get(b"content-type", b"")
+        if scope["type"] != "http" or not content_type.startswith(b"multipart/"):
+            await self.app(scope, receive, send)
+            return
+        detail = f"Uploads are limited to {self.max_bytes} bytes."
+        declared = headers.get(b"content-length", b"")
+        if declared.isdigit() and int(declared) > self.max_bytes:
+            response = JSONResponse(status_code=413, content={"detail": detail})
+            await response(scope, receive, send)
+            return
+        busy = "Too many uploads in progress, retry later."
+        retry = {"Retry-After": str(QUEUE_RETRY_AFTER)}
+        held = int(declared) if declared.isdigit() else 0
+        if self.over_budget(held):
+            response = JSONResponse(
+                status_code=429, content={"detail": busy}, headers=retry
+            )
+            await response(scope, receive, send)
+            return
+        self.in_flight += held
+        received = 0
+
+        async def limited_receive():
+            nonlocal received, held
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.max_bytes:
+                raise HTTPException(status_code=413, detail=detail)
+            if received > held:
+                # No or a wrong declared length: count the bytes as they come
+                if self.over_budget(received - held):
+                    raise HTTPException(status_code=429, detail=busy, headers=retry)
+                self.in_flight += received - held
+                held = received
+            return message
+
+        try:
+            await self.app(scope, limited_receive, send)
+        finally:
+            self.in_flight -= held
+
+
+def register_upload_limit(
+    server, max_bytes: int = UPLOAD_MAX_BYTES, budget: int = UPLOAD_MEMORY_BUDGET
+):
+    """
+    Cap the size of uploads to ``server`` and the upload bytes each of its
+    API server processes holds at once. Call before server.run().
+    """
+    server.app.add_middleware(UploadLimitMiddleware, max_bytes=max_bytes, budget=budget)
+
+
+def read_content(request) -> bytes | str | None:
+    """
+    Reads the image reference from an incoming request without fetching URLs.
 
     Args:
         request: The incoming request object. Expected to have a "content" key
                  which can be a URL string or a file-like object from an upload.
 
     Returns:
-        An PIL.Image.Image object if successful, None otherwise.
+        The uploaded file bytes, the URL string to fetch, or None on failure.
     """
     file_content = request.get("content")
 
@@ -31,28 +131,20 @@ def decode_request(request) -> Image.Image | None:
         return None
 
     if isinstance(file_content, str) and "http" in file_content:
-        # Handle URL input
-        url = file_content.replace("localhost:3210", "backend:3210")  # HACK
-        try:
-            response = requests.get(url, stream=True)
-            response.raise_for_status()  # Raise an exception for bad status codes
-            image = Image.open(BytesIO(response.content))
-            logger.debug("Successfully processed URL input.")
-            return image
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to fetch image from URL {url}: {e}")
-            return None
-        except IOError as e:
-            logger.error(f"Failed to open image from URL {url} content: {e}")
-            return None
+        # URLs are fetched later so that a whole batch can be fetched at once
+        return file_content
     elif hasattr(file_content, "file") and not isinstance(file_content, str):
         try:
             # We've narrowed the type, so file_content.file is now more safely accessed
             # The linter knows if we reach here, it's not a str.
-            file_bytes = file_content.file.read()
-            image = Image.open(BytesIO(file_bytes))
-            logger.debug("Successfully processed file input.")
-            return image
+            file_bytes = file_content.file.read(UPLOAD_MAX_BYTES + 1)
+            if len(file_bytes) > UPLOAD_MAX_BYTES:
+                logger.warning(
+                    f"Upload exceeds the {UPLOAD_MAX_BYTES} byte limit, ignoring it."
+                )
+                return None
+            logger.debug("Successfully read file input.")
+            return file_bytes
         except (
             AttributeError
         ):  # Keep this for robustness in case file_content.file isn't callable
@@ -60,9 +152,6 @@ def decode_request(request) -> Image.Image | None:
                 "Failed to access 'file' attribute or 'read' method from file_content."
             )
             return None
-        except IOError as e:
-            logger.error(f"Failed to open image from file content: {e}")
-            return None
         finally:
             # Ensure the file handle is closed if it's an upload object
             if hasattr(file_content.file, "close"):
@@ -74,3 +163,180 @@ def decode_request(request) -> Image.Image | None:
             "Expected a URL string or a file upload object."
         )
         return None
+
+
+def resolve_contents(contents: list[bytes | str]) -> list[bytes | None]:
+    """
+    Replaces every URL in ``contents`` with its downloaded bytes, fetching all
+    of them concurrently. Failed fetches become None.
+    """
+    urls = [c for c in contents if isinstance(c, str)]
+    fetched = iter(get_fetcher().fetch_all(urls))
+    return [next(fetched) if isinstance(c, str) else c for c in contents]
+
+
+def fetch_content(request) -> bytes | None:
+    """
+    Reads the raw (still encoded) image bytes from an incoming request,
+    downloading them first if the request holds a URL.
+    """
+    content = read_content(request)
+    if content is None:
+        return None
+    return resolve_contents([content])[0]
+
+
+def reduce_on_decode(image: Image.Image, min_edge: int, edge: str = "short"):
+    """
+    Ask the codec to decode ``image`` at the lowest resolution that keeps its
+    short (or long) edge at least ``min_edge`` pixels. Must be called before
+    the image is loaded. JPEG decodes at 1/2, 1/4 or 1/8 scale via DCT scaling;
+    formats without reduced decoding are left untouched.
+    """
+    width, height = image.size
+    reference = min(width, height) if edge == "short" else max(width, height)
+    if reference <= min_edge:
+        return
+    factor = reference / min_edge
+    requested = (math.ceil(width / factor), math.ceil(height / factor))
+    if image.draft(None, requested) is not None:
+        logger.debug(f"Decoding {(width, height)} image at {image.size}.")
+
+
+def decoded_pixels(image: Image.Image) -> int:
+    """Pixels that loading ``image`` decodes, after any reduce_on_decode."""
+    width, height = image.size
+    return width * height
+
+
+class PixelBudget:
+    """
+    Caps the decoded pixels held at once by one process. An image counts from
+    its decode until it is garbage collected. An image larger than the whole
+    budget still gets it all, alone.
+    """
+
+    def __init__(self, pixels: int):
+        self.pixels = pixels
+        self.in_flight = 0
+        # Reentrant: garbage collection may release an image at any point
+        self.condition = threading.Condition(threading.RLock())
+        self.held: dict[int, int] = {}
+
+    def acquire(self, image: Image.Image, wait: bool = False):
+        """
+        Count ``image`` in, once. Waits for other threads to release theirs
+        with ``wait``, else raises ValueError if the budget is used up.
+        """
+        if id(image) in self.held:
+            return
+        pixels = decoded_pixels(image)
+
+        def fits():
+            return self.in_flight == 0 or self.in_flight + pixels <= self.pixels
+
+        with self.condition:
+            if wait:
+                self.condition.wait_for(fits)
+            elif not fits():
+                raise ValueError(
+                    f"Not enough decode budget left for a {image.size} image, "
+                    "retry later."
+                )
+            self.in_flight += pixels
+            self.held[id(image)] = pixels
+        weakref.finalize(image, self.release, id(image))
+
+    def release(self, key: int):
+        with self.condition:
+            self.in_flight -= self.held.pop(key)
+            self.condition.notify_all()
+
+
+_decode_budget = PixelBudget(DECODE_PIXEL_BUDGET)
+
+
+def load_image(image: Image.Image, wait: bool = False) -> Image.Image:
+    """
+    Decode the pixels of an image from open_image within this process's
+    DECODE_PIXEL_BUDGET (see PixelBudget.acquire). Raises ValueError if the
+    budget is used up and OSError if the image data is broken.
+    """
+    _decode_budget.acquire(image, wait)
+    image.load()
+    return image
+
+
+def open_image(
+    file_bytes: bytes,
+    min_edge: int | Callable[[tuple[int, int]], int] | None = None,
+    edge: str = "short",
+) -> Image.Image | None:
+    """
+    Opens already-fetched image bytes, returning None if they are not an image
+    or would decode to more than IMAGE_MAX_PIXELS. Only the header is read:
+    the pixels are decoded when the image is first used.
+
+    Args:
+        file_bytes: The encoded image.
+        min_edge: If set (and REDUCED_DECODE is on), allow decoding at a lower
+                  resolution as long as the ``edge`` side keeps this many pixels.
+                  May be a function of the full (width, height) returning it.
+        edge: "short" or "long", the side that ``min_edge`` applies to.
+    """
+    try:
+        image = Image.open(BytesIO(file_bytes))
+        if callable(min_edge):
+            min_edge = min_edge(image.size)
+        if min_edge and REDUCED_DECODE:
+            reduce_on_decode(image, min_edge, edge)
+        if decoded_pixels(image) > IMAGE_MAX_PIXELS:
+            logger.error(
+                f"Refusing to decode a {image.size} image, over the "
+                f"{IMAGE_MAX_PIXELS} pixel limit."
+            )
+            return None
+        return image
+    except Image.DecompressionBombError as e:
+        # PIL's own check, on the full size: over twice Image.MAX_IMAGE_PIXELS
+        logger.error(f"Refusing to decode image: {e}")
+        return None
+    except IOError as e:
+        logger.error(f"Failed to open image from content: {e}")
+        return None
+
+
+def decode_request(request) -> Image.Image | None:
+    """
+    Decodes an incoming request to extract an image.
+
+    Args:
+        request: The incoming request object. Expected to have a "content" key
+                 which can be a URL string or a file-like object from an upload.
+
+    Returns:
+        An PIL.Image.Image object if successful, None otherwise.
+    """
+    file_bytes = fetch_content(request)
+    if file_bytes is None:
+        return None
+    return open_image(file_bytes)
+
+
+def embedding_response(embeddings: np.ndarray, request_format: dict):
+    """
+    Encodes full-size embeddings in the dimension, normalization, dtype and
+    encoding the client asked for (see api_formats). Invalid values become a
+    400 for this request only.
+    """
+    try:
+        dtype, encoding = parse_format(request_format)
+        dimension, normalize = parse_matryoshka(request_format, embeddings.shape[-1])
+    except (TypeError, ValueError) as e:
+        return JSONResponse(status_code=400, content={"detail": str(e)})
+    embeddings = matryoshka(embeddings, dimension, normalize)
+    encoded = encode_embeddings(embeddings, dtype, encoding)
+    if encoding == "raw":
+        body, headers = encoded
+        return Response(content=body, headers=headers)
+    return encoded
@@ -0,0 +1,402 @@
+"""
+Embed a directory or manifest of images, or a file of texts, offline.
+
+Runs the model code of the image and text endpoints directly, without a
+server, the embedding cache or warmup. For images, a process pool fetches,
+decodes, resizes and crops the next batches while the model embeds the
+current one. Embeddings go to shards of --shard-size inputs:
+OUT/embeddings-00000.npy (load with np.load(..., mmap_mode="r")), the ids of
+its rows as JSON lines in OUT/ids-00000.jsonl and inputs that failed in
+OUT/errors-00000.jsonl. OUT/manifest.json records finished shards, so
+running the same command again after an interruption resumes at the first
+unfinished one. --collection adds the full-size embeddings to a collection
+of the vector index, as the server does, whatever the --dimension.
+
+Images come from a directory (searched recursively) or a manifest file with
+one path or URL per line, optionally preceded by an id and a tab. Texts come
+from JSON lines with a "text" and an optional "id", or from plain lines.
+
+    python backfill.py images photos/ out/ --batch-size 64 --workers 8
+    python backfill.py images urls.txt out/ --collection photos
+    python backfill.py texts docs.jsonl out/ --prefix search_document
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from api_formats import DIMENSION, NORMALIZE, matryoshka
+
+SHARD_NAME = "{kind}-{shard:05d}.{ext}"
+
+# Set in each pool worker by init_worker
+_preprocessor = None
+_decode_edge = None
+
+
+def image_sources(path: str) -> list[tuple[str, str]]:
+    """(id, path or URL) of every image in a directory or manifest file."""
+    if os.path.isdir(path):
+        extensions = set(Image.registered_extensions())
+        sources = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in extensions:
+                    full = os.path.join(root, name)
+                    sources.append((os.path.relpath(full, path), full))
+        return sources
+    sources = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.strip():
+                id_, _, source = line.rpartition("\t")
+                sources.append((id_ or source, source))
+    return sources
+
+
+def text_sources(path: str) -> list[tuple[str, str | None]]:
+    """
+    (id, text) of every line of a JSON lines or plain text file. The text is
+    None for records that are not JSON objects with a string "text", which
+    run_texts writes to the errors file like images that fail to decode.
+    """
+    texts = []
+    with open(path) as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+            if path.endswith(".jsonl"):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    record = None
+                if not isinstance(record, dict):
+                    texts.append((str(number), None))
+                    continue
+                text = record.get("text")
+                texts.append(
+                    (
+                        str(record.get("id", number)),
+                        text if isinstance(text, str) else None,
+                    )
+                )
+            else:
+                texts.append((str(number), line.rstrip("\n")))
+    return texts
+
+
+def init_worker(preprocessor, decode_edge: int):
+    global _preprocessor, _decode_edge
+    _preprocessor, _decode_edge = preprocessor, decode_edge
+
+
+def prepare_images(sources: list[str]):
+    """
+    Fetch, decode, resize and crop one batch in a pool worker. Returns the
+    positions in ``sources`` that succeeded, their uint8 pixels (or decoded
+    images, without the fast preprocessor) and an error per failed position.
+    """
+    from api_utils import open_image, resolve_contents
+
+    contents = []
+    for source in sources:
+        if source.startswith(("http://", "https://")):
+            contents.append(source)
+            continue
+        try:
+            with open(source, "rb") as f:
+                contents.append(f.read())
+        except OSError:
+            contents.append(None)
+
+    rows, prepared, errors = [], [], {}
+    for i, content in enumerate(resolve_contents(contents)):
+        image = None if content is None else open_image(content, _decode_edge)
+        if image is None:
+            errors[i] = "could not read an image"
+            continue
+        try:
+            if _preprocessor is not None:
+                prepared.append(_preprocessor.resize_and_crop(image))
+            else:
+                image.load()
+                prepared.append(image)
+        except (OSError, ValueError) as e:
+            errors[i] = str(e)
+            continue
+        rows.append(i)
+    if _preprocessor is not None:
+        prepared = np.stack(prepared) if prepared else None
+    return rows, prepared, errors
+
+
+def pipelined(pool, function, arguments, depth: int):
+    """
+    function(argument) for every argument, in order, keeping ``depth`` calls
+    submitted to ``pool`` ahead of the one whose result is being consumed.
+    """
+    arguments = iter(arguments)
+    futures = deque(
+        pool.submit(function, argument)
+        for argument in itertools.islice(arguments, depth)
+    )
+    while futures:
+        result = futures.popleft().result()
+        for argument in itertools.islice(arguments, 1):
+            futures.append(pool.submit(function, argument))
+        yield result
+
+
+class ShardWriter:
+    """Writes finished shards and the manifest that makes a run resumable."""
+
+    def __init__(self, path: str, config: dict, collection: str | None = None):
+        self.path = path
+        self.manifest_path = os.path.join(path, "manifest.json")
+        self.index = None
+        if collection:
+            from api_index import get_index
+
+            self.index = get_index(collection)
+        os.makedirs(path, exist_ok=True)
+        self.manifest = {"config": config, "shards": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest["config"] != config:
+                raise ValueError(
+                    f"{path} holds the output of a different run "
+                    f"({manifest['config']}), use another directory."
+                )
+            self.manifest = manifest
+
+    def file(self, kind: str, shard: int, ext: str) -> str:
+        return os.path.join(
+            self.path, SHARD_NAME.format(kind=kind, shard=shard, ext=ext)
+        )
+
+    def done(self, shard: int) -> bool:
+        return str(shard) in self.manifest["shards"] and os.path.exists(
+            self.file("embeddings", shard, "npy")
+        )
+
+    def write(self, shard, ids, embeddings, errors):
+        """
+        Save a shard of full-size ``embeddings``, truncated and normalized
+        as configured. The vector index gets them full-size, like the server
+        adds them, so both can fill the same collection.
+        """
+        if self.index is not None and ids:
+            self.index.refresh()
+            if self.index.dim not in (None, embeddings.shape[1]):
+                raise ValueError(
+                    f"Collection {os.path.basename(self.index.path)!r} holds "
+                    f"{self.index.dim}-dimensional vectors, the model returns "
+                    f"{embeddings.shape[1]}."
+                )
+        config = self.manifest["config"]
+        truncated = matryoshka(embeddings, config["dimension"], config["normalize"])
+        # Every file is complete before the manifest lists the shard
+        with open(f"{self.file('embeddings', shard, 'npy')}.tmp", "wb") as f:
+            np.save(f, truncated.astype(np.float32, copy=False))
+        self._write_lines(self.file("ids", shard, "jsonl"), ids)
+        self._write_lines(
+            self.file("errors", shard, "jsonl"),
+            [{"id": id_, "error": error} for id_, error in errors],
+        )
+        os.replace(
+            f"{self.file('embeddings', shard, 'npy')}.tmp",
+            self.file("embeddings", shard, "npy"),
+        )
+        if self.index is not None and ids:
+            # Replaces the vectors of ids added before an interruption
+            self.index.add(ids, embeddings)
+        self.manifest["shards"][str(shard)] = {"rows": len(ids), "errors": len(errors)}
+        with open(f"{self.manifest_path}.tmp", "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+
+    @staticmethod
+    def _write_lines(path, records):
+        with open(f"{path}.tmp", "w") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+        os.replace(f"{path}.tmp", path)
+
+
+def batch_tasks(items, pending_shards, shard_size, batch_size):
+    """(shard, start, end) of every batch of the unfinished shards."""
+    for shard in pending_shards:
+        end = min((shard + 1) * shard_size, len(items))
+        for start in range(shard * shard_size, end, batch_size):
+            yield shard, start, min(start + batch_size, end)
+
+
+def run_images(api, items, tasks, args):
+    """Yields (shard, ids, embeddings, errors) per batch, decoding ahead."""
+    preprocessor = api.fast_preprocessor
+    # spawn: forking after the model is loaded would copy or break its threads
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        args.workers,
+        mp_context=context,
+        initializer=init_worker,
+        initargs=(preprocessor, api.decode_edge),
+    ) as pool:
+        sources = (
+            [source for _, source in items[start:end]] for _, start, end in tasks
+        )
+        results = pipelined(pool, prepare_images, sources, depth=args.workers * 2)
+        for (shard, start, _), (rows, prepared, errors) in zip(tasks, results):
+            ids = [items[start + i][0] for i in rows]
+            failed = [(items[start + i][0], error) for i, error in errors.items()]
+            if not rows:
+                embeddings = None
+            elif preprocessor is not None:
+                embeddings = api.embed_inputs(
+                    preprocessor.normalize(prepared, api.device)
+                )
+            else:
+                embeddings = api.embed(prepared)
+            yield shard, ids, embeddings, failed
+
+
+def run_texts(api, items, tasks, args):
+    """Yields (shard, ids, embeddings, errors) per batch."""
+    prefix = args.prefix.strip()
+    if not prefix.endswith(":"):
+        prefix += ":"
+    for shard, start, end in tasks:
+        batch = [(id_, text) for id_, text in items[start:end] if text is not None]
+        failed = [
+            (id_, 'not a JSON object with a "text" string')
+            for id_, text in items[start:end]
+            if text is None
+        ]
+        embeddings = None
+        if batch:
+            embeddings = api.embed([f"{prefix} {text}" for _, text in batch])
+        yield shard, [id_ for id_, _ in batch], embeddings, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.strip().splitlines()[1:]),
+    )
+    parser.add_argument("modality", choices=("images", "texts"))
+    parser.add_argument("source", help="Directory or manifest of images, or texts")
+    parser.add_argument("output", help="Directory for the shards and the manifest")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--shard-size", type=int, default=10000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=max(1, (os.cpu_count() or 2) - 1),
+        help="Image decoding processes",
+    )
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--dimension", type=int, default=DIMENSION)
+    parser.add_argument(
+        "--normalize", action=argparse.BooleanOptionalAction, default=NORMALIZE
+    )
+    parser.add_argument(
+        "--prefix", default="search_document", help="Task prefix of the texts"
+    )
+    parser.add_argument(
+        "--collection", help="Also add the embeddings to this vector index collection"
+    )
+    args = parser.parse_args()
+
+    if args.modality == "images":
+        items = image_sources(args.source)
+    else:
+        items = text_sources(args.source)
+    ids_digest = hashlib.sha1()
+    for id_, _ in items:
+        ids_digest.update(f"{id_}\n".encode())
+    # Shard boundaries depend on all of these: resuming needs them unchanged
+    config = {
+        "modality": args.modality,
+        "inputs": len(items),
+        "ids_sha1": ids_digest.hexdigest(),
+        "shard_size": args.shard_size,
+        "dimension": args.dimension,
+        "normalize": args.normalize,
+    }
+    if args.modality == "texts":
+        config["prefix"] = args.prefix
+    try:
+        writer = ShardWriter(args.output, config, args.collection)
+    except ValueError as e:
+        sys.exit(str(e))
+    shards = range((len(items) + args.shard_size - 1) // args.shard_size)
+    pending = [shard for shard in shards if not writer.done(shard)]
+    print(
+        f"{len(items)} {args.modality} in {len(shards)} shards, "
+        f"{len(shards) - len(pending)} already done."
+    )
+    if not pending:
+        return
+
+    # As benchmark.py does for the server: measure and run the model only
+    os.environ.update({"CACHE_SIZE": "0", "CACHE_DIR": "", "WARMUP_BATCH_SIZES": ""})
+    for name in ("WARMUP_BATCH_SIZES_IMG_EMBED", "WARMUP_BATCH_SIZES_TXT_EMBED"):
+        os.environ.pop(name, None)
+    if args.modality == "images":
+        from api_embed import NomicVisionAPI
+
+        api = NomicVisionAPI(max_batch_size=args.batch_size, api_path="/img/embed")
+        run = run_images
+    else:
+        from api_text import NomicTextAPI
+
+        api = NomicTextAPI(max_batch_size=args.batch_size, api_path="/txt/embed")
+        run = run_texts
+    api.setup(args.device)
+
+    tasks = list(batch_tasks(items, pending, args.shard_size, args.batch_size))
+    started = time.perf_counter()
+    count = 0
+    for shard, batches in itertools.groupby(
+        run(api, items, tasks, args), key=lambda batch: batch[0]
+    ):
+        shard_ids, shard_embeddings, shard_errors = [], [], []
+        for _, ids, embeddings, errors in batches:
+            shard_ids += ids
+            shard_errors += errors
+            if embeddings is not None:
+                shard_embeddings.append(embeddings)
+        embeddings = (
+            np.concatenate(shard_embeddings)
+            if shard_embeddings
+            else np.empty((0, args.dimension), np.float32)
+        )
+        try:
+            writer.write(shard, shard_ids, embeddings, shard_errors)
+        except ValueError as e:
+            sys.exit(str(e))
+        count += len(shard_ids) + len(shard_errors)
+        print(
+            f"shard {shard}: {len(shard_ids)} embedded, {len(shard_errors)} failed "
+            f"({count / (time.perf_counter() - started):.1f} inputs/s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+"""
+Load test /img/embed, /txt/embed and /img/stats and write the results as JSON.
+
+Runs against a server that is already up (--url), or starts server.py once
+per configuration of a sweep over its environment variables. --stub starts
+it with STUB_MODELS=1, so queueing, batching and serialization overhead can
+be measured offline without model weights.
+
+Load is either closed-loop (--concurrency clients sending back to back) or
+open-loop (--rate requests/s with Poisson arrivals, latency measured from
+the scheduled send time so a slow server is not hidden by a slow client).
+An "@bulk" suffix in --mix sends that share with the bulk priority, to
+measure interactive latency next to a backfill; refused requests (429) are
+counted as "shed".
+
+    python benchmark.py --url http://127.0.0.1:8000 --concurrency 16
+    python benchmark.py --stub --rate 100 --mix img/embed=1,txt/embed=3 \\
+        --sweep IMAGE_MAX_BATCH_SIZE=8,32 --sweep WORKERS_PER_DEVICE=1,2
+    python benchmark.py --stub --concurrency 64 --mix txt/embed=1,txt/embed@bulk=8
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime
+
+import numpy as np
+import requests
+from PIL import Image
+
+ENDPOINTS = ("img/embed", "txt/embed", "img/stats")
+PRIORITIES = ("interactive", "bulk")
+WORDS = [
+    "a", "photo", "of", "the", "red", "blue", "small", "large", "dog", "cat",
+    "car", "house", "tree", "river", "city", "mountain", "person", "food",
+    "street", "night", "beach", "snow", "old", "new", "with", "on", "in", "near",
+]  # fmt: skip
+
+
+class Payloads:
+    """Seeded request bodies for every endpoint, unique per request."""
+
+    def __init__(self, seed: int, image_pool: int, image_size: int, repeat: bool):
+        self.rng = np.random.default_rng(seed)
+        self.repeat = repeat
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.images = [self.make_image(image_size) for _ in range(image_pool)]
+
+    def make_image(self, size: int) -> bytes:
+        height, width = self.rng.integers(size // 2, size, endpoint=True, size=2)
+        y, x = np.mgrid[0:height, 0:width]
+        freq = self.rng.uniform(5, 60, size=3)
+        pixels = np.stack(
+            [128 + 100 * np.sin((x + y * c) / freq[c]) for c in range(3)], axis=-1
+        )
+        pixels += self.rng.normal(0, 10, pixels.shape)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(
+            buffer, format="JPEG", quality=90
+        )
+        return buffer.getvalue()
+
+    def next(self, endpoint: str) -> dict:
+        """Keyword arguments for requests.post."""
+        endpoint, _, priority = endpoint.partition("@")
+        with self.lock:
+            n = next(self.counter)
+            words = self.rng.choice(WORDS, self.rng.integers(3, 60))
+        if endpoint == "txt/embed":
+            text = " ".join(words)
+            body = {"input": text if self.repeat else f"{n} {text}"}
+            return {"json": {**body, "priority": priority} if priority else body}
+        image = self.images[n % len(self.images)]
+        if not self.repeat:
+            # Bytes after the JPEG end marker are ignored by decoders but
+            # change the content hash, so every request misses the cache
+            image += n.to_bytes(8, "little")
+        files = {"content": ("image.jpg", image, "image/jpeg")}
+        return {"files": files, "data": {"priority": priority} if priority else {}}
+
+
+def parse_mix(spec: str) -> dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        endpoint, _, weight = part.partition("=")
+        endpoint = endpoint.strip().strip("/")
+        path, _, priority = endpoint.partition("@")
+        if path not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint {path!r}, expected {ENDPOINTS}.")
+        if priority and priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority!r}, expected {PRIORITIES}.")
+        mix[endpoint] = float(weight or 1)
+    return mix
+
+
+def parse_sweep(specs: list[str]) -> list[dict[str, str]]:
+    """["A=1,2", "B=x"] -> [{"A": "1", "B": "x"}, {"A": "2", "B": "x"}]"""
+    axes = []
+    for spec in specs:
+        name, _, values = spec.partition("=")
+        axes.append([(name.strip(), v.strip()) for v in values.split(",")])
+    return [dict(combo) for combo in itertools.product(*axes)]
+
+
+def percentiles(latencies: list[float]) -> dict:
+    if not latencies:
+        return {}
+    ms = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "mean_ms": round(float(ms.mean()), 2),
+        "max_ms": round(float(ms.max()), 2),
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []  # (endpoint, latency_s, ok, response bytes, shed)
+
+    def add(self, endpoint: str, latency: float, ok: bool, size: int, shed=False):
+        with self.lock:
+            self.samples.append((endpoint, latency, ok, size, shed))
+
+    def summary(self, elapsed: float) -> dict:
+        groups = {"all": self.samples}
+        for sample in self.samples:
+            groups.setdefault(sample[0], []).append(sample)
+        results = {}
+        for name, samples in groups.items():
+            ok = [s for s in samples if s[2]]
+            results[name] = {
+                "requests": len(samples),
+                "errors": len(samples) - len(ok),
+                "error_rate": round(1 - len(ok) / len(samples), 4) if samples else 0,
+                "shed": sum(1 for s in samples if s[4]),
+                "throughput_rps": round(len(ok) / elapsed, 2),
+                "response_bytes_mean": (
+                    round(float(np.mean([s[3] for s in ok])), 1) if ok else 0
+                ),
+                **percentiles([s[1] for s in ok]),
+            }
+        return results
+
+
+def send(session, url, endpoint, payloads, recorder, scheduled=None, timeout=60):
+    kwargs = payloads.next(endpoint)
+    start = time.perf_counter() if scheduled is None else scheduled
+    path = endpoint.partition("@")[0]
+    try:
+        response = session.post(f"{url}/{path}", timeout=timeout, **kwargs)
+        ok, size = response.ok, len(response.content)
+        shed = response.status_code == 429
+    except requests.RequestException:
+        ok, size, shed = False, 0, False
+    recorder.add(endpoint, time.perf_counter() - start, ok, size, shed)
+
+
+def run_load(url, mix, payloads, args, duration) -> dict:
+    """Drive ``url`` for ``duration`` seconds and return the summary."""
+    endpoints = list(mix)
+    weights = np.array(list(mix.values())) / sum(mix.values())
+    rng = np.random.default_rng(args.seed)
+    recorder = Recorder()
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    start = time.perf_counter()
+    deadline = start + duration
+    if args.rate:
+        # Open loop: sends follow the arrival schedule, whatever the latency
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            scheduled = start
+            while True:
+                scheduled += rng.exponential(1 / args.rate)
+                if scheduled >= deadline:
+                    break
+                time.sleep(max(0.0, scheduled - time.perf_counter()))
+                endpoint = endpoints[rng.choice(len(endpoints), p=weights)]
+                pool.submit(
+                    lambda e=endpoint, t=scheduled: send(
+                        session(), url, e, payloads, recorder, t, args.timeout
+                    )
+                )
+    else:
+        # Closed loop: each client sends its next request when one completes
+        choices = rng.choice(len(endpoints), size=1_000_000, p=weights)
+        counter = itertools.count()
+
+        def client():
+            while time.perf_counter() < deadline:
+                endpoint = endpoints[choices[next(counter) % len(choices)]]
+                send(session(), url, endpoint, payloads, recorder, None, args.timeout)
+
+        threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return recorder.summary(time.perf_counter() - start)
+
+
+def wait_ready(url, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}.")
+        try:
+            if requests.get(f"{url}/health", timeout=1).text.strip('"') == "ok":
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"Server not ready after {timeout}s.")
+
+
+def start_server(config: dict[str, str], args):
+    env = {
+        **os.environ,
+        # Measure the model path, not the embedding cache
+        "CACHE_SIZE": "0",
+        "CACHE_DIR": "",
+        "PORT": str(args.port),
+        "LOG_LEVEL": "WARNING",
+        **({"STUB_MODELS": "1"} if args.stub else {}),
+        **config,
+    }
+    # The server keeps its own copy of the log file descriptor
+    with open(args.server_log or os.devnull, "ab") as log:
+        # A session of its own, so the workers it spawns are stopped with it
+        return subprocess.Popen(
+            [sys.executable, args.server_script],
+            env=env,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+        )
+
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(config, results):
+    label = " ".join(f"{k}={v}" for k, v in config.items()) or "(defaults)"
+    print(label, file=sys.stderr)
+    for name, r in results.items():
+        print(
+            f"  {name:<16} {r['requests']:>6} req  {r['throughput_rps']:>8.1f} req/s"
+            f"  err {r['error_rate']:.2%} (shed {r['shed']})"
+            f"  p50 {r.get('p50_ms', 0):>7.1f}"
+            f"  p95 {r.get('p95_ms', 0):>7.1f}  p99 {r.get('p99_ms', 0):>7.1f} ms",
+            file=sys.stderr,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.strip().splitlines()[1:]),
+    )
+    parser.add_argument("--url", help="Benchmark this server instead of starting one")
+    parser.add_argument("--stub", action="store_true", help="Start with STUB_MODELS=1")
+    parser.add_argument(
+        "--sweep",
+        action="append",
+        default=[],
+        metavar="VAR=V1,V2",
+        help="Server environment values to sweep (repeatable, all combinations)",
+    )
+    parser.add_argument("--mix", default="img/embed=1,txt/embed=1,img/stats=1")
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="Clients, or max in flight"
+    )
+    parser.add_argument("--rate", type=float, help="Open-loop arrival rate (req/s)")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds per run")
+    parser.add_argument("--warmup", type=float, default=5, help="Unrecorded seconds")
+    parser.add_argument("--timeout", type=float, default=60, help="Request timeout")
+    parser.add_argument("--image-size", type=int, default=512, help="Max image edge")
+    parser.add_argument("--image-pool", type=int, default=32)
+    parser.add_argument(
+        "--repeat", action="store_true", help="Allow cache hits (identical payloads)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--server-script", default="server.py", help="Server to start")
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--server-log", help="Append server output to this file")
+    parser.add_argument(
+        "--output",
+        default=f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json",
+        help="JSON results file",
+    )
+    args = parser.parse_args()
+    if args.url and (args.sweep or args.stub):
+        parser.error("--sweep and --stub start their own server, drop --url")
+
+    mix = parse_mix(args.mix)
+    payloads = Payloads(args.seed, args.image_pool, args.image_size, args.repeat)
+    configs = parse_sweep(args.sweep) if args.sweep else [{}]
+
+    report = {
+        "started": datetime.now(UTC).isoformat(),
+        "git_commit": git_commit(),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "args": vars(args),
+        "runs": [],
+    }
+    for config in configs:
+        process = None
+        url = (args.url or f"http://127.0.0.1:{args.port}").rstrip("/")
+        try:
+            if not args.url:
+                process = start_server(config, args)
+                wait_ready(url, process, args.startup_timeout)
+            if args.warmup > 0:
+                run_load(url, mix, payloads, args, args.warmup)
+            results = run_load(url, mix, payloads, args, args.duration)
+        except (RuntimeError, TimeoutError) as e:
+            print(f"{config}: {e}", file=sys.stderr)
+            report["runs"].append({"config": config, "error": str(e)})
+            continue
+        finally:
+            if process is not None:
+                stop_server(process)
+        print_summary(config, results)
+        report["runs"].append({"config": config, "results": results})
+        # Rewritten after every run, so a long sweep keeps partial results
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Check that one bad image fails only its own request, not its whole batch.
+
+Runs the image endpoint's batch(), predict() and encode_response() on a
+batch that mixes valid images with an upload that is not an image, a
+truncated JPEG and a URL that cannot be fetched, with and without the
+preprocessing pipeline, and checks that exactly the bad requests get a
+400. Uses the stub models, so it needs no weights or network.
+
+    python check_batch_errors.py
+"""
+
+import argparse
+import io
+import os
+import sys
+
+os.environ.update(
+    {"STUB_MODELS": "1", "CACHE_SIZE": "0", "CACHE_DIR": "", "WARMUP_BATCH_SIZES": ""}
+)
+
+import numpy as np  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from api_embed import NomicVisionAPI  # noqa: E402
+from api_preprocess import PreprocessPipeline  # noqa: E402
+
+
+def encoded(width, height, seed):
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3))
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.astype(np.uint8)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def requests_batch():
+    """(name, content, whether it should succeed) of one mixed batch."""
+    valid = [encoded(320, 240, seed) for seed in range(3)]
+    return [
+        ("valid 0", valid[0], True),
+        ("not an image", b"garbage", False),
+        ("valid 1", valid[1], True),
+        ("truncated jpeg", valid[2][: len(valid[2]) // 3], False),
+        # Nothing listens on the discard port: the fetch fails at once
+        ("unreachable url", "http://127.0.0.1:9/image.jpg", False),
+        ("valid 0 again", valid[0], True),
+    ]
+
+
+def check(api, batch) -> list[str]:
+    """The names of the requests of ``batch`` that got the wrong status."""
+    items = api.batch([content for _, content, _ in batch])
+    outputs = api.predict(items)
+    wrong = []
+    for (name, _, ok), output in zip(batch, outputs):
+        response = api.encode_response(output, {"format": {}, "index": {}})
+        status = response.status_code if isinstance(response, JSONResponse) else 200
+        print(f"  {name:<18}{status:>5}")
+        if (status == 200) != ok:
+            wrong.append(name)
+    return wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.strip().splitlines()[1:]),
+    )
+    parser.add_argument("--micro-batch", type=int, default=2)
+    args = parser.parse_args()
+
+    api = NomicVisionAPI(max_batch_size=8, api_path="/img/embed")
+    api.setup("cpu")
+    pipeline = PreprocessPipeline(
+        api.fast_preprocessor, args.micro_batch, 2, opener=api.load_content
+    )
+    wrong = []
+    for name, api.pipeline in (("sequential", None), ("pipelined", pipeline)):
+        print(name)
+        wrong += [f"{name} {request}" for request in check(api, requests_batch())]
+    if wrong:
+        sys.exit(f"Wrong status for: {', '.join(wrong)}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compare the reduced-resolution decode path against a full decode.
+
+For every image, both paths are resized to the size the consumer actually
+uses and compared pixel by pixel, and both decodes are timed.
+
+    python check_decode.py photo1.jpg photo2.webp --edge 224
+    python check_decode.py photo1.jpg --edge 512 --long
+"""
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from api_utils import reduce_on_decode
+
+
+def decode(path, min_edge=None, edge="short"):
+    image = Image.open(path)
+    if min_edge:
+        reduce_on_decode(image, min_edge, edge)
+    start = time.perf_counter()
+    image.load()
+    return image.convert("RGB"), time.perf_counter() - start
+
+
+def resize_to(image, min_edge, edge):
+    width, height = image.size
+    reference = min(width, height) if edge == "short" else max(width, height)
+    scale = min_edge / reference
+    if scale >= 1:
+        return image
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(size, Image.Resampling.BICUBIC)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--edge", type=int, default=224, help="target edge size")
+    parser.add_argument(
+        "--long", action="store_true", help="target the long edge (stats path)"
+    )
+    args = parser.parse_args()
+    edge = "long" if args.long else "short"
+
+    for path in args.images:
+        full, full_time = decode(path)
+        reduced, reduced_time = decode(path, args.edge, edge)
+        a = np.asarray(resize_to(full, args.edge, edge), dtype=float)
+        # Rounding can leave the two thumbnails a pixel apart in size
+        b = resize_to(reduced, args.edge, edge).resize((a.shape[1], a.shape[0]))
+        b = np.asarray(b, dtype=float)
+        mse = ((a - b) ** 2).mean()
+        psnr = float("inf") if mse == 0 else 10 * np.log10(255.0**2 / mse)
+        print(
+            f"{path}: decoded {full.size} -> {reduced.size}, "
+            f"{full_time * 1000:.1f}ms -> {reduced_time * 1000:.1f}ms, "
+            f"mean abs diff {np.abs(a - b).mean():.2f}, PSNR {psnr:.1f}dB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Check the URL fetcher against a local HTTP server.
+
+Serves an image, a slow response, oversized bodies (with and without a
+Content-Length) and a 404 from a local http.server, and checks that
+Fetcher returns the image over pooled keep-alive connections, gives up on
+the others within its timeout and byte limit, and rewrites the default
+localhost:3210 host to backend:3210. Needs no network.
+
+    python check_fetch.py
+"""
+
+import argparse
+import io
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+from api_fetch import Fetcher
+
+READ_TIMEOUT = 0.5
+MAX_BYTES = 256 * 1024
+
+
+def encoded_image() -> bytes:
+    pixels = np.random.default_rng(0).integers(0, 256, (48, 64, 3), np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+IMAGE = encoded_image()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Keep-alive, so that pooled connections can be reused
+    protocol_version = "HTTP/1.1"
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body: bytes, length: bool = True):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        if length:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        # Chunked, so only the bytes received tell the size
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for start in range(0, len(body), 64 * 1024):
+            chunk = body[start : start + 64 * 1024]
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_GET(self):
+        if self.path == "/image.png":
+            self.send_body(IMAGE)
+        elif self.path == "/slow.png":
+            time.sleep(READ_TIMEOUT * 4)
+            self.send_body(IMAGE)
+        elif self.path == "/large.png":
+            self.send_body(bytes(MAX_BYTES + 1))
+        elif self.path == "/large-chunked.png":
+            self.send_body(bytes(MAX_BYTES * 2), length=False)
+        else:
+            self.send_error(404)
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # the fetcher hangs up on oversized bodies on purpose
+
+
+def check(name: str, passed: bool, detail: str = "") -> bool:
+    print(f"  {name:<34}{'ok' if passed else 'FAILED'} {detail}".rstrip())
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.strip().splitlines()[1:]),
+    )
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f"127.0.0.1:{server.server_address[1]}"
+    fetcher = Fetcher(
+        read_timeout=READ_TIMEOUT,
+        max_bytes=MAX_BYTES,
+        concurrency=args.concurrency,
+        host_rewrites={"localhost:3210": host},
+    )
+    results = []
+
+    urls = [f"http://{host}/image.png"] * (args.concurrency * 4)
+    fetched = fetcher.fetch_all(urls)
+    results.append(check("concurrent fetches", all(body == IMAGE for body in fetched)))
+    for _ in range(8):
+        fetcher.fetch(urls[0])
+    results.append(
+        check(
+            "pooled connections",
+            Handler.connections <= args.concurrency,
+            f"({Handler.connections} for {len(urls) + 8} requests)",
+        )
+    )
+
+    for name, path in (
+        ("slow response", "/slow.png"),
+        ("oversized body", "/large.png"),
+        ("oversized chunked body", "/large-chunked.png"),
+        ("404", "/missing.png"),
+    ):
+        start = time.perf_counter()
+        body = fetcher.fetch_all([f"http://{host}{path}"])[0]
+        elapsed = time.perf_counter() - start
+        results.append(
+            check(
+                name,
+                body is None and elapsed < READ_TIMEOUT * 3,
+                f"({elapsed:.2f}s)",
+            )
+        )
+
+    mixed = fetcher.fetch_all(
+        [f"http://{host}/missing.png", urls[0], f"http://{host}/large.png"]
+    )
+    results.append(check("failures keep their positions", mixed == [None, IMAGE, None]))
+    results.append(
+        check(
+            "rewritten host",
+            fetcher.fetch("http://localhost:3210/image.png") == IMAGE,
+        )
+    )
+    results.append(
+        check(
+            "default rewrite",
+            Fetcher().rewrite("http://localhost:3210/a.png")
+            == "http://backend:3210/a.png",
+        )
+    )
+    server.shutdown()
+    if not all(results):
+        sys.exit("The fetcher failed some checks.")
+
+
+if __name__ == "__main__":
+    main()
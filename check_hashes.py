@@ -0,0 +1,116 @@
+"""
+Measure perceptual hash robustness and Hamming index lookup latency.
+
+For every image (random smooth images unless files are given), prints the
+hash distances of its re-encodes and resizes, which should be near-duplicates,
+and the smallest distance to any other image, which should not. Then fills
+a HammingIndex with random hashes at each --sizes and prints per-lookup
+latency percentiles.
+
+    python check_hashes.py --sizes 10000,100000,1000000
+    python check_hashes.py photo1.jpg photo2.png
+"""
+
+import argparse
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+from api_hashes import HASH_MAX_DISTANCE, HammingIndex, perceptual_hashes
+from api_stats import resize_for_processing
+
+
+def random_images(count, rng):
+    small = rng.integers(0, 256, (count, 12, 16, 3), np.uint8)
+    return [
+        Image.fromarray(pixels).resize((1024, 768), Image.BICUBIC) for pixels in small
+    ]
+
+
+def variants(image):
+    """Re-encoded and resized copies of ``image``, by name."""
+    result = {}
+    for quality in (90, 50):
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=quality)
+        result[f"jpeg q{quality}"] = Image.open(io.BytesIO(buffer.getvalue()))
+    for scale in (0.5, 0.25):
+        size = (int(image.width * scale), int(image.height * scale))
+        result[f"resize {scale}"] = image.resize(size, Image.LANCZOS)
+    return result
+
+
+def distance(a, b) -> int:
+    return max(
+        (int(a[name], 16) ^ int(b[name], 16)).bit_count() for name in ("dhash", "phash")
+    )
+
+
+def check_robustness(images):
+    hashes = [perceptual_hashes(resize_for_processing(image)) for image in images]
+    names = list(variants(images[0]))
+    print(f"{'image':<8}" + "".join(f"{name:>12}" for name in names) + f"{'other':>12}")
+    for i, image in enumerate(images):
+        copies = variants(image)
+        row = [
+            distance(hashes[i], perceptual_hashes(resize_for_processing(copies[name])))
+            for name in names
+        ]
+        other = min(distance(hashes[i], h) for j, h in enumerate(hashes) if j != i)
+        print(f"{i:<8}" + "".join(f"{d:>12}" for d in row) + f"{other:>12}")
+
+
+def check_latency(sizes, queries, rng):
+    print(f"\n{'index size':<14}{'p50 ms':>10}{'p99 ms':>10}{'matches':>10}")
+    for size in sizes:
+        index = HammingIndex(size)
+        codes = rng.integers(0, 2**64, (size, 2), dtype=np.uint64, endpoint=False)
+        index.dhashes[:], index.phashes[:] = codes[:, 0], codes[:, 1]
+        index.ids = [str(i) for i in range(size)]
+        index.slots = {id_: i for i, id_ in enumerate(index.ids)}
+        index.count = size
+        latencies, found = [], 0
+        for row in codes[rng.integers(size, size=queries)]:
+            # A stored image with a few bits flipped, as a near-duplicate would be
+            flips = rng.choice(64, 3, replace=False)
+            query = {
+                "dhash": f"{int(row[0]) ^ sum(1 << int(b) for b in flips):016x}",
+                "phash": f"{int(row[1]):016x}",
+            }
+            start = time.perf_counter()
+            found += len(index.search(query, HASH_MAX_DISTANCE))
+            latencies.append(time.perf_counter() - start)
+        latencies = np.array(latencies) * 1000
+        print(
+            f"{size:<14}{np.percentile(latencies, 50):>10.3f}"
+            f"{np.percentile(latencies, 99):>10.3f}{found / queries:>10.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.strip().splitlines()[1:]),
+    )
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--count", type=int, default=8, help="Random images")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.images:
+        images = [Image.open(path).convert("RGB") for path in args.images]
+    else:
+        images = random_images(args.count, rng)
+    if len(images) > 1:
+        check_robustness(images)
+    check_latency([int(n) for n in args.sizes.split(",")], args.queries, rng)
+
+
+if __name__ == "__main__":
+    main()
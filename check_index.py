@@ -0,0 +1,110 @@
+"""
+Measure recall and latency of the vector index, exact search against IVF.
+
+Fills a temporary collection with clustered random unit vectors (or the
+rows of --vectors, a .npy file of embeddings), then runs every query with
+exact search, which also gives the true neighbours, and with IVF at each
+--nprobe. Prints recall@k and per-query latency percentiles.
+
+    python check_index.py --size 200000 --queries 200 --nprobe 4,16,64
+"""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from api_index import VectorIndex, normalize_rows
+
+
+def clustered_vectors(count, dim, clusters, noise, rng):
+    centers = normalize_rows(rng.standard_normal((clusters, dim)))
+    labels = rng.integers(clusters, size=count)
+    offsets = rng.standard_normal((count, dim)).astype(np.float32)
+    return normalize_rows(centers[labels] + noise * offsets)
+
+
+def timed_search(index, queries, k, **kwargs):
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(index.search(query, k, **kwargs)[0])
+        latencies.append(time.perf_counter() - start)
+    return results, np.array(latencies) * 1000
+
+
+def recall(results, truth) -> float:
+    found = [
+        len({i for i, _ in r} & {i for i, _ in t}) / max(len(t), 1)
+        for r, t in zip(results, truth)
+    ]
+    return float(np.mean(found))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.strip().splitlines()[1:]),
+    )
+    parser.add_argument("--vectors", help="Index these embeddings (.npy)")
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument(
+        "--noise", type=float, default=0.06, help="Spread around cluster centers"
+    )
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--nprobe", default="4,8,16,32,64")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.vectors:
+        vectors = normalize_rows(np.load(args.vectors))
+        order = rng.permutation(len(vectors))
+        queries = vectors[order[: args.queries]]
+        vectors = vectors[order[args.queries :]]
+    else:
+        data = clustered_vectors(
+            args.size + args.queries, args.dim, args.clusters, args.noise, rng
+        )
+        vectors, queries = data[: args.size], data[args.size :]
+
+    with tempfile.TemporaryDirectory() as path:
+        # Never built in the background, so that exact search and the build
+        # time are measured separately
+        index = VectorIndex(path, ivf_threshold=len(vectors) + 1)
+        for start in range(0, len(vectors), 10000):
+            chunk = vectors[start : start + 10000]
+            index.add([str(i) for i in range(start, start + len(chunk))], chunk)
+        index.refresh()
+        print(f"{len(index)} vectors of dimension {index.dim}, k={args.k}")
+
+        truth, latencies = timed_search(index, queries, args.k, exact=True)
+        print(f"{'exact':<14}{'recall':>8}{'p50 ms':>10}{'p99 ms':>10}")
+        print(
+            f"{'':<14}{1.0:>8.3f}"
+            f"{np.percentile(latencies, 50):>10.2f}{np.percentile(latencies, 99):>10.2f}"
+        )
+
+        start = time.perf_counter()
+        index.build_ivf()
+        print(
+            f"\nIVF: {len(index.ivf.centroids)} lists built in "
+            f"{time.perf_counter() - start:.1f}s"
+        )
+        print(f"{'nprobe':<14}{'recall':>8}{'p50 ms':>10}{'p99 ms':>10}")
+        for nprobe in (int(n) for n in args.nprobe.split(",")):
+            results, latencies = timed_search(index, queries, args.k, nprobe=nprobe)
+            print(
+                f"{nprobe:<14}{recall(results, truth):>8.3f}"
+                f"{np.percentile(latencies, 50):>10.2f}"
+                f"{np.percentile(latencies, 99):>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
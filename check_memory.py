@@ -0,0 +1,134 @@
+"""
+Report the memory of every server process, e.g. with and without SHARED_WEIGHTS.
+
+Starts the server once per configuration, waits until all workers are set
+up and prints RSS, PSS (shared pages divided between the processes mapping
+them) and USS (pages no other process maps) of each of its processes. RSS
+counts shared weights in full in every worker: compare PSS and USS to see
+what sharing saves.
+
+    python check_memory.py --sweep SHARED_WEIGHTS=0,1 --sweep WORKERS_PER_DEVICE=4
+"""
+
+import argparse
+import os
+import re
+import sys
+
+import requests
+
+from benchmark import parse_sweep, start_server, stop_server, wait_ready
+
+WORKER_KEY = re.compile(r'api="([^"]+)",worker="(\d+)"')
+
+
+def session_pids(sid: int) -> list[int]:
+    """Processes of session ``sid``, which the started server leads."""
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces, the fields after it not
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[3]) == sid:
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def memory(pid: int) -> dict[str, int]:
+    """RSS, PSS and USS of ``pid`` in bytes."""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                values[name] = int(value.split()[0]) * 1024
+    return {
+        "rss": values["Rss"],
+        "pss": values["Pss"],
+        "uss": values["Private_Clean"] + values["Private_Dirty"],
+    }
+
+
+def roles(url: str, server_pid: int) -> dict[int, str]:
+    """What each known process is: the main process or a worker of an API."""
+    startup = requests.get(f"{url}/ready", timeout=5).json()["startup"]
+    names = {server_pid: "main"}
+    for key in startup:
+        match = WORKER_KEY.search(key)
+        if match:
+            names[int(match.group(2))] = f"worker {match.group(1)}"
+    return names
+
+
+def report(config: dict[str, str], url: str, server_pid: int) -> dict[str, int]:
+    names = roles(url, server_pid)
+    print(f"\n{config or 'default configuration'}")
+    print(f"{'pid':>8}  {'process':<22}{'RSS MB':>10}{'PSS MB':>10}{'USS MB':>10}")
+    totals = {"rss": 0, "pss": 0, "uss": 0}
+    for pid in session_pids(server_pid):
+        try:
+            usage = memory(pid)
+        except OSError:
+            continue  # exited in the meantime
+        for k in totals:
+            totals[k] += usage[k]
+        print(
+            f"{pid:>8}  {names.get(pid, 'helper'):<22}"
+            + "".join(f"{usage[k] / 2**20:>10.0f}" for k in ("rss", "pss", "uss"))
+        )
+    print(
+        f"{'':>8}  {'total':<22}"
+        + "".join(f"{totals[k] / 2**20:>10.0f}" for k in ("rss", "pss", "uss"))
+    )
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.strip().splitlines()[1:]),
+    )
+    parser.add_argument("--stub", action="store_true", help="Start with STUB_MODELS=1")
+    parser.add_argument(
+        "--sweep",
+        action="append",
+        default=[],
+        metavar="VAR=V1,V2",
+        help="Server environment values to compare (repeatable, all combinations)",
+    )
+    parser.add_argument("--server-script", default="server.py", help="Server to start")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--server-log", help="Append server output to this file")
+    args = parser.parse_args()
+
+    url = f"http://127.0.0.1:{args.port}"
+    summary = []
+    for config in parse_sweep(args.sweep) if args.sweep else [{}]:
+        process = start_server(config, args)
+        try:
+            wait_ready(url, process, args.startup_timeout)
+            summary.append((config, report(config, url, process.pid)))
+        except (RuntimeError, TimeoutError) as e:
+            print(f"{config}: {e}", file=sys.stderr)
+        finally:
+            stop_server(process)
+
+    if len(summary) > 1:
+        print(f"\n{'configuration':<50}{'RSS MB':>10}{'PSS MB':>10}{'USS MB':>10}")
+        for config, totals in summary:
+            name = " ".join(f"{k}={v}" for k, v in config.items())
+            print(
+                f"{name:<50}"
+                + "".join(f"{totals[k] / 2**20:>10.0f}" for k in ("rss", "pss", "uss"))
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Compare the ONNX Runtime backend (FP32 and dynamic INT8) with PyTorch.
+
+Embeds a fixed, seeded sample set with every backend and prints the cosine
+similarity to the PyTorch embeddings and the throughput of each backend.
+Exports are cached in ONNX_CACHE_DIR, exactly as the APIs use them.
+
+    python check_onnx.py --samples 64 --batch-size 16
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from sentence_transformers import SentenceTransformer
+from transformers import AutoImageProcessor, AutoModel
+
+from api_embed import VISION_MODEL
+from api_onnx import SentenceEmbedding, VisionEmbedding, load_or_export
+from api_startup import model_revision, resolve_model
+from api_text import TEXT_MODEL
+from benchmark import WORDS
+
+
+def sample_texts(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        "search_query: " + " ".join(rng.choice(WORDS, rng.integers(3, 40)))
+        for _ in range(count)
+    ]
+
+
+def sample_images(count, seed=0):
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        height, width = rng.integers(160, 640, size=2)
+        y, x = np.mgrid[0:height, 0:width]
+        base = rng.uniform(0, 255, size=3)
+        freq = rng.uniform(5, 60, size=3)
+        pixels = np.stack(
+            [base[c] / 2 + 60 * np.sin((x + y * c) / freq[c]) for c in range(3)],
+            axis=-1,
+        )
+        pixels += rng.normal(0, 10, pixels.shape)
+        images.append(Image.fromarray(pixels.clip(0, 255).astype(np.uint8)))
+    return images
+
+
+def run(name, embed, batches, reference=None):
+    """Embed every batch with ``embed``, print stats and return the embeddings."""
+    embed(batches[0])  # warm up
+    start = time.perf_counter()
+    embeddings = np.concatenate([embed(batch) for batch in batches])
+    elapsed = time.perf_counter() - start
+    line = f"  {name:<10} {len(embeddings) / elapsed:8.1f} items/s"
+    if reference is not None:
+        cosine = (embeddings * reference).sum(axis=1) / (
+            np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference, axis=1)
+        )
+        line += f"   cosine min {cosine.min():.5f} mean {cosine.mean():.5f}"
+    print(line)
+    return embeddings
+
+
+def compare(model_name, build, torch_embed, batches):
+    print(model_name)
+    reference = run("torch", torch_embed, batches)
+    revision = model_revision(resolve_model(model_name))
+    for quantize in (False, True):
+        encoder = load_or_export(model_name, revision, build, quantize_model=quantize)
+        name = "onnx-int8" if quantize else "onnx-fp32"
+        run(name, lambda inputs, encoder=encoder: encoder(**inputs), batches, reference)
+
+
+def chunk(items, size):
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def check_text(model, model_name, texts, batch_size):
+    def build():
+        features = model.tokenize(texts[:1])
+        sample = {k: v for k, v in features.items() if isinstance(v, torch.Tensor)}
+        return SentenceEmbedding(model, list(sample)), sample
+
+    def tokenize(batch):
+        features = model.tokenize(batch)
+        return {k: v for k, v in features.items() if isinstance(v, torch.Tensor)}
+
+    batches = [tokenize(batch) for batch in chunk(texts, batch_size)]
+    module, _ = build()
+
+    def torch_embed(features):
+        with torch.no_grad():
+            return module(*features.values()).numpy()
+
+    compare(model_name, build, torch_embed, batches)
+
+
+def check_vision(model, processor, model_name, images, batch_size):
+    module = VisionEmbedding(model).eval()
+
+    def build():
+        crop = processor.crop_size
+        return module, {
+            "pixel_values": torch.zeros(1, 3, crop["height"], crop["width"])
+        }
+
+    batches = [
+        {"pixel_values": processor(batch, return_tensors="pt")["pixel_values"]}
+        for batch in chunk(images, batch_size)
+    ]
+
+    def torch_embed(inputs):
+        with torch.no_grad():
+            return module(**inputs).numpy()
+
+    compare(model_name, build, torch_embed, batches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--samples", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--skip-text", action="store_true")
+    parser.add_argument("--skip-vision", action="store_true")
+    args = parser.parse_args()
+
+    if not args.skip_text:
+        model = SentenceTransformer(TEXT_MODEL, trust_remote_code=True, device="cpu")
+        check_text(model, TEXT_MODEL, sample_texts(args.samples), args.batch_size)
+
+    if not args.skip_vision:
+        processor = AutoImageProcessor.from_pretrained(VISION_MODEL, use_fast=False)
+        model = AutoModel.from_pretrained(VISION_MODEL, trust_remote_code=True)
+        check_vision(
+            model, processor, VISION_MODEL, sample_images(args.samples), args.batch_size
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Compare sequential and pipelined preprocessing of the image endpoint.
+
+Embeds the same batch with preprocessing before the forward pass and with
+the PreprocessPipeline at each --micro-batch size, and prints throughput,
+the overlap of preprocessing and forward passes, and the largest difference
+from the sequential embeddings. Uses random photos-sized images unless
+image files are given; STUB_MODELS=1 with STUB_ITEM_MS runs without weights.
+
+    python check_pipeline.py --batch-size 32 --micro-batch 4,8,16
+    python check_pipeline.py photo1.jpg photo2.png --threads 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from api_embed import NomicVisionAPI
+from api_preprocess import PreprocessPipeline
+
+
+def random_images(count, width, height, rng):
+    # Smooth images, so that resampling costs what it does for photos
+    small = rng.integers(0, 256, (count, height // 16, width // 16, 3), np.uint8)
+    return [
+        Image.fromarray(pixels).resize((width, height), Image.BILINEAR)
+        for pixels in small
+    ]
+
+
+def timed(api, images, rounds):
+    best, overlaps = None, []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        if api.pipeline is None:
+            embeddings = api.embed(images)
+        else:
+            embeddings, timings = api.pipeline.run(images, api.embed_inputs)
+            overlaps.append(timings["overlap"])
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return embeddings, best, np.mean(overlaps) if overlaps else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.strip().splitlines()[1:]),
+    )
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--micro-batch", default="4,8,16")
+    parser.add_argument("--threads", type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument("--size", default="1024x768", help="Random image size")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    if args.images:
+        images = [Image.open(path).convert("RGB") for path in args.images]
+        images = (images * args.batch_size)[: args.batch_size]
+    else:
+        width, height = (int(n) for n in args.size.split("x"))
+        images = random_images(args.batch_size, width, height, np.random.default_rng(0))
+
+    api = NomicVisionAPI(max_batch_size=args.batch_size, api_path="/img/embed")
+    api.setup(args.device)
+    if api.fast_preprocessor is None:
+        sys.exit("The pipeline needs the fast preprocessor (FAST_PREPROCESS=1).")
+
+    api.pipeline = None
+    expected, sequential, _ = timed(api, images, args.rounds)
+    print(f"{len(images)} images, {args.threads} preprocessing threads")
+    print(f"{'micro-batch':<14}{'images/s':>10}{'speedup':>10}{'overlap':>10}")
+    print(f"{'sequential':<14}{len(images) / sequential:>10.1f}{1.0:>10.2f}")
+    failed = False
+    for micro_batch in (int(n) for n in args.micro_batch.split(",")):
+        api.pipeline = PreprocessPipeline(
+            api.fast_preprocessor, micro_batch, args.threads, api.device
+        )
+        actual, elapsed, overlap = timed(api, images, args.rounds)
+        error = float(np.abs(actual - expected).max())
+        failed |= error > args.atol
+        print(
+            f"{micro_batch:<14}{len(images) / elapsed:>10.1f}"
+            f"{sequential / elapsed:>10.2f}{overlap:>10.0%}"
+            f"{'' if error <= args.atol else f'  differs by {error:.2e}'}"
+        )
+    if failed:
+        sys.exit(f"Pipelined embeddings differ by more than {args.atol}.")
+
+
+if __name__ == "__main__":
+    main()
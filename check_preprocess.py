@@ -0,0 +1,93 @@
+"""
+Compare BatchImagePreprocessor against the slow transformers image processor.
+
+Prints the largest absolute difference in pixel_values per image mode and
+the time each engine takes, and fails if any exceeds --atol. Runs offline on
+random RGB, RGBA and grayscale images of several sizes and aspect ratios
+with the nomic-embed-vision preprocessing configuration (see api_stub)
+unless image files or --hub, which downloads the model's processor, are given.
+
+    python check_preprocess.py
+    python check_preprocess.py photo1.jpg photo2.png --hub --atol 1e-4
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from api_preprocess import BatchImagePreprocessor
+from api_stub import stub_image_processor
+
+MODES = ("RGB", "RGBA", "L")
+SIZES = ((640, 480), (480, 640), (224, 224), (225, 1000), (1023, 229), (300, 301))
+
+
+def random_images(mode, rng):
+    images = []
+    for width, height in SIZES:
+        # Smooth images, so that resampling differences show like in photos
+        small = rng.integers(0, 256, (height // 8 + 1, width // 8 + 1, 4), np.uint8)
+        image = Image.fromarray(small, "RGBA").resize((width, height), Image.BILINEAR)
+        images.append(image.convert(mode))
+    return images
+
+
+def compare(processor, name, images, atol):
+    fast = BatchImagePreprocessor.from_processor(processor)
+
+    start = time.perf_counter()
+    expected = processor(images, return_tensors="pt")["pixel_values"]
+    slow_time = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = fast(images)["pixel_values"]
+    fast_time = time.perf_counter() - start
+
+    errors = (actual - expected).abs().flatten(1).max(dim=1).values.tolist()
+    print(
+        f"{name:<8}{len(images)} images: slow {slow_time * 1000:.1f}ms, "
+        f"fast {fast_time * 1000:.1f}ms, max abs diff {max(errors):.2e}"
+    )
+    return all(error <= atol for error in errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.strip().splitlines()[1:]),
+    )
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--hub", action="store_true", help="Use the hub processor")
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.hub:
+        from transformers import AutoImageProcessor
+
+        from api_embed import VISION_MODEL
+
+        processor = AutoImageProcessor.from_pretrained(VISION_MODEL, use_fast=False)
+    else:
+        processor = stub_image_processor()
+    if args.images:
+        batches = {"files": [Image.open(path) for path in args.images]}
+    else:
+        rng = np.random.default_rng(args.seed)
+        batches = {mode: random_images(mode, rng) for mode in MODES}
+    failed = [
+        name
+        for name, images in batches.items()
+        if not compare(processor, name, images, args.atol)
+    ]
+    if failed:
+        sys.exit(
+            f"Preprocessing of {', '.join(failed)} differs by more than {args.atol}."
+        )
+
+
+if __name__ == "__main__":
+    main()
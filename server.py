@@ -2,33 +2,59 @@ import os
 
 import litserve as ls
 
-from api_embed import NomicVisionAPI
+import api_metrics
+from api_analyze import ImageAnalyzeAPI, register_analyze_route
+from api_batching import batching_loop
+from api_bulk import register_bulk_route
+from api_cache import cache_stats
+from api_index import register_search_route
+from api_priority import register_load_shedding
+from api_startup import register_readiness_route
 from api_stats import ImageStatsAPI
 from api_text import NomicTextAPI
+from api_utils import register_upload_limit
 
 PORT = int(os.environ.get("PORT", "8000"))
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 NUM_API_SERVERS = int(os.environ.get("NUM_API_SERVERS", "1"))
-WORKERS_PER_DEVICE = int(os.environ.get("WORKERS_PER_DEVICE ", "1"))
+WORKERS_PER_DEVICE = int(os.environ.get("WORKERS_PER_DEVICE", "1"))
 IMAGE_MAX_BATCH_SIZE = int(os.environ.get("IMAGE_MAX_BATCH_SIZE", "16"))
 IMAGE_BATCH_TIMEOUT = float(os.environ.get("IMAGE_BATCH_TIMEOUT", "0.2"))
+# p99 latency targets (seconds) for adaptive batching, see api_batching
+IMAGE_LATENCY_TARGET = float(os.environ.get("IMAGE_LATENCY_TARGET", "1.0"))
+# Queue bounds (0: unbounded) and bulk share of batches, see api_priority
+IMAGE_MAX_QUEUE = int(os.environ.get("IMAGE_MAX_QUEUE", str(16 * IMAGE_MAX_BATCH_SIZE)))
+IMAGE_BULK_QUEUE = int(os.environ.get("IMAGE_BULK_QUEUE", str(IMAGE_MAX_QUEUE // 2)))
+IMAGE_BULK_SHARE = float(os.environ.get("IMAGE_BULK_SHARE", "0.25"))
+STATS_MAX_BATCH_SIZE = int(os.environ.get("STATS_MAX_BATCH_SIZE", "16"))
+STATS_BATCH_TIMEOUT = float(os.environ.get("STATS_BATCH_TIMEOUT", "0.05"))
 TEXT_MAX_BATCH_SIZE = int(os.environ.get("TEXT_MAX_BATCH_SIZE", "32"))
 TEXT_BATCH_TIMEOUT = float(os.environ.get("TEXT_BATCH_TIMEOUT", "0.05"))
+TEXT_LATENCY_TARGET = float(os.environ.get("TEXT_LATENCY_TARGET", "0.25"))
+TEXT_MAX_QUEUE = int(os.environ.get("TEXT_MAX_QUEUE", str(16 * TEXT_MAX_BATCH_SIZE)))
+TEXT_BULK_QUEUE = int(os.environ.get("TEXT_BULK_QUEUE", str(TEXT_MAX_QUEUE // 2)))
+TEXT_BULK_SHARE = float(os.environ.get("TEXT_BULK_SHARE", "0.25"))
 
 if __name__ == "__main__":
     stats_api = ImageStatsAPI(
-        max_batch_size=1,
+        max_batch_size=STATS_MAX_BATCH_SIZE,
+        batch_timeout=STATS_BATCH_TIMEOUT,
         api_path="/img/stats",
     )
-    img_api = NomicVisionAPI(
+    # Also serves /img/analyze, with the same loaded vision model
+    img_api = ImageAnalyzeAPI(
         max_batch_size=IMAGE_MAX_BATCH_SIZE,
         batch_timeout=IMAGE_BATCH_TIMEOUT,
         api_path="/img/embed",
+        loop=batching_loop(
+            IMAGE_MAX_BATCH_SIZE, IMAGE_LATENCY_TARGET, IMAGE_BULK_SHARE
+        ),
     )
     txt_api = NomicTextAPI(
         max_batch_size=TEXT_MAX_BATCH_SIZE,
         batch_timeout=TEXT_BATCH_TIMEOUT,
         api_path="/txt/embed",
+        loop=batching_loop(TEXT_MAX_BATCH_SIZE, TEXT_LATENCY_TARGET, TEXT_BULK_SHARE),
     )
     server = ls.LitServer(
         [stats_api, img_api, txt_api],
@@ -36,6 +62,16 @@ if __name__ == "__main__":
         track_requests=True,
         workers_per_device=WORKERS_PER_DEVICE,
     )
+    register_load_shedding(server, img_api, IMAGE_MAX_QUEUE, IMAGE_BULK_QUEUE)
+    register_analyze_route(server, img_api)
+    register_load_shedding(server, txt_api, TEXT_MAX_QUEUE, TEXT_BULK_QUEUE)
+    server.app.add_api_route("/cache/stats", cache_stats, methods=["GET"])
+    register_bulk_route(server, txt_api, "/txt/embed/bulk")
+    register_search_route(server, text_api=txt_api, image_api=img_api)
+    api_metrics.register_metrics_route(server)
+    register_readiness_route(server)
+    register_upload_limit(server)
+    api_metrics.reset()
     server.run(
         port=PORT,
         host="0.0.0.0",